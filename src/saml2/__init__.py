@@ -77,6 +77,32 @@ def class_name(instance):
     return "%s:%s" % (instance.c_namespace, instance.c_tag)
 
 
+class ParsedXml(six.binary_type):
+    """ XML text that carries the element tree it was parsed into, or
+    serialized from. Everything that expects the text works as before, and
+    :py:func:`create_class_from_xml_string` uses the element instead of
+    parsing the text again.
+    """
+
+    def __new__(cls, text, element):
+        obj = six.binary_type.__new__(cls, text)
+        obj.element = element
+        return obj
+
+
+def parsed_xml(xml_string):
+    """ Parses XML text unless it has already been parsed.
+
+    :param xml_string: The XML text
+    :return: A :py:class:`ParsedXml` instance
+    """
+    if isinstance(xml_string, ParsedXml):
+        return xml_string
+    if not isinstance(xml_string, six.binary_type):
+        xml_string = xml_string.encode('utf-8')
+    return ParsedXml(xml_string, defusedxml.ElementTree.fromstring(xml_string))
+
+
 def create_class_from_xml_string(target_class, xml_string):
     """Creates an instance of the target class from a string.
 
@@ -91,9 +117,12 @@ def create_class_from_xml_string(target_class, xml_string):
         the contents of the XML - or None if the root XML tag and namespace did
         not match those of the target class.
     """
-    if not isinstance(xml_string, six.binary_type):
-        xml_string = xml_string.encode('utf-8')
-    tree = defusedxml.ElementTree.fromstring(xml_string)
+    if isinstance(xml_string, ParsedXml):
+        tree = xml_string.element
+    else:
+        if not isinstance(xml_string, six.binary_type):
+            xml_string = xml_string.encode('utf-8')
+        tree = defusedxml.ElementTree.fromstring(xml_string)
     return create_class_from_element_tree(target_class, tree)
 
 
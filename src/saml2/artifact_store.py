@@ -0,0 +1,325 @@
+"""
+Storage of messages that have been handed out by reference as SAML artifacts.
+
+An artifact is only a pointer to a message, the message itself has to be
+kept around until the receiver resolves the artifact through the artifact
+resolution service. According to the SAML bindings specification an artifact
+MUST only be resolvable once and only during a short period of time.
+
+The stores are indexed by the message handle of the artifact
+(the last 20 bytes of a type 0x0004 artifact).
+"""
+import base64
+import importlib
+import logging
+import sqlite3
+import threading
+
+from binascii import hexlify
+from collections import OrderedDict
+
+import six
+
+from saml2 import SAMLError
+from saml2 import saml
+from saml2 import samlp
+from saml2 import extension_element_from_string
+from saml2 import extension_elements_to_elements
+from saml2.time_util import utc_now
+
+logger = logging.getLogger(__name__)
+
+# How long, in seconds, an artifact can be resolved after it was issued.
+ARTIFACT_LIFETIME = 300
+# Max number of outstanding artifacts kept by the in memory store.
+MAX_ARTIFACTS = 10000
+
+
+class ArtifactError(SAMLError):
+    pass
+
+
+def message_handle(artifact):
+    """ Picks out the message handle from a Base64 encoded type 0x0004
+    SAML artifact.
+
+    :param artifact: The Base64 encoded artifact
+    :return: The message handle as a hex string
+    """
+    try:
+        _art = base64.b64decode(artifact)
+    except (TypeError, ValueError):
+        raise ArtifactError("Not a Base64 encoded artifact")
+
+    if len(_art) != 44:
+        raise ArtifactError("Wrong artifact length: %d" % len(_art))
+
+    handle = hexlify(_art[24:44])
+    if isinstance(handle, six.binary_type):
+        handle = handle.decode('ascii')
+    return handle
+
+
+def message_from_string(xmlstr):
+    """ Turns the string representation of a stored message back into a
+    SAML message instance.
+    """
+    return extension_elements_to_elements(
+        [extension_element_from_string(xmlstr)], [samlp, saml])[0]
+
+
+class ArtifactStore(object):
+    """ Interface of an artifact store.
+
+    Items are kept for *lifetime* seconds, a message can only be picked out
+    once using :py:meth:`pop`.
+    """
+
+    def __init__(self, lifetime=ARTIFACT_LIFETIME):
+        self.lifetime = lifetime
+
+    def store(self, artifact, message):
+        """ Stores a message under the message handle of the artifact.
+
+        :param artifact: The Base64 encoded artifact
+        :param message: The SAML message the artifact points to
+        """
+        raise NotImplementedError()
+
+    def get(self, artifact):
+        """ Returns the message an artifact points to without consuming it.
+
+        :param artifact: The Base64 encoded artifact
+        :return: The SAML message, raises KeyError if it is not known or the
+            artifact has expired.
+        """
+        raise NotImplementedError()
+
+    def pop(self, artifact):
+        """ Returns the message an artifact points to and removes it from
+        the store. This is what should be used when resolving an artifact.
+
+        :param artifact: The Base64 encoded artifact
+        :return: The SAML message, raises KeyError if it is not known or the
+            artifact has expired.
+        """
+        raise NotImplementedError()
+
+    def remove_expired(self, now=None):
+        """ Removes all expired artifacts.
+
+        :param now: Point in time, as seconds since the epoch, to compare
+            with. Default is the current time.
+        :return: The number of artifacts removed
+        """
+        raise NotImplementedError()
+
+    def __getitem__(self, artifact):
+        return self.get(artifact)
+
+    def __setitem__(self, artifact, message):
+        self.store(artifact, message)
+
+    def __contains__(self, artifact):
+        try:
+            self.get(artifact)
+        except KeyError:
+            return False
+        return True
+
+
+class ArtifactStoreMemory(ArtifactStore):
+    """ In memory storage of artifacts, bounded in size and time. Only useful
+    if all messages from a client end up in the same process.
+    """
+
+    def __init__(self, lifetime=ARTIFACT_LIFETIME, max_entries=MAX_ARTIFACTS):
+        ArtifactStore.__init__(self, lifetime)
+        self.max_entries = max_entries
+        # Since all items have the same lifetime insertion order is also
+        # expiration order.
+        self._db = OrderedDict()
+        self._lock = threading.Lock()
+
+    def store(self, artifact, message):
+        handle = message_handle(artifact)
+        with self._lock:
+            self._remove_expired(utc_now())
+            self._db[handle] = (utc_now() + self.lifetime, message)
+            while len(self._db) > self.max_entries:
+                _handle, _ = self._db.popitem(last=False)
+                logger.info("Artifact store full, dropped %s", _handle)
+
+    def _lookup(self, artifact, remove):
+        handle = message_handle(artifact)
+        with self._lock:
+            if remove:
+                expires, message = self._db.pop(handle)
+            else:
+                expires, message = self._db[handle]
+
+        if expires < utc_now():
+            raise KeyError("Artifact expired")
+        return message
+
+    def get(self, artifact):
+        return self._lookup(artifact, False)
+
+    def pop(self, artifact):
+        return self._lookup(artifact, True)
+
+    def _remove_expired(self, now):
+        removed = 0
+        while self._db:
+            handle, (expires, _) = next(iter(self._db.items()))
+            if expires >= now:
+                break
+            del self._db[handle]
+            removed += 1
+        return removed
+
+    def remove_expired(self, now=None):
+        if now is None:
+            now = utc_now()
+        with self._lock:
+            return self._remove_expired(now)
+
+    def __len__(self):
+        return len(self._db)
+
+
+class ArtifactStoreSQLite(ArtifactStore):
+    """ Artifacts stored in a SQLite database. Can be shared between
+    processes on the same host.
+    """
+
+    def __init__(self, filename, lifetime=ARTIFACT_LIFETIME):
+        ArtifactStore.__init__(self, lifetime)
+        self._db = sqlite3.connect(filename, check_same_thread=False,
+                                   isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS artifact ("
+                "handle TEXT PRIMARY KEY, expires INTEGER, message TEXT)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS artifact_expires "
+                "ON artifact (expires)")
+
+    def store(self, artifact, message):
+        handle = message_handle(artifact)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO artifact VALUES (?, ?, ?)",
+                (handle, utc_now() + self.lifetime, "%s" % message))
+
+    def get(self, artifact):
+        handle = message_handle(artifact)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT message FROM artifact WHERE handle = ? AND "
+                "expires >= ?", (handle, utc_now())).fetchone()
+        if row is None:
+            raise KeyError("Unknown artifact")
+        return message_from_string(row[0])
+
+    def pop(self, artifact):
+        handle = message_handle(artifact)
+        with self._lock:
+            # The delete decides who gets the message if two processes
+            # try to resolve the same artifact.
+            row = self._db.execute(
+                "SELECT message, expires FROM artifact WHERE handle = ?",
+                (handle,)).fetchone()
+            if row is None:
+                raise KeyError("Unknown artifact")
+            cur = self._db.execute("DELETE FROM artifact WHERE handle = ?",
+                                   (handle,))
+        if cur.rowcount != 1 or row[1] < utc_now():
+            raise KeyError("Unknown artifact")
+        return message_from_string(row[0])
+
+    def remove_expired(self, now=None):
+        if now is None:
+            now = utc_now()
+        with self._lock:
+            cur = self._db.execute("DELETE FROM artifact WHERE expires < ?",
+                                   (now,))
+        return cur.rowcount
+
+    def close(self):
+        self._db.close()
+
+
+class ArtifactStoreMemcached(ArtifactStore):
+    """ Artifacts stored in memcached, can be shared between hosts.
+    Expiration is handled by memcached.
+    """
+
+    def __init__(self, servers, lifetime=ARTIFACT_LIFETIME):
+        import memcache
+
+        ArtifactStore.__init__(self, lifetime)
+        self._cache = memcache.Client(servers)
+
+    @staticmethod
+    def _key(artifact):
+        return "artifact_%s" % message_handle(artifact)
+
+    def store(self, artifact, message):
+        if not self._cache.set(self._key(artifact), "%s" % message,
+                               time=self.lifetime):
+            raise ArtifactError("set failed")
+
+    def get(self, artifact):
+        res = self._cache.get(self._key(artifact))
+        if res is None:
+            raise KeyError("Unknown artifact")
+        return message_from_string(res)
+
+    def pop(self, artifact):
+        key = self._key(artifact)
+        res = self._cache.get(key)
+        # Only the one who manages to delete the item may use it
+        if res is None or not self._cache.delete(key):
+            raise KeyError("Unknown artifact")
+        return message_from_string(res)
+
+    def remove_expired(self, now=None):
+        return 0
+
+
+def artifact_store_factory(spec, lifetime=None):
+    """ Creates an artifact store according to a configuration specification.
+
+    :param spec: None or "memory" for an in memory store or a tuple
+        (type, data) where type is one of "memory", "sqlite", "memcached"
+        or "class". For "memory" data is the max number of entries, for
+        "sqlite" a file name, for "memcached" a list of servers and for
+        "class" the dotted path of a class that implements ArtifactStore.
+    :param lifetime: Number of seconds an artifact is valid
+    :return: An ArtifactStore instance
+    """
+    if lifetime is None:
+        lifetime = ARTIFACT_LIFETIME
+
+    if not spec:
+        return ArtifactStoreMemory(lifetime)
+    elif isinstance(spec, six.string_types):
+        if spec.lower() == "memory":
+            return ArtifactStoreMemory(lifetime)
+    else:
+        typ, data = spec
+        typ = typ.lower()
+        if typ == "memory":
+            return ArtifactStoreMemory(lifetime, data)
+        elif typ == "sqlite":
+            return ArtifactStoreSQLite(data, lifetime)
+        elif typ == "memcached":
+            return ArtifactStoreMemcached(data, lifetime)
+        elif typ == "class":
+            mod, clas = data.rsplit('.', 1)
+            mod = importlib.import_module(mod)
+            return getattr(mod, clas)(lifetime=lifetime)
+
+    raise SAMLError("Unknown artifact storage type: %s" % (spec,))
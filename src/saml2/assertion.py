@@ -20,6 +20,9 @@ from saml2.time_util import in_a_while
 
 logger = logging.getLogger(__name__)
 
+# Max number of SPs assertion templates are kept for
+MAX_ASSERTION_TEMPLATES = 1024
+
 
 def _filter_values(vals, vlist=None, must=False):
     """ Removes values from *vals* that does not appear in vlist
@@ -328,6 +331,7 @@ class Policy(object):
         else:
             self._restrictions = None
         self.acs = []
+        self._templates = {}
 
     def compile(self, restrictions):
         """ This is only for IdPs or AAs, and it's about limiting what
@@ -342,6 +346,7 @@ class Policy(object):
         """
 
         self._restrictions = copy.deepcopy(restrictions)
+        self._templates = {}
 
         for who, spec in self._restrictions.items():
             if spec is None:
@@ -492,7 +497,7 @@ class Policy(object):
         :return: String representation of the time
         """
 
-        return in_a_while(**self.get_lifetime(sp_entity_id))
+        return self.template(sp_entity_id).not_on_or_after()
 
     def filter(self, ava, sp_entity_id, mdstore, required=None, optional=None):
         """ What attribute and attribute values returns depends on what
@@ -558,14 +563,25 @@ class Policy(object):
         :param sp_entity_id: The SP entity ID
         :return: A saml.Condition instance
         """
-        return factory(saml.Conditions,
-                       not_before=instant(),
-                       # How long might depend on who's getting it
-                       not_on_or_after=self.not_on_or_after(sp_entity_id),
-                       audience_restriction=[factory(
-                           saml.AudienceRestriction,
-                           audience=[factory(saml.Audience,
-                                             text=sp_entity_id)])])
+        return self.template(sp_entity_id).conditions()
+
+    def template(self, sp_entity_id):
+        """ The parts of an assertion that are the same for every assertion
+        issued to a SP. Built the first time they are asked for.
+
+        :param sp_entity_id: The SP entity ID
+        :return: An AssertionTemplate instance
+        """
+        try:
+            return self._templates[sp_entity_id]
+        except KeyError:
+            pass
+
+        tmpl = AssertionTemplate(self, sp_entity_id)
+        if len(self._templates) >= MAX_ASSERTION_TEMPLATES:
+            self._templates.clear()
+        self._templates[sp_entity_id] = tmpl
+        return tmpl
 
     def get_sign(self, sp_entity_id):
         """
@@ -579,6 +595,47 @@ class Policy(object):
         return self.get("sign", sp_entity_id, [])
 
 
+class AssertionTemplate(object):
+    """ What the assertions issued to one SP have in common: the audience,
+    the lifetime and the attribute name format. Each assertion only fills
+    in the dynamic values. """
+
+    def __init__(self, policy, sp_entity_id):
+        self.sp_entity_id = sp_entity_id
+        self.name_format = policy.get_name_form(sp_entity_id)
+        self.lifetime = policy.get_lifetime(sp_entity_id)
+        self._converter = None
+
+    def not_on_or_after(self):
+        return in_a_while(**self.lifetime)
+
+    def conditions(self):
+        """ Return a saml.Conditions instance valid from now on """
+        return saml.Conditions(
+            not_before=instant(),
+            # How long might depend on who's getting it
+            not_on_or_after=self.not_on_or_after(),
+            # Every assertion gets its own, callers may add to it
+            audience_restriction=[factory(
+                saml.AudienceRestriction,
+                audience=[factory(saml.Audience, text=self.sp_entity_id)])])
+
+    def converter(self, acs):
+        """ The attribute converter for the name format of this SP
+
+        :param acs: AttributeConverters
+        :return: An AttributeConverter instance or None
+        """
+        if self._converter is None or self._converter[0] is not acs:
+            _conv = None
+            for aconv in acs:
+                if aconv.name_format == self.name_format:
+                    _conv = aconv
+                    break
+            self._converter = (acs, _conv)
+        return self._converter[1]
+
+
 class EntityCategories(object):
     pass
 
@@ -762,12 +819,15 @@ class Assertion(dict):
         """
 
         if policy:
-            _name_format = policy.get_name_form(sp_entity_id)
+            _conv = policy.template(sp_entity_id).converter(attrconvs)
+            if _conv:
+                _attributes = _conv.to_(self)
+            else:
+                _attributes = None
         else:
-            _name_format = NAME_FORMAT_URI
+            _attributes = from_local(attrconvs, self, NAME_FORMAT_URI)
 
-        attr_statement = saml.AttributeStatement(attribute=from_local(
-            attrconvs, self, _name_format))
+        attr_statement = saml.AttributeStatement(attribute=_attributes)
 
         if encrypt == "attributes":
             for attr in attr_statement.attribute:
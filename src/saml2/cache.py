@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 
+import heapq
 import shelve
+import threading
+
 import six
 from saml2.ident import code, decode
 from saml2 import time_util, SAMLError
+from saml2.s_utils import Sweeper
+from saml2.time_util import to_epoch
+from saml2.time_util import utc_now
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,28 +27,233 @@ class CacheError(SAMLError):
     pass
 
 
+# Marks a subject as deleted but not yet flushed
+_DELETED = object()
+
+# Max number of expired entries evicted when new information is stored
+EVICT_BATCH = 100
+
+
 class Cache(object):
-    def __init__(self, filename=None):
+    """ Keeps the identity information received about subjects.
+
+    If a filename is given the information is stored in a shelve database.
+    Only the subjects that has been changed are written back and changes can
+    be batched, they are then written when *batch_size* changes has been
+    made or *flush_interval* milliseconds has passed since the first
+    unwritten change, whichever comes first.
+
+    Entries are indexed on when they stop being valid. Expired entries are
+    evicted a few at the time when new information is stored, in the same
+    write, by calling :py:meth:`remove_expired` or by a background sweeper.
+
+    :param filename: Name of the shelve database, None means in memory
+    :param batch_size: Number of changes to collect before writing them
+    :param flush_interval: Max time in milliseconds a change stays unwritten
+    :param sweep_interval: If given, seconds between background sweeps
+        for expired entries
+    """
+
+    def __init__(self, filename=None, batch_size=1, flush_interval=0,
+                 sweep_interval=0):
         if filename:
-            self._db = shelve.open(filename, writeback=True, protocol=2)
+            self._db = shelve.open(filename, writeback=False, protocol=2)
             self._sync = True
         else:
             self._db = {}
             self._sync = False
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # subject -> entities dict or _DELETED
+        self._dirty = {}
+        self._changes = 0
+        self._lock = threading.RLock()
+        self._timer = None
+        # heap of (not on or after, subject, entity id)
+        self._expires = []
+        self._live = 0
+        self.evicted = 0
+        for cni in list(self._db.keys()):
+            for entity_id, (timestamp, _) in self._db[cni].items():
+                self._index(cni, entity_id, timestamp)
+                self._live += 1
+        heapq.heapify(self._expires)
+        self._sweeper = None
+        if sweep_interval:
+            self.start_sweeper(sweep_interval)
+
+    def _index(self, cni, entity_id, timestamp):
+        expires = to_epoch(timestamp)
+        if expires:
+            self._expires.append((expires, cni, entity_id))
+
+    def _entry(self, cni):
+        try:
+            entry = self._dirty[cni]
+        except KeyError:
+            return self._db[cni]
 
-    def delete(self, name_id):
-        """
+        if entry is _DELETED:
+            raise KeyError(cni)
+        return entry
 
-        :param name_id: The subject identifier, a NameID instance
+    def _store(self, entries):
+        """ Stores changed subjects, together they count as one change.
+
+        :param entries: A dictionary subject -> entities dict or _DELETED,
+            a subject without entities is deleted too
         """
-        del self._db[code(name_id)]
+        entries = dict((cni, entry or _DELETED)
+                       for cni, entry in entries.items())
+        if not self._sync:
+            for cni, entry in entries.items():
+                if entry is _DELETED:
+                    del self._db[cni]
+                else:
+                    self._db[cni] = entry
+            return
+
+        with self._lock:
+            self._dirty.update(entries)
+            self._changes += 1
+            if self._changes >= self.batch_size:
+                self.flush()
+            elif self.flush_interval and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval / 1000.0,
+                                              self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """ Writes all changes that hasn't been written yet """
+        if not self._sync:
+            return
+
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            for cni, entry in self._dirty.items():
+                if entry is _DELETED:
+                    try:
+                        del self._db[cni]
+                    except KeyError:
+                        pass
+                else:
+                    self._db[cni] = entry
+            self._dirty = {}
+            self._changes = 0
 
-        if self._sync:
             try:
                 self._db.sync()
             except AttributeError:
                 pass
 
+    def close(self):
+        self.stop_sweeper()
+        self.flush()
+        if self._sync:
+            self._db.close()
+
+    def _remove_expired(self, now, max_items=None):
+        """ Removes expired entries without storing the result, that is left
+        to the caller so it can be done in the same write as other changes.
+
+        :return: A tuple with a dictionary, subject -> what is left of its
+            entities, and the number of entries removed
+        """
+        entries = {}
+        removed = 0
+        while self._expires and self._expires[0][0] < now:
+            if max_items is not None and removed >= max_items:
+                break
+            expires, cni, entity_id = heapq.heappop(self._expires)
+            try:
+                try:
+                    entry = entries[cni]
+                except KeyError:
+                    entry = self._entry(cni)
+                timestamp, _ = entry[entity_id]
+            except KeyError:  # already gone
+                continue
+            if to_epoch(timestamp) != expires:  # has been stored again
+                continue
+
+            del entry[entity_id]
+            entries[cni] = entry
+            self._live -= 1
+            removed += 1
+
+        self.evicted += removed
+        return entries, removed
+
+    def remove_expired(self, now=None, max_items=None):
+        """ Evicts the information that is no longer valid. Subjects
+        are removed when there is no information left about them.
+
+        :param now: Point in time, as seconds since the epoch, to compare
+            with. Default is the current time.
+        :param max_items: Max number of entries to remove, None means all
+            that has expired.
+        :return: The number of (subject, entity) entries removed
+        """
+        if now is None:
+            now = utc_now()
+
+        removed = 0
+        while True:
+            batch = EVICT_BATCH
+            if max_items is not None:
+                batch = min(batch, max_items - removed)
+            # Release the lock between batches so requests aren't held up
+            with self._lock:
+                entries, _removed = self._remove_expired(now, batch)
+                if entries:
+                    self._store(entries)
+            removed += _removed
+            if _removed < batch:
+                break
+            if max_items is not None and removed >= max_items:
+                break
+
+        if removed:
+            logger.debug("Evicted %d expired identity cache entries", removed)
+        return removed
+
+    def start_sweeper(self, interval):
+        """ Starts a background thread that evicts expired information every
+        *interval* seconds.
+        """
+        if self._sweeper is None:
+            self._sweeper = Sweeper(self.remove_expired, interval,
+                                    "IdentityCacheSweeper")
+            self._sweeper.start()
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.stop()
+            self._sweeper = None
+
+    def stats(self):
+        """ Number of (subject, entity) entries in the cache and the number
+        that has been evicted since the cache was opened.
+
+        :return: A dictionary with the keys 'live' and 'evicted'
+        """
+        with self._lock:
+            return {"live": self._live, "evicted": self.evicted}
+
+    def delete(self, name_id):
+        """
+
+        :param name_id: The subject identifier, a NameID instance
+        """
+        cni = code(name_id)
+        with self._lock:
+            self._live -= len(self._entry(cni))
+            self._store({cni: _DELETED})
+
     def get_identity(self, name_id, entities=None,
                      check_not_on_or_after=True):
         """ Get all the identity information that has been received and
@@ -57,8 +268,7 @@ class Cache(object):
         """
         if not entities:
             try:
-                cni = code(name_id)
-                entities = self._db[cni].keys()
+                entities = self.entities(name_id)
             except KeyError:
                 return {}, []
 
@@ -95,7 +305,7 @@ class Cache(object):
         :return: The session information
         """
         cni = code(name_id)
-        (timestamp, info) = self._db[cni][entity_id]
+        (timestamp, info) = self._entry(cni)[entity_id]
         info = info.copy()
         if check_not_on_or_after and time_util.after(timestamp):
             raise ToOld("past %s" % str(timestamp))
@@ -120,15 +330,27 @@ class Cache(object):
             info['name_id'] = code(name_id)
 
         cni = code(name_id)
-        if cni not in self._db:
-            self._db[cni] = {}
+        with self._lock:
+            # Amortize the eviction over the insertions, what is evicted is
+            # written together with the new information
+            entries, _ = self._remove_expired(utc_now(), EVICT_BATCH)
 
-        self._db[cni][entity_id] = (not_on_or_after, info)
-        if self._sync:
             try:
-                self._db.sync()
-            except AttributeError:
-                pass
+                entry = entries[cni]
+            except KeyError:
+                try:
+                    entry = self._entry(cni)
+                except KeyError:
+                    entry = {}
+
+            if entity_id not in entry:
+                self._live += 1
+            entry[entity_id] = (not_on_or_after, info)
+            entries[cni] = entry
+            self._store(entries)
+            expires = to_epoch(not_on_or_after)
+            if expires:
+                heapq.heappush(self._expires, (expires, cni, entity_id))
 
     def reset(self, name_id, entity_id):
         """ Scrap the assertions received from a IdP or an AA about a special
@@ -148,7 +370,7 @@ class Cache(object):
         :return: A possibly empty list of entity identifiers
         """
         cni = code(name_id)
-        return list(self._db[cni].keys())
+        return list(self._entry(cni).keys())
 
     def receivers(self, name_id):
         """ Another name for entities() just to make it more logic in the IdP
@@ -165,7 +387,7 @@ class Cache(object):
         """
         try:
             cni = code(name_id)
-            (timestamp, info) = self._db[cni][entity_id]
+            (timestamp, info) = self._entry(cni)[entity_id]
         except KeyError:
             return False
 
@@ -179,4 +401,11 @@ class Cache(object):
 
         :return: list of subject identifiers
         """
-        return [decode(c) for c in self._db.keys()]
+        with self._lock:
+            keys = set(self._db.keys())
+            for cni, entry in self._dirty.items():
+                if entry is _DELETED:
+                    keys.discard(cni)
+                else:
+                    keys.add(cni)
+        return [decode(c) for c in keys]
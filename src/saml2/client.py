@@ -128,6 +128,7 @@ class Saml2Client(Base):
             http_info = self.apply_binding(binding, _req_str, destination,
                                            relay_state, **args)
 
+            self.outstanding_queries[reqid] = relay_state
             return reqid, binding, http_info
         else:
             raise SignOnError(
@@ -301,7 +302,7 @@ class Saml2Client(Base):
             response message, response headers and message)
         """
 
-        logger.info("state: %s", self.state)
+        logger.debug("Logout response to: %s", response.in_response_to)
         status = self.state[response.in_response_to]
         logger.info("status: %s", status)
         issuer = response.issuer()
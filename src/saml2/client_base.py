@@ -13,6 +13,9 @@ from saml2.entity import Entity
 import saml2.attributemaps as attributemaps
 
 from saml2.mdstore import destinations
+from saml2.metrics import AUTHN_REQUEST_CREATE
+from saml2.metrics import AUTHN_RESPONSE_PARSE
+from saml2.metrics import timed
 from saml2.profile import paos, ecp
 from saml2.saml import NAMEID_FORMAT_TRANSIENT
 from saml2.samlp import AuthnQuery, RequestedAuthnContext
@@ -35,6 +38,10 @@ from six.moves.urllib.parse import urlparse
 from saml2.s_utils import signature
 from saml2.s_utils import UnravelError
 from saml2.s_utils import do_attributes
+from saml2.time_util import to_epoch
+from saml2.time_util import utc_now
+from saml2.id_store import REQUEST_LIFETIME
+from saml2.id_store import id_store_factory
 
 from saml2 import samlp, BINDING_SOAP, SAMLError
 from saml2 import saml
@@ -47,6 +54,7 @@ from saml2.response import AssertionIDResponse
 from saml2.response import AuthnQueryResponse
 from saml2.response import NameIDMappingResponse
 from saml2.response import AuthnResponse
+from saml2.response import ReplayedResponse
 
 from saml2 import BINDING_HTTP_REDIRECT
 from saml2 import BINDING_HTTP_POST
@@ -105,9 +113,32 @@ class Base(Entity):
         Entity.__init__(self, "sp", config, config_file, virtual_organization,
                         msg_cb=msg_cb)
 
+        if identity_cache is None:
+            # Only SQLite database specifications, the identity cache has
+            # always been in memory per default and other settings were
+            # never used by an SP.
+            _spec = self.config.getattr("subject_data", "sp")
+            if isinstance(_spec, tuple) and _spec[0] == "sqlite":
+                identity_cache = _spec
+
         self.users = Population(identity_cache)
         self.lock = threading.Lock()
-        # for server state storage
+
+        # Requests and responses are only of interest as long as the
+        # responses would pass the time checks.
+        self.timeslack = int(self.config.accepted_time_diff or 0)
+        lifetime = self.config.getattr("request_lifetime", "sp")
+        if lifetime is None:
+            lifetime = REQUEST_LIFETIME
+        lifetime += self.timeslack
+        _spec = self.config.getattr("request_storage", "sp")
+        # IDs of sent AuthnRequests -> where the user came from
+        self.outstanding_queries = id_store_factory(_spec, "outstanding",
+                                                    lifetime)
+        # IDs of consumed responses and assertions
+        self.seen_ids = id_store_factory(_spec, "seen", lifetime)
+
+        # for server state storage, kept until used
         if state_cache is None:
             self.state = {}  # in memory storage
         else:
@@ -138,7 +169,8 @@ class Base(Entity):
             logger.warning("The SAML service provider accepts unsigned SAML Responses " +
                            "and Assertions. This configuration is insecure.")
 
-        self.artifact2response = {}
+        self.artifact2response = id_store_factory(None, "artifact2response",
+                                                  lifetime)
 
     #
     # Private methods
@@ -178,6 +210,32 @@ class Base(Entity):
     def sso_location(self, entityid=None, binding=BINDING_HTTP_REDIRECT):
         return self._sso_location(entityid, binding)
 
+    def _check_replay(self, resp):
+        """ Remembers the IDs of the response and the assertions in it for as
+        long as they could pass the time checks.
+
+        :raise ReplayedResponse: If any of them has been seen before
+        """
+        now = utc_now()
+        points = []
+        for assertion in resp.assertions:
+            try:
+                points.append(assertion.conditions.not_on_or_after)
+            except AttributeError:
+                pass
+            for _sc in assertion.subject.subject_confirmation:
+                try:
+                    points.append(_sc.subject_confirmation_data.not_on_or_after)
+                except AttributeError:
+                    pass
+        expires = max([to_epoch(p) for p in points if p] +
+                      [now + self.seen_ids.lifetime]) + self.timeslack
+
+        for _id in [resp.response.id] + [a.id for a in resp.assertions]:
+            if _id and not self.seen_ids.add(_id, expires=expires):
+                logger.error("Replayed message: %s", _id)
+                raise ReplayedResponse("Message already consumed: %s" % _id)
+
     def _my_name(self):
         return self.config.name
 
@@ -220,6 +278,7 @@ class Base(Entity):
         else:
             return None
 
+    @timed(AUTHN_REQUEST_CREATE)
     def create_authn_request(self, destination, vorg="", scoping=None,
             binding=saml2.BINDING_HTTP_POST,
             nameid_format=None,
@@ -662,6 +721,7 @@ class Base(Entity):
 
     # ======== response handling ===========
 
+    @timed(AUTHN_RESPONSE_PARSE)
     def parse_authn_request_response(self, xmlstr, binding, outstanding=None,
                                      outstanding_certs=None, conv_info=None):
         """ Deal with an AuthnResponse
@@ -670,7 +730,8 @@ class Base(Entity):
         :param binding: Which binding that was used for the transport
         :param outstanding: A dictionary with session IDs as keys and
             the original web request from the user before redirection
-            as values.
+            as values. If not given the requests made by this instance are
+            used.
         :param outstanding_certs:
         :param conv_info: Information about the conversation.
         :return: An response.AuthnResponse or None
@@ -681,6 +742,9 @@ class Base(Entity):
         except KeyError:
             raise SAMLError("Missing entity_id specification")
 
+        if outstanding is None:
+            outstanding = self.outstanding_queries
+
         resp = None
         if xmlstr:
             kwargs = {
@@ -712,6 +776,9 @@ class Base(Entity):
             if resp is None:
                 return None
             elif isinstance(resp, AuthnResponse):
+                self._check_replay(resp)
+                if resp.in_response_to:
+                    self.outstanding_queries.pop(resp.in_response_to, None)
                 if resp.assertion is not None and len(
                         resp.response.encrypted_assertion) == 0:
                     self.users.add_information_about_person(resp.session_info())
@@ -54,7 +54,14 @@ COMMON_ARGS = [
     "validate_certificate",
     "extensions",
     "allow_unknown_attributes",
-    "crypto_backend"
+    "crypto_backend",
+    "artifact_storage",
+    "artifact_lifetime",
+    "crypto_pool",
+    "max_message_size",
+    "max_decoded_message_size",
+    "metadata_load_workers",
+    "metrics",
 ]
 
 SP_ARGS = [
@@ -81,6 +88,8 @@ SP_ARGS = [
     "sp_type",
     "sp_type_in_metadata",
     "requested_attributes",
+    "request_storage",
+    "request_lifetime",
 ]
 
 AA_IDP_ARGS = [
@@ -91,6 +100,7 @@ AA_IDP_ARGS = [
     "encrypt_assertion_self_contained",
     "want_authn_requests_signed",
     "want_authn_requests_only_with_valid_cert",
+    "encrypt_cert_in_key_info",
     "provided_attributes",
     "subject_data",
     "sp",
@@ -225,6 +235,13 @@ class Config(object):
         self.attribute = []
         self.attribute_profile = []
         self.requested_attribute_name_format = NAME_FORMAT_URI
+        self.artifact_storage = None
+        self.artifact_lifetime = None
+        self.crypto_pool = None
+        self.max_message_size = None
+        self.max_decoded_message_size = None
+        self.metadata_load_workers = None
+        self.metrics = None
 
     def setattr(self, context, attr, val):
         if context == "":
@@ -395,7 +412,8 @@ class Config(object):
             disable_validation = False
 
         mds = MetadataStore(acs, self, ca_certs,
-            disable_ssl_certificate_validation=disable_validation)
+            disable_ssl_certificate_validation=disable_validation,
+            load_workers=self.metadata_load_workers)
 
         mds.imp(metadata_conf)
 
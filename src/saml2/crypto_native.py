@@ -0,0 +1,796 @@
+"""
+A CryptoBackend that signs, verifies, encrypts and decrypts XML documents
+in process.
+
+The cryptographic operations are done by the cryptography package, lxml is
+used for parsing and canonicalization. No external program is run, so
+unlike CryptoBackendXmlSec1 no subprocess and no temporary files are
+involved when handling a message.
+
+Supported are enveloped signatures with RSA or ECDSA keys, (exclusive)
+canonicalization and the SHA family of digests. For encryption AES in CBC
+or GCM mode and triple DES are supported, the session key is transported
+using RSA PKCS#1 v1.5 or RSA-OAEP.
+"""
+import base64
+import hmac
+import logging
+import os
+import threading
+from binascii import hexlify
+
+import six
+from cryptography import __version__ as cryptography_version
+from cryptography.exceptions import InvalidSignature
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import padding as sym_padding
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.utils import \
+    decode_dss_signature
+from cryptography.hazmat.primitives.asymmetric.utils import \
+    encode_dss_signature
+from cryptography.hazmat.primitives.ciphers import Cipher
+from cryptography.hazmat.primitives.ciphers import algorithms
+from cryptography.hazmat.primitives.ciphers import modes
+from cryptography.utils import int_to_bytes
+from lxml import etree
+
+try:
+    from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+except ImportError:
+    TripleDES = algorithms.TripleDES
+
+from saml2 import SamlBase
+import saml2.xmldsig as ds
+import saml2.xmlenc as xenc
+from saml2.sigver import ASSERT_XPATH
+from saml2.sigver import PREFIX2
+from saml2.sigver import RSA_1_5
+from saml2.sigver import TRIPLE_DES_CBC
+from saml2.sigver import CryptoBackend
+from saml2.sigver import DecryptError
+from saml2.sigver import EncryptError
+from saml2.sigver import PemData
+from saml2.sigver import SignatureError
+from saml2.sigver import SigverError
+from saml2.sigver import key_manager
+from saml2.sigver import pre_encrypt_assertion
+from saml2.s_utils import Unsupported
+
+logger = logging.getLogger(__name__)
+
+backend = default_backend()
+
+DS = "{%s}" % ds.NAMESPACE
+XENC = "{%s}" % xenc.NAMESPACE
+XENC11_NS = "http://www.w3.org/2009/xmlenc11#"
+EXC_C14N_NS = ds.ALG_EXC_C14N
+
+ALG_EXC_C14N_WITH_C = ds.ALG_EXC_C14N + "WithComments"
+
+AES128_CBC = "http://www.w3.org/2001/04/xmlenc#aes128-cbc"
+AES192_CBC = "http://www.w3.org/2001/04/xmlenc#aes192-cbc"
+AES256_CBC = "http://www.w3.org/2001/04/xmlenc#aes256-cbc"
+AES128_GCM = XENC11_NS + "aes128-gcm"
+AES192_GCM = XENC11_NS + "aes192-gcm"
+AES256_GCM = XENC11_NS + "aes256-gcm"
+
+RSA_OAEP_MGF1P = "http://www.w3.org/2001/04/xmlenc#rsa-oaep-mgf1p"
+RSA_OAEP = XENC11_NS + "rsa-oaep"
+
+ENC_ELEMENT = "http://www.w3.org/2001/04/xmlenc#Element"
+ENC_CONTENT = "http://www.w3.org/2001/04/xmlenc#Content"
+ENCRYPTED_KEY_TYPE = "http://www.w3.org/2001/04/xmlenc#EncryptedKey"
+
+# canonicalization algorithm -> (exclusive, with comments)
+C14N_METHODS = {
+    ds.C14N: (False, False),
+    ds.C14N_WITH_C: (False, True),
+    ds.ALG_EXC_C14N: (True, False),
+    ALG_EXC_C14N_WITH_C: (True, True),
+}
+
+DIGESTS = {
+    ds.DIGEST_SHA1: hashes.SHA1,
+    ds.DIGEST_SHA224: hashes.SHA224,
+    ds.DIGEST_SHA256: hashes.SHA256,
+    ds.DIGEST_SHA384: hashes.SHA384,
+    ds.DIGEST_SHA512: hashes.SHA512,
+}
+
+# signature algorithm -> (key type, hash)
+SIGNATURE_METHODS = {
+    ds.SIG_RSA_SHA1: ("rsa", hashes.SHA1),
+    ds.SIG_RSA_SHA224: ("rsa", hashes.SHA224),
+    ds.SIG_RSA_SHA256: ("rsa", hashes.SHA256),
+    ds.SIG_RSA_SHA384: ("rsa", hashes.SHA384),
+    ds.SIG_RSA_SHA512: ("rsa", hashes.SHA512),
+    ds.SIG_ECDSA_SHA1: ("ec", hashes.SHA1),
+    ds.SIG_ECDSA_SHA224: ("ec", hashes.SHA224),
+    ds.SIG_ECDSA_SHA256: ("ec", hashes.SHA256),
+    ds.SIG_ECDSA_SHA384: ("ec", hashes.SHA384),
+    ds.SIG_ECDSA_SHA512: ("ec", hashes.SHA512),
+}
+
+# block encryption algorithm -> (cipher, key size in bytes, mode)
+BLOCK_CIPHERS = {
+    TRIPLE_DES_CBC: (TripleDES, 24, "cbc"),
+    AES128_CBC: (algorithms.AES, 16, "cbc"),
+    AES192_CBC: (algorithms.AES, 24, "cbc"),
+    AES256_CBC: (algorithms.AES, 32, "cbc"),
+    AES128_GCM: (algorithms.AES, 16, "gcm"),
+    AES192_GCM: (algorithms.AES, 24, "gcm"),
+    AES256_GCM: (algorithms.AES, 32, "gcm"),
+}
+
+MGF1_DIGESTS = {
+    XENC11_NS + "mgf1sha1": hashes.SHA1,
+    XENC11_NS + "mgf1sha224": hashes.SHA224,
+    XENC11_NS + "mgf1sha256": hashes.SHA256,
+    XENC11_NS + "mgf1sha384": hashes.SHA384,
+    XENC11_NS + "mgf1sha512": hashes.SHA512,
+}
+
+GCM_IV_SIZE = 12
+GCM_TAG_SIZE = 16
+
+_parsers = threading.local()
+
+
+def _parser():
+    # lxml parsers must not be shared between threads
+    try:
+        return _parsers.parser
+    except AttributeError:
+        _parsers.parser = etree.XMLParser(resolve_entities=False,
+                                          no_network=True, load_dtd=False,
+                                          huge_tree=False)
+        return _parsers.parser
+
+
+def parse_xml(text):
+    """ Parses a XML document, refusing documents with a DTD.
+
+    :param text: The document as a string or a SamlBase instance
+    :return: The root element
+    """
+    if isinstance(text, SamlBase):
+        text = str(text)
+    if not isinstance(text, six.binary_type):
+        text = text.encode('utf-8')
+    root = etree.fromstring(text, parser=_parser())
+    if root.getroottree().docinfo.internalDTD is not None:
+        raise SigverError("Documents with a DTD are not accepted")
+    return root
+
+
+def to_string(root):
+    return "%s\n%s" % (PREFIX2, etree.tostring(root, encoding="unicode"))
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _b64decode(elem):
+    if elem is None or not elem.text:
+        raise ValueError("Missing base64 data")
+    return base64.b64decode("".join(elem.text.split()))
+
+
+def _digest(algorithm, data):
+    try:
+        digest = hashes.Hash(DIGESTS[algorithm](), backend)
+    except KeyError:
+        raise Unsupported("Digest algorithm: %s" % algorithm)
+    digest.update(data)
+    return digest.finalize()
+
+
+def _c14n(elem, algorithm, prefixes=None):
+    try:
+        exclusive, comments = C14N_METHODS[algorithm]
+    except KeyError:
+        raise Unsupported("Canonicalization algorithm: %s" % algorithm)
+    if exclusive and prefixes:
+        return etree.tostring(elem, method="c14n", exclusive=True,
+                              with_comments=comments,
+                              inclusive_ns_prefixes=prefixes)
+    return etree.tostring(elem, method="c14n", exclusive=exclusive,
+                          with_comments=comments)
+
+
+def _inclusive_prefixes(transform):
+    inc = transform.find("{%s}InclusiveNamespaces" % EXC_C14N_NS)
+    if inc is None:
+        return None
+    return [p for p in inc.get("PrefixList", "").split() if p != "#default"]
+
+
+def find_by_id(root, value, id_attr=""):
+    """ Finds the elements that have a specific identifier.
+
+    :param root: Root of the document
+    :param value: The identifier
+    :param id_attr: Name of the ID attribute, "ID", "Id" and "id" are always
+        tried
+    :return: A list of elements, more than one if the identifier is not
+        unique
+    """
+    names = {"ID", "Id", "id"}
+    if id_attr:
+        names.add(id_attr)
+    cond = " or ".join("@%s=$value" % n for n in sorted(names))
+    return root.xpath("descendant-or-self::*[%s]" % cond, value=value)
+
+
+def _by_id(root, value, id_attr, exception):
+    found = find_by_id(root, value, id_attr)
+    if len(found) != 1:
+        raise exception("%d elements with ID %s" % (len(found), value))
+    return found[0]
+
+
+def _replace(elem, new):
+    """ Replaces an element with another, keeping the text that follows """
+    new.tail = elem.tail
+    elem.getparent().replace(elem, new)
+
+
+class _Detached(object):
+    """ Takes an element out of its tree for the time of a with block,
+    the text following it stays in the tree.
+    """
+
+    def __init__(self, elem):
+        self.elem = elem
+
+    def __enter__(self):
+        self.parent = self.elem.getparent()
+        self.index = self.parent.index(self.elem)
+        self.tail = self.elem.tail
+        self.prev = self.elem.getprevious()
+        if self.prev is not None:
+            self.saved = self.prev.tail
+        else:
+            self.saved = self.parent.text
+        self.parent.remove(self.elem)
+        if self.tail:
+            if self.prev is not None:
+                self.prev.tail = (self.saved or "") + self.tail
+            else:
+                self.parent.text = (self.saved or "") + self.tail
+        return self.elem
+
+    def __exit__(self, *args):
+        if self.prev is not None:
+            self.prev.tail = self.saved
+        else:
+            self.parent.text = self.saved
+        self.elem.tail = self.tail
+        self.parent.insert(self.index, self.elem)
+
+
+def _signature_method(algorithm, key):
+    try:
+        typ, hash_cls = SIGNATURE_METHODS[algorithm]
+    except KeyError:
+        raise Unsupported("Signature algorithm: %s" % algorithm)
+    if typ == "rsa" and isinstance(key, (rsa.RSAPrivateKey,
+                                         rsa.RSAPublicKey)):
+        return typ, hash_cls
+    elif typ == "ec" and isinstance(key, (ec.EllipticCurvePrivateKey,
+                                          ec.EllipticCurvePublicKey)):
+        return typ, hash_cls
+    raise SigverError("Key does not match signature algorithm %s" % algorithm)
+
+
+def sign_data(key, algorithm, data):
+    typ, hash_cls = _signature_method(algorithm, key)
+    if typ == "rsa":
+        return key.sign(data, padding.PKCS1v15(), hash_cls())
+    # XML signatures use the raw (r, s) pair, not the DER encoding
+    r, s = decode_dss_signature(key.sign(data, ec.ECDSA(hash_cls())))
+    size = (key.curve.key_size + 7) // 8
+    return int_to_bytes(r, size) + int_to_bytes(s, size)
+
+
+def verify_data(key, algorithm, data, signature):
+    typ, hash_cls = _signature_method(algorithm, key)
+    try:
+        if typ == "rsa":
+            key.verify(signature, data, padding.PKCS1v15(), hash_cls())
+        else:
+            # The raw (r, s) pair, both of the size of the curve
+            size = (key.curve.key_size + 7) // 8
+            if len(signature) != 2 * size:
+                return False
+            sig = encode_dss_signature(int(hexlify(signature[:size]), 16),
+                                       int(hexlify(signature[size:]), 16))
+            key.verify(sig, data, ec.ECDSA(hash_cls()))
+    except InvalidSignature:
+        return False
+    return True
+
+
+def _key_transport_padding(method):
+    algorithm = method.get("Algorithm")
+    if algorithm == RSA_1_5:
+        return padding.PKCS1v15()
+    elif algorithm not in (RSA_OAEP_MGF1P, RSA_OAEP):
+        raise Unsupported("Key transport algorithm: %s" % algorithm)
+
+    digest = hashes.SHA1
+    _digest_method = method.find(DS + "DigestMethod")
+    if _digest_method is not None:
+        try:
+            digest = DIGESTS[_digest_method.get("Algorithm")]
+        except KeyError:
+            raise Unsupported(
+                "Digest algorithm: %s" % _digest_method.get("Algorithm"))
+    mgf_digest = hashes.SHA1
+    if algorithm == RSA_OAEP:
+        _mgf = method.find("{%s}MGF" % XENC11_NS)
+        if _mgf is not None:
+            try:
+                mgf_digest = MGF1_DIGESTS[_mgf.get("Algorithm")]
+            except KeyError:
+                raise Unsupported("MGF algorithm: %s" % _mgf.get("Algorithm"))
+    label = None
+    _params = method.find(XENC + "OAEPparams")
+    if _params is not None and _params.text:
+        label = _b64decode(_params)
+    return padding.OAEP(mgf=padding.MGF1(algorithm=mgf_digest()),
+                        algorithm=digest(), label=label)
+
+
+def _block_cipher(algorithm):
+    try:
+        return BLOCK_CIPHERS[algorithm]
+    except KeyError:
+        raise Unsupported("Block encryption algorithm: %s" % algorithm)
+
+
+def encrypt_data(algorithm, key, data):
+    cipher_cls, _, mode = _block_cipher(algorithm)
+    if mode == "gcm":
+        iv = os.urandom(GCM_IV_SIZE)
+        encryptor = Cipher(cipher_cls(key), modes.GCM(iv),
+                           backend).encryptor()
+        return iv + encryptor.update(data) + encryptor.finalize() + \
+            encryptor.tag
+
+    block_size = cipher_cls.block_size
+    iv = os.urandom(block_size // 8)
+    padder = sym_padding.PKCS7(block_size).padder()
+    data = padder.update(data) + padder.finalize()
+    encryptor = Cipher(cipher_cls(key), modes.CBC(iv), backend).encryptor()
+    return iv + encryptor.update(data) + encryptor.finalize()
+
+
+def decrypt_data(algorithm, key, data):
+    cipher_cls, _, mode = _block_cipher(algorithm)
+    if mode == "gcm":
+        iv = data[:GCM_IV_SIZE]
+        tag = data[-GCM_TAG_SIZE:]
+        decryptor = Cipher(cipher_cls(key), modes.GCM(iv, tag),
+                           backend).decryptor()
+        return decryptor.update(data[GCM_IV_SIZE:-GCM_TAG_SIZE]) + \
+            decryptor.finalize()
+
+    size = cipher_cls.block_size // 8
+    if len(data) < 2 * size or len(data) % size:
+        raise ValueError("Bad cipher text length")
+    decryptor = Cipher(cipher_cls(key), modes.CBC(data[:size]),
+                       backend).decryptor()
+    plain = decryptor.update(data[size:]) + decryptor.finalize()
+    # XML Encryption only defines the last byte of the padding
+    pad = six.indexbytes(plain, -1)
+    if not 0 < pad <= size:
+        raise ValueError("Bad padding")
+    return plain[:-pad]
+
+
+class CryptoBackendNative(CryptoBackend):
+    """
+    CryptoBackend implementation that does everything in process using the
+    cryptography package and lxml.
+    """
+
+    def __init__(self, debug=False):
+        CryptoBackend.__init__(self, debug=debug)
+
+    def version(self):
+        return "native (cryptography %s, lxml %s)" % (
+            cryptography_version,
+            ".".join(str(v) for v in etree.LXML_VERSION))
+
+    def key_file(self, key):
+        # Keys are parsed from memory, no file is needed
+        if not isinstance(key, six.binary_type):
+            key = str(key).encode('utf-8')
+        return None, PemData(key)
+
+    # --- signatures ---
+
+    @staticmethod
+    def _start_node(root, node_id, id_attr, exception):
+        if node_id:
+            return _by_id(root, node_id, id_attr, exception)
+        return root
+
+    @staticmethod
+    def _signature_node(start):
+        sig = start.find(DS + "Signature")
+        if sig is None and start.getparent() is None:
+            # Like xmlsec, without a node ID use the first signature
+            sig = next(start.iter(DS + "Signature"), None)
+        return sig
+
+    def _reference_data(self, root, sig, reference, id_attr, exception):
+        uri = reference.get("URI")
+        if not uri:
+            node = root
+        elif uri.startswith("#"):
+            node = _by_id(root, uri[1:], id_attr, exception)
+        else:
+            raise exception("Only same document references allowed: %s" % uri)
+
+        enveloped = False
+        c14n_alg = ds.C14N
+        prefixes = None
+        for transform in reference.iterfind(
+                "%sTransforms/%sTransform" % (DS, DS)):
+            algorithm = transform.get("Algorithm")
+            if algorithm == ds.TRANSFORM_ENVELOPED:
+                enveloped = True
+            elif algorithm in C14N_METHODS:
+                c14n_alg = algorithm
+                prefixes = _inclusive_prefixes(transform)
+            else:
+                raise exception("Unsupported transform: %s" % algorithm)
+
+        if enveloped and any(a is node for a in sig.iterancestors()):
+            with _Detached(sig):
+                return node, _c14n(node, c14n_alg, prefixes)
+        return node, _c14n(node, c14n_alg, prefixes)
+
+    @staticmethod
+    def _digest_algorithm(reference, exception):
+        method = reference.find(DS + "DigestMethod")
+        if method is None or not method.get("Algorithm"):
+            raise exception("Reference without DigestMethod")
+        return method.get("Algorithm")
+
+    @staticmethod
+    def _signed_info(sig, exception):
+        signed_info = sig.find(DS + "SignedInfo")
+        if signed_info is None:
+            raise exception("Signature without SignedInfo")
+        c14n = signed_info.find(DS + "CanonicalizationMethod")
+        method = signed_info.find(DS + "SignatureMethod")
+        if c14n is None or method is None:
+            raise exception("Incomplete SignedInfo")
+        return signed_info, c14n, method
+
+    def sign_statement(self, statement, node_name, key_file, node_id,
+                       id_attr):
+        """
+        Sign an XML statement. The statement must contain a signature
+        template, see pre_signature_part().
+
+        :param statement: The statement to be signed
+        :param node_name: string like 'urn:oasis:names:...:Assertion'
+        :param key_file: The file where the key can be found
+        :param node_id: The identifier of the signed element
+        :param id_attr: The attribute name for the identifier, normally one of
+            'id','Id' or 'ID'
+        :return: The signed statement
+        """
+        root = parse_xml(statement)
+        sig = self._signature_node(
+            self._start_node(root, node_id, id_attr, SigverError))
+        if sig is None:
+            raise SigverError("No signature template in %s" % node_name)
+
+        key = key_manager.private_key(key_file)
+        signed_info, c14n, method = self._signed_info(sig, SigverError)
+        for reference in signed_info.iterfind(DS + "Reference"):
+            _, data = self._reference_data(root, sig, reference, id_attr,
+                                           SigverError)
+            digest_value = reference.find(DS + "DigestValue")
+            if digest_value is None:
+                digest_value = etree.SubElement(reference, DS + "DigestValue")
+            digest_value.text = _b64(_digest(
+                self._digest_algorithm(reference, SigverError), data))
+
+        signature_value = sig.find(DS + "SignatureValue")
+        if signature_value is None:
+            raise SigverError("Signature template without SignatureValue")
+        signature_value.text = _b64(sign_data(
+            key, method.get("Algorithm"),
+            _c14n(signed_info, c14n.get("Algorithm"),
+                  _inclusive_prefixes(c14n))))
+        return to_string(root)
+
+    def validate_signature(self, signedtext, cert_file, cert_type, node_name,
+                           node_id, id_attr):
+        """
+        Validate signature on XML document.
+
+        :param signedtext: The XML document as a string
+        :param cert_file: The public key that was used to sign the document
+        :param cert_type: The file type of the certificate
+        :param node_name: The name of the class that is signed
+        :param node_id: The identifier of the node
+        :param id_attr: Should normally be one of "id", "Id" or "ID"
+        :return: True if the signature was correct, otherwise
+            SignatureError is raised
+        """
+        try:
+            return self._validate_signature(signedtext, cert_file, cert_type,
+                                            node_name, node_id, id_attr)
+        except SignatureError:
+            raise
+        except (Unsupported, SigverError) as err:
+            # Unknown algorithms and keys that don't match the signature
+            # method are properties of the signed document
+            raise SignatureError("%s" % err)
+
+    def _validate_signature(self, signedtext, cert_file, cert_type,
+                            node_name, node_id, id_attr):
+        root = parse_xml(signedtext)
+        start = self._start_node(root, node_id, id_attr, SignatureError)
+        sig = self._signature_node(start)
+        if sig is None:
+            raise SignatureError("No signature on %s" % node_name)
+
+        signed_info, c14n, method = self._signed_info(sig, SignatureError)
+        references = signed_info.findall(DS + "Reference")
+        if not references:
+            raise SignatureError("Signature without references")
+
+        covered = False
+        for reference in references:
+            node, data = self._reference_data(root, sig, reference, id_attr,
+                                              SignatureError)
+            covered = covered or node is start
+            digest = _digest(
+                self._digest_algorithm(reference, SignatureError), data)
+            try:
+                expected = _b64decode(reference.find(DS + "DigestValue"))
+            except (ValueError, TypeError):
+                raise SignatureError("Bad digest value")
+            if not hmac.compare_digest(digest, expected):
+                raise SignatureError("Digest mismatch for %s" % node_name)
+
+        if node_id and not covered:
+            raise SignatureError("Signature does not cover %s" % node_id)
+
+        try:
+            signature = _b64decode(sig.find(DS + "SignatureValue"))
+        except (ValueError, TypeError):
+            raise SignatureError("Bad signature value")
+        key = key_manager.public_key(cert_file, cert_type)
+        if not verify_data(key, method.get("Algorithm"),
+                           _c14n(signed_info, c14n.get("Algorithm"),
+                                 _inclusive_prefixes(c14n)),
+                           signature):
+            raise SignatureError("Signature verification failed")
+        return True
+
+    # --- encryption ---
+
+    @staticmethod
+    def _template(template):
+        if isinstance(template, SamlBase):
+            return parse_xml(str(template))
+        if isinstance(template, six.string_types) and os.path.isfile(
+                template):
+            with open(template, "rb") as fp:
+                return parse_xml(fp.read())
+        return parse_xml(template)
+
+    def _fill_template(self, tmpl, data, recv_key):
+        """ Encrypts data with a new session key which is encrypted with
+        the receivers public key. The result is written into the template.
+        """
+        method = tmpl.find(XENC + "EncryptionMethod")
+        if method is None:
+            raise EncryptError("Template without EncryptionMethod")
+        algorithm = method.get("Algorithm")
+        session_key = os.urandom(_block_cipher(algorithm)[1])
+
+        encrypted_key = tmpl.find("%sKeyInfo/%sEncryptedKey" % (DS, XENC))
+        if encrypted_key is None:
+            raise EncryptError("Template without EncryptedKey")
+        pub_key = key_manager.public_key(recv_key)
+        _set_cipher_value(encrypted_key, pub_key.encrypt(
+            session_key, _key_transport_padding(
+                encrypted_key.find(XENC + "EncryptionMethod"))))
+        _set_cipher_value(tmpl, encrypt_data(algorithm, session_key, data))
+        return tmpl
+
+    def encrypt(self, text, recv_key, template, session_key_type, xpath=""):
+        """
+        :param text: The text to be encrypted
+        :param recv_key: Filename of a file where the key resides
+        :param template: Filename of a file with the pre-encryption part or
+            the pre-encryption part itself
+        :param session_key_type: Not used, the type of the session key
+            is given by the template
+        :param xpath: What should be encrypted, default is the whole document
+        :return: The encrypted document
+        """
+        root = parse_xml(text)
+        if not xpath:
+            return to_string(self._fill_template(
+                self._template(template),
+                etree.tostring(root, encoding="utf-8"), recv_key))
+
+        nodes = root.xpath(xpath)
+        if not nodes:
+            raise EncryptError("Nothing to encrypt at %s" % xpath)
+        self._encrypt_node(nodes[0], template, recv_key)
+        return to_string(root)
+
+    def _encrypt_node(self, node, template, recv_key):
+        tmpl = self._template(template)
+        data = etree.tostring(node, encoding="utf-8", with_tail=False)
+        if data.startswith(b"<?xml"):
+            data = data[data.index(b"?>") + 2:].lstrip()
+        _replace(node, self._fill_template(tmpl, data, recv_key))
+
+    def encrypt_assertion(self, statement, enc_key, template,
+                          key_type="des-192", node_xpath=None, node_id=None):
+        """
+        Will encrypt an assertion
+
+        :param statement: A XML document that contains the assertion to encrypt
+        :param enc_key: File name of a file containing the encryption key
+        :param template: A template for the encryption part to be added.
+        :param key_type: Not used, the type of session key is given by the
+            template.
+        :return: The encrypted text
+        """
+        if isinstance(statement, SamlBase):
+            statement = pre_encrypt_assertion(statement)
+
+        root = parse_xml(statement)
+        nodes = root.xpath(node_xpath or ASSERT_XPATH)
+        if node_id:
+            nodes = [n for n in nodes if node_id in (n.get("ID"), n.get("Id"))]
+        if not nodes:
+            raise EncryptError("No assertion to encrypt")
+        self._encrypt_node(nodes[0], template, enc_key)
+        return to_string(root)
+
+    def _encrypted_keys(self, root, enc_data):
+        key_info = enc_data.find(DS + "KeyInfo")
+        if key_info is not None:
+            for ek in key_info.iterfind(XENC + "EncryptedKey"):
+                yield ek
+            for rm in key_info.iterfind(DS + "RetrievalMethod"):
+                uri = rm.get("URI", "")
+                if uri.startswith("#") and rm.get(
+                        "Type", ENCRYPTED_KEY_TYPE) == ENCRYPTED_KEY_TYPE:
+                    for ek in find_by_id(root, uri[1:], "Id"):
+                        yield ek
+        # SAML places the key next to the encrypted data
+        parent = enc_data.getparent()
+        if parent is not None:
+            for ek in parent.iterfind(XENC + "EncryptedKey"):
+                yield ek
+
+    def _session_key(self, root, enc_data, priv_key, key_size):
+        for encrypted_key in self._encrypted_keys(root, enc_data):
+            try:
+                key = priv_key.decrypt(
+                    _b64decode(encrypted_key.find(
+                        "%sCipherData/%sCipherValue" % (XENC, XENC))),
+                    _key_transport_padding(
+                        encrypted_key.find(XENC + "EncryptionMethod")))
+            except (ValueError, TypeError, AttributeError):
+                continue
+            if len(key) == key_size:
+                return key
+        raise DecryptError("No encrypted key that could be decrypted")
+
+    @staticmethod
+    def _in_context(plain, nsmap):
+        """ Parses decrypted XML inside a wrapper element that declares the
+        namespaces in scope where the encrypted data was.
+        """
+        # lxml serializes the declarations, the empty element is opened up
+        # to take the plain text as content
+        try:
+            start = etree.tostring(etree.Element("wrapper", nsmap=nsmap))
+        except ValueError as err:
+            raise DecryptError("Bad namespace in scope: %s" % err)
+        return parse_xml(start[:-2] + b">" + plain + b"</wrapper>")
+
+    def _decrypt_node(self, root, enc_data, priv_key):
+        method = enc_data.find(XENC + "EncryptionMethod")
+        if method is None:
+            raise DecryptError("EncryptedData without EncryptionMethod")
+        algorithm = method.get("Algorithm")
+        session_key = self._session_key(root, enc_data, priv_key,
+                                        _block_cipher(algorithm)[1])
+        try:
+            plain = decrypt_data(
+                algorithm, session_key, _b64decode(enc_data.find(
+                    "%sCipherData/%sCipherValue" % (XENC, XENC))))
+        except (ValueError, TypeError, InvalidTag) as err:
+            raise DecryptError("Decryption failed: %s" % err)
+
+        # The plain text is parsed in the context of the encrypted data so
+        # that namespace prefixes declared above it can be used.
+        parent = enc_data.getparent()
+        nsmap = parent.nsmap if parent is not None else {}
+        wrapper = self._in_context(plain, nsmap)
+
+        if enc_data.get("Type") == ENC_CONTENT:
+            if parent is None:
+                raise DecryptError("Encrypted content without parent")
+            index = parent.index(enc_data)
+            prev = enc_data.getprevious()
+            text = (wrapper.text or "")
+            if prev is not None:
+                prev.tail = (prev.tail or "") + text
+            else:
+                parent.text = (parent.text or "") + text
+            children = list(wrapper)
+            if children:
+                children[-1].tail = (children[-1].tail or "") + (
+                    enc_data.tail or "")
+            parent.remove(enc_data)
+            for offset, child in enumerate(children):
+                parent.insert(index + offset, child)
+            return root
+
+        if len(wrapper) != 1:
+            raise DecryptError("Decrypted data is not one element")
+        new = wrapper[0]
+        if parent is None:
+            return new
+        _replace(enc_data, new)
+        return root
+
+    def decrypt(self, enctext, key_file):
+        """
+        Decrypts all the encrypted parts of a document that can be
+        decrypted with a key.
+
+        :param enctext: XML document containing an encrypted part
+        :param key_file: The key to use for the decryption
+        :return: The decrypted document or None if nothing could be
+            decrypted with the key
+        """
+        root = parse_xml(enctext)
+        priv_key = key_manager.private_key(key_file)
+        decrypted = 0
+        for enc_data in list(root.iter(XENC + "EncryptedData")):
+            try:
+                root = self._decrypt_node(root, enc_data, priv_key)
+            except (DecryptError, Unsupported) as err:
+                logger.debug("Could not decrypt: %s", err)
+                continue
+            decrypted += 1
+
+        if not decrypted:
+            return None
+        return to_string(root)
+
+
+def _set_cipher_value(elem, value):
+    cipher_data = elem.find(XENC + "CipherData")
+    if cipher_data is None:
+        cipher_data = etree.SubElement(elem, XENC + "CipherData")
+    cipher_value = cipher_data.find(XENC + "CipherValue")
+    if cipher_value is None:
+        cipher_value = etree.SubElement(cipher_data, XENC + "CipherValue")
+    cipher_value.text = _b64(value)
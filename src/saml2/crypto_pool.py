@@ -0,0 +1,210 @@
+"""
+Runs signing and encryption in a pool of worker processes.
+
+Each worker process creates its own security context, with the keys loaded,
+when it starts. A :py:class:`CryptoPool` stands in for the security context
+of an entity. Signing and encryption are handed to the workers, everything
+else is done by the entity's own security context.
+
+The number of operations waiting for a worker is bounded. When the bound is
+reached a caller waits at most *queue_timeout* seconds for a place in the
+queue before :py:class:`CryptoPoolBusy` is raised, so an overloaded IdP
+answers with an error instead of piling up requests.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+
+import six
+
+from saml2 import SAMLError
+from saml2 import SamlBase
+from saml2 import class_name
+from saml2 import saml
+from saml2 import samlp
+from saml2.metrics import ENCRYPT
+from saml2.metrics import SIGN
+from saml2.metrics import measure
+from saml2.s_utils import sid
+from saml2.sigver import pre_encrypt_assertion
+from saml2.sigver import pre_signature_part
+from saml2.sigver import security_context
+
+logger = logging.getLogger(__name__)
+
+# Max number of operations queued per worker process
+QUEUE_PER_PROCESS = 8
+# How long, in seconds, to wait for a place in the queue
+QUEUE_TIMEOUT = 5.0
+# How long, in seconds, to wait for an operation to finish
+OPERATION_TIMEOUT = 30.0
+
+# The security context of a worker process
+_worker_sec = None
+
+
+class CryptoPoolBusy(SAMLError):
+    pass
+
+
+class WorkerConfig(object):
+    """ The parts of a configuration a worker needs to create its security
+    context. Unlike a Config instance it can be pickled.
+    """
+
+    ATTRIBUTES = ["xmlsec_binary", "xmlsec_path", "crypto_backend",
+                  "key_file", "cert_file", "encryption_keypairs", "debug",
+                  "only_use_keys_in_metadata", "tmp_cert_file",
+                  "tmp_key_file", "validate_certificate"]
+
+    def __init__(self, conf):
+        for attr in self.ATTRIBUTES:
+            setattr(self, attr, getattr(conf, attr, None))
+        # Workers only sign and encrypt
+        self.metadata = None
+        self.cert_handler_extra_class = None
+        self.generate_cert_info = None
+
+    def getattr(self, attr, context=None):
+        return getattr(self, attr, None)
+
+
+def _init_worker(conf):
+    global _worker_sec
+    _worker_sec = security_context(conf)
+
+
+def _run(method, args, kwargs):
+    return getattr(_worker_sec, method)(*args, **kwargs)
+
+
+class CryptoPool(object):
+    """ A security context that hands signing and encryption to a pool of
+    worker processes.
+
+    :param sec: The entity's own security context
+    :param conf: The configuration the workers create their security
+        contexts from
+    :param processes: Number of worker processes, default is the number of
+        cores
+    :param max_pending: Max number of operations queued or running
+    :param queue_timeout: Seconds to wait for a place in the queue
+    """
+
+    def __init__(self, sec, conf, processes=None, max_pending=None,
+                 queue_timeout=QUEUE_TIMEOUT, timeout=OPERATION_TIMEOUT):
+        self._sec = sec
+        if not processes:
+            processes = multiprocessing.cpu_count()
+        if not max_pending:
+            max_pending = processes * QUEUE_PER_PROCESS
+        self.processes = processes
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0,
+                       "rejected": 0, "pending": 0, "time": 0.0}
+        self._pool = multiprocessing.Pool(processes, _init_worker,
+                                          (WorkerConfig(conf),))
+
+    def __getattr__(self, item):
+        if item == "_sec":
+            raise AttributeError(item)
+        # Everything but signing and encryption is done locally
+        return getattr(self._sec, item)
+
+    def _count(self, **kwargs):
+        with self._lock:
+            for key, val in kwargs.items():
+                self._stats[key] += val
+
+    def _submit(self, method, *args, **kwargs):
+        if not self._slots.acquire(*self._acquire_args()):
+            self._count(rejected=1)
+            raise CryptoPoolBusy("Too many pending crypto operations")
+
+        self._count(submitted=1, pending=1)
+        start = time.time()
+        try:
+            res = self._pool.apply_async(_run, (method, args, kwargs)).get(
+                self.timeout)
+        except Exception:
+            self._count(failed=1)
+            raise
+        else:
+            self._count(completed=1)
+            return res
+        finally:
+            self._count(pending=-1, time=time.time() - start)
+            self._slots.release()
+
+    def _acquire_args(self):
+        if six.PY2:
+            # No timeout in Python 2, only wait if asked to
+            return (bool(self.queue_timeout),)
+        return (True, self.queue_timeout)
+
+    def sign_statement(self, statement, node_name, key=None, key_file=None,
+                       node_id=None, id_attr=""):
+        if key and not key_file:
+            # Only the local security context can handle a key as a string
+            return self._sec.sign_statement(statement, node_name, key=key,
+                                            node_id=node_id, id_attr=id_attr)
+        with measure(self._sec.metrics, SIGN):
+            return self._submit("sign_statement", "%s" % statement,
+                                node_name, key_file=key_file,
+                                node_id=node_id, id_attr=id_attr)
+
+    def sign_assertion(self, statement, **kwargs):
+        return self.sign_statement(statement, class_name(saml.Assertion()),
+                                   **kwargs)
+
+    def sign_attribute_query(self, statement, **kwargs):
+        return self.sign_statement(statement, class_name(
+            samlp.AttributeQuery()), **kwargs)
+
+    def multiple_signatures(self, statement, to_sign, key=None, key_file=None,
+                            sign_alg=None, digest_alg=None):
+        for (item, _sid, id_attr) in to_sign:
+            if not _sid:
+                if not item.id:
+                    _sid = item.id = sid()
+                else:
+                    _sid = item.id
+
+            if not item.signature:
+                item.signature = pre_signature_part(_sid, self._sec.cert_file,
+                                                    sign_alg=sign_alg,
+                                                    digest_alg=digest_alg)
+
+            statement = self.sign_statement(statement, class_name(item),
+                                            key=key, key_file=key_file,
+                                            node_id=_sid, id_attr=id_attr)
+        return statement
+
+    def encrypt_assertion(self, statement, enc_key, template,
+                          key_type="des-192", node_xpath=None):
+        if isinstance(statement, SamlBase):
+            statement = pre_encrypt_assertion(statement)
+        with measure(self._sec.metrics, ENCRYPT):
+            return self._submit("encrypt_assertion", "%s" % statement,
+                                enc_key, "%s" % template, key_type,
+                                node_xpath)
+
+    def stats(self):
+        """ Counters for the operations handed to the pool.
+
+        :return: A dictionary with the number of submitted, completed,
+            failed and rejected operations, the number pending right now
+            and the total time spent waiting for results.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self._sec.close()
@@ -7,6 +7,7 @@ import six
 from binascii import hexlify
 from hashlib import sha1
 
+from saml2.artifact_store import artifact_store_factory
 from saml2.metadata import ENDPOINTS
 from saml2.profile import paos, ecp, samlec
 from saml2.soap import parse_soap_enveloped_saml_artifact_resolve
@@ -38,7 +39,11 @@ from saml2.s_utils import UnravelError
 from saml2.s_utils import error_status_factory
 from saml2.s_utils import rndbytes
 from saml2.s_utils import success_status_factory
-from saml2.s_utils import decode_base64_and_inflate
+from saml2.s_utils import MAX_DECODED_SIZE
+from saml2.s_utils import MAX_ENCODED_SIZE
+from saml2.s_utils import MessageDecoder
+from saml2.s_utils import MessageTooLarge
+from saml2.s_utils import message_decoder
 from saml2.s_utils import UnsupportedBinding
 from saml2.samlp import AuthnRequest, SessionIndex, response_from_string
 from saml2.samlp import AuthzDecisionQuery
@@ -53,6 +58,12 @@ from saml2.samlp import Artifact
 from saml2.samlp import LogoutRequest
 from saml2.samlp import AttributeQuery
 from saml2.mdstore import destinations
+from saml2.metrics import BINDING_ENCODE
+from saml2.metrics import PARSE
+from saml2.metrics import UNRAVEL
+from saml2.metrics import VERIFY
+from saml2.metrics import measure
+from saml2.metrics import timed
 from saml2 import BINDING_HTTP_POST
 from saml2 import BINDING_HTTP_REDIRECT
 from saml2 import BINDING_SOAP
@@ -63,9 +74,15 @@ from saml2.httpbase import HTTPBase
 from saml2.sigver import security_context
 from saml2.sigver import response_factory
 from saml2.sigver import SigverError
+from saml2.sigver import CertificateError
 from saml2.sigver import CryptoBackendXmlSec1
+from saml2.sigver import encryption_template
+from saml2.sigver import key_manager
 from saml2.sigver import make_temp
-from saml2.sigver import pre_encryption_part
+from saml2.sigver import pem_format
+from saml2.sigver import peek_issuer
+from saml2.sigver import redirect_signature_parts
+from saml2.sigver import SignatureError
 from saml2.sigver import pre_signature_part
 from saml2.sigver import pre_encrypt_assertion
 from saml2.sigver import signed_instance_factory
@@ -123,6 +140,9 @@ def create_artifact(entity_id, message_handle, endpoint_index=0):
 
 
 class Entity(HTTPBase):
+    # A saml2.metrics.MetricsSink
+    metrics = None
+
     def __init__(self, entity_type, config=None, config_file="",
                  virtual_organization="", msg_cb=None):
         self.entity_type = entity_type
@@ -160,8 +180,14 @@ class Entity(HTTPBase):
         self.metadata = self.config.metadata
         self.config.setup_logger()
         self.debug = self.config.debug
+        self.metrics = self.config.metrics
 
         self.sec = security_context(self.config)
+        self.decoder = MessageDecoder(
+            self.config.max_message_size or MAX_ENCODED_SIZE,
+            self.config.max_decoded_message_size or MAX_DECODED_SIZE)
+        if self.config.crypto_pool:
+            self.sec = self._crypto_pool(self.config.crypto_pool)
 
         if virtual_organization:
             if isinstance(virtual_organization, six.string_types):
@@ -171,7 +197,8 @@ class Entity(HTTPBase):
         else:
             self.vorg = None
 
-        self.artifact = {}
+        self.artifact = artifact_store_factory(
+            self.config.artifact_storage, self.config.artifact_lifetime)
         if self.metadata:
             self.sourceid = self.metadata.construct_source_id()
         else:
@@ -179,6 +206,23 @@ class Entity(HTTPBase):
 
         self.msg_cb = msg_cb
 
+    def _crypto_pool(self, spec):
+        """ Puts a pool of worker processes that does the signing and
+        encryption in front of the security context.
+
+        :param spec: Number of processes or a tuple (processes, max number
+            of pending operations)
+        """
+        from saml2.crypto_pool import CryptoPool
+
+        if isinstance(spec, (list, tuple)):
+            processes, max_pending = spec
+        elif spec is True:
+            processes, max_pending = None, None
+        else:
+            processes, max_pending = spec, None
+        return CryptoPool(self.sec, self.config, processes, max_pending)
+
     def _issuer(self, entityid=None):
         """ Return an Issuer instance """
         if entityid:
@@ -190,6 +234,7 @@ class Entity(HTTPBase):
             return Issuer(text=self.config.entityid,
                           format=NAMEID_FORMAT_ENTITY)
 
+    @timed(BINDING_ENCODE)
     def apply_binding(self, binding, msg_str, destination="", relay_state="",
                       response=False, sign=False, **kwargs):
         """
@@ -365,16 +410,19 @@ class Entity(HTTPBase):
         return info
 
     @staticmethod
-    def unravel(txt, binding, msgtype="response"):
+    def unravel(txt, binding, msgtype="response", decoder=None):
         """
         Will unpack the received text. Depending on the context the original
          response may have been transformed before transmission.
         :param txt:
         :param binding:
         :param msgtype:
+        :param decoder: The MessageDecoder that sets the size limits
         :return:
         """
         # logger.debug("unravel '%s'", txt)
+        if decoder is None:
+            decoder = message_decoder
         if binding not in [BINDING_HTTP_REDIRECT, BINDING_HTTP_POST,
                            BINDING_SOAP, BINDING_URI, BINDING_HTTP_ARTIFACT,
                            None]:
@@ -382,17 +430,19 @@ class Entity(HTTPBase):
         else:
             try:
                 if binding == BINDING_HTTP_REDIRECT:
-                    xmlstr = decode_base64_and_inflate(txt)
+                    xmlstr = decoder.decode_base64_and_inflate(txt)
                 elif binding == BINDING_HTTP_POST:
-                    xmlstr = base64.b64decode(txt)
+                    xmlstr = decoder.b64decode(txt)
                 elif binding == BINDING_SOAP:
                     func = getattr(soap,
                                    "parse_soap_enveloped_saml_%s" % msgtype)
-                    xmlstr = func(txt)
+                    xmlstr = func(decoder.check_size(txt))
                 elif binding == BINDING_HTTP_ARTIFACT:
-                    xmlstr = base64.b64decode(txt)
+                    xmlstr = decoder.b64decode(txt)
                 else:
                     xmlstr = txt
+            except MessageTooLarge:
+                raise
             except Exception:
                 raise UnravelError("Unravelling binding '%s' failed" % binding)
 
@@ -439,7 +489,7 @@ class Entity(HTTPBase):
         except (AttributeError, TypeError):
             to_sign = [(class_name(msg), mid)]
 
-        logger.info("REQUEST: %s", msg)
+        logger.debug("REQUEST: %s", msg)
         return signed_instance_factory(msg, self.sec, to_sign)
 
     def _message(self, request_cls, destination=None, message_id=0,
@@ -563,14 +613,21 @@ class Entity(HTTPBase):
             try:
                 begin_cert = "-----BEGIN CERTIFICATE-----\n"
                 end_cert = "\n-----END CERTIFICATE-----\n"
+                _b64_cert = "".join(
+                    _l.strip() for _l in _cert.splitlines()
+                    if _l.strip() and not _l.startswith("-----"))
                 if begin_cert not in _cert:
                     _cert = "%s%s" % (begin_cert, _cert)
                 if end_cert not in _cert:
                     _cert = "%s%s" % (_cert, end_cert)
-                _, cert_file = make_temp(_cert.encode('ascii'), decode=False)
-                response = self.sec.encrypt_assertion(response, cert_file,
-                                                      pre_encryption_part(),
-                                                      node_xpath=node_xpath)
+                if self.config.getattr("encrypt_cert_in_key_info"):
+                    template = encryption_template(_b64_cert)
+                else:
+                    template = encryption_template()
+                # _fp keeps the file until the assertion is encrypted
+                _fp, cert_file = self.sec.crypto.cert_file(_cert)
+                response = self.sec.encrypt_assertion(
+                    response, cert_file, template, node_xpath=node_xpath)
                 return response
             except Exception as ex:
                 exception = ex
@@ -803,7 +860,69 @@ class Entity(HTTPBase):
                 else:
                     return typ
 
-    def _parse_request(self, enc_request, request_cls, service, binding):
+    @timed(VERIFY)
+    def _verify_redirect_signature(self, saml_msg, enc_request, binding,
+                                   msgtype, only_valid_cert=False):
+        """ Verifies the signature of a message received using the
+        HTTP-Redirect binding before the message is parsed. A malformed
+        signature or an unsupported algorithm is refused before the message
+        is even inflated.
+
+        :param saml_msg: The query string as a dictionary with strings as
+            values
+        :param enc_request: The request in its transport format
+        :param binding: Which binding that was used to transport the message
+        :param msgtype: The type of message
+        :param only_valid_cert: Whether the certificate of the signer must
+            be valid too
+        :return: A tuple of the message as a XML string and its issuer
+        """
+        parts = redirect_signature_parts(saml_msg)
+        if parts is None:
+            raise SignatureError("Unsupported signature algorithm: %s" %
+                                 saml_msg.get("SigAlg"))
+        signer, string, signature = parts
+
+        with measure(self.metrics, UNRAVEL):
+            xmlstr = self.unravel(enc_request, binding, msgtype,
+                                  decoder=self.decoder)
+        issuer = peek_issuer(xmlstr)
+        if not issuer:
+            raise SignatureError("Signed message without issuer")
+
+        try:
+            certs = self.metadata.certs(issuer, "any", "signing")
+        except KeyError:
+            raise SignatureError("Unknown issuer: %s" % issuer)
+
+        for cert in certs:
+            try:
+                _key = key_manager.cert_public_key(cert)
+            except ValueError as err:
+                logger.warning("Bad certificate for %s: %s", issuer, err)
+                continue
+            if signer.verify(string, signature, _key):
+                if only_valid_cert:
+                    self._verify_signer_cert(cert)
+                return xmlstr, issuer
+
+        raise SignatureError("Redirect signature verification failed")
+
+    def _verify_signer_cert(self, cert):
+        """ Checks a certificate from metadata like the certificate of a
+        signature in a message is checked.
+
+        :param cert: A base64 encoded DER certificate or a PEM certificate
+        """
+        if "-----BEGIN" not in cert:
+            cert = pem_format(cert)
+        _fp, cert_file = make_temp(cert, ".pem", decode=False)
+        if not self.sec.cert_handler.verify_cert(cert_file):
+            raise CertificateError("Invalid certificate!")
+
+    @timed(PARSE)
+    def _parse_request(self, enc_request, request_cls, service, binding,
+                       saml_msg=None):
         """Parse a Request
 
         :param enc_request: The request in its transport format
@@ -811,6 +930,9 @@ class Entity(HTTPBase):
         :param service:
         :param binding: Which binding that was used to transport the message
             to this entity.
+        :param saml_msg: For the HTTP-Redirect binding, the query string as
+            a dictionary with strings as values. If it is signed the
+            signature is verified before the request is parsed.
         :return: A request instance
         """
 
@@ -840,7 +962,6 @@ class Entity(HTTPBase):
                                self.config.attribute_converters,
                                timeslack=timeslack)
 
-        xmlstr = self.unravel(enc_request, binding, request_cls.msgtype)
         must = self.config.getattr("want_authn_requests_signed", "idp")
         only_valid_cert = self.config.getattr(
             "want_authn_requests_only_with_valid_cert", "idp")
@@ -848,11 +969,30 @@ class Entity(HTTPBase):
             only_valid_cert = False
         if only_valid_cert:
             must = True
+
+        signer = None
+        if binding == BINDING_HTTP_REDIRECT and saml_msg and \
+                "Signature" in saml_msg:
+            xmlstr, signer = self._verify_redirect_signature(
+                saml_msg, enc_request, binding, request_cls.msgtype,
+                only_valid_cert)
+            # The signature is on the query string, not in the message
+            must = False
+        else:
+            with measure(self.metrics, UNRAVEL):
+                xmlstr = self.unravel(enc_request, binding,
+                                      request_cls.msgtype,
+                                      decoder=self.decoder)
         _request = _request.loads(xmlstr, binding, origdoc=enc_request,
                                   must=must, only_valid_cert=only_valid_cert)
 
         _log_debug("Loaded request")
 
+        if _request and signer is not None:
+            issuer = _request.message.issuer
+            if issuer is None or (issuer.text or "").strip() != signer:
+                raise SignatureError("The message is not from the signer")
+
         if _request:
             _request = _request.verify()
             _log_debug("Verified request")
@@ -999,7 +1139,8 @@ class Entity(HTTPBase):
                                          sign=sign, sign_alg=sign_alg,
                                          digest_alg=digest_alg, **rinfo)
 
-        msg = element_to_extension_element(self.artifact[artifact])
+        # An artifact can only be resolved once
+        msg = element_to_extension_element(self.artifact.pop(artifact))
         response.extension_elements = [msg]
 
         logger.info("Response: %s", response)
@@ -1051,18 +1192,22 @@ class Entity(HTTPBase):
                              extensions=extensions, sign=sign,
                              sign_alg=sign_alg, digest_alg=digest_alg, **kwargs)
 
-    def parse_manage_name_id_request(self, xmlstr, binding=BINDING_SOAP):
+    def parse_manage_name_id_request(self, xmlstr, binding=BINDING_SOAP,
+                                     saml_msg=None):
         """ Deal with a LogoutRequest
 
         :param xmlstr: The response as a xml string
         :param binding: What type of binding this message came through.
+        :param saml_msg: The query string, as a dictionary with strings as
+            values, if the HTTP-Redirect binding was used.
         :return: None if the reply doesn't contain a valid SAML LogoutResponse,
             otherwise the reponse if the logout was successful and None if it
             was not.
         """
 
         return self._parse_request(xmlstr, saml_request.ManageNameIDRequest,
-                                   "manage_name_id_service", binding)
+                                   "manage_name_id_service", binding,
+                                   saml_msg=saml_msg)
 
     def create_manage_name_id_response(self, request, bindings=None,
                                        status=None, sign=False, issuer=None,
@@ -1087,6 +1232,7 @@ class Entity(HTTPBase):
 
     # ------------------------------------------------------------------------
 
+    @timed(PARSE)
     def _parse_response(self, xmlstr, response_cls, service, binding,
                         outstanding_certs=None, **kwargs):
         """ Deal with a Response
@@ -1129,7 +1275,9 @@ class Entity(HTTPBase):
                 logger.info("%s", exc)
                 raise
 
-            xmlstr = self.unravel(xmlstr, binding, response_cls.msgtype)
+            with measure(self.metrics, UNRAVEL):
+                xmlstr = self.unravel(xmlstr, binding, response_cls.msgtype,
+                                      decoder=self.decoder)
             origxml = xmlstr
             if not xmlstr:  # Not a valid reponse
                 return None
@@ -1147,8 +1295,6 @@ class Entity(HTTPBase):
                     logger.error("Not well-formed XML")
                 raise
 
-            logger.debug("XMLSTR: %s", xmlstr)
-
             if response:
                 keys = None
                 if outstanding_certs:
@@ -1184,18 +1330,22 @@ class Entity(HTTPBase):
 
     # ------------------------------------------------------------------------
 
-    def parse_logout_request(self, xmlstr, binding=BINDING_SOAP):
+    def parse_logout_request(self, xmlstr, binding=BINDING_SOAP,
+                             saml_msg=None):
         """ Deal with a LogoutRequest
 
         :param xmlstr: The response as a xml string
         :param binding: What type of binding this message came through.
+        :param saml_msg: The query string, as a dictionary with strings as
+            values, if the HTTP-Redirect binding was used.
         :return: None if the reply doesn't contain a valid SAML LogoutResponse,
             otherwise the reponse if the logout was successful and None if it
             was not.
         """
 
         return self._parse_request(xmlstr, saml_request.LogoutRequest,
-                                   "single_logout_service", binding)
+                                   "single_logout_service", binding,
+                                   saml_msg=saml_msg)
 
     def use_artifact(self, message, endpoint_index=0):
         """
@@ -1208,7 +1358,7 @@ class Entity(HTTPBase):
         message_handle.update(rndbytes())
         mhd = message_handle.digest()
         saml_art = create_artifact(self.config.entityid, mhd, endpoint_index)
-        self.artifact[saml_art] = message
+        self.artifact.store(saml_art, message)
         return saml_art
 
     def artifact2destination(self, artifact, descriptor):
@@ -0,0 +1,357 @@
+"""
+Time limited storage of message IDs.
+
+A service provider has to remember the IDs of the requests it has sent until
+the responses to them arrive (the outstanding queries) and the IDs of the
+responses and assertions it has consumed, so the same assertion can not be
+used twice. Both kinds of information are only of interest for a limited
+time, after that the messages would be rejected anyway.
+
+Each entry carries its own expiration time. The stores can also be used as
+plain dictionaries, which is how the outstanding queries are handed to the
+response classes.
+"""
+import heapq
+import importlib
+import logging
+import sqlite3
+import threading
+
+import six
+from six.moves import cPickle as pickle
+
+from saml2 import SAMLError
+from saml2.time_util import utc_now
+
+logger = logging.getLogger(__name__)
+
+# How long, in seconds, to wait for a response to a request.
+REQUEST_LIFETIME = 600
+# Max number of IDs kept by the in memory store.
+MAX_IDS = 100000
+
+
+class IdStore(object):
+    """ Interface of a store of IDs.
+
+    Entries are kept for *lifetime* seconds unless another expiration time
+    is given when they are stored.
+    """
+
+    def __init__(self, lifetime=REQUEST_LIFETIME):
+        self.lifetime = lifetime
+
+    def _expiration(self, expires):
+        if expires:
+            return expires
+        return utc_now() + self.lifetime
+
+    def store(self, key, value=None, expires=None):
+        """ Stores a value under an ID, replacing any earlier value.
+
+        :param key: The ID
+        :param value: Something to remember about the ID
+        :param expires: When to forget about it, as seconds since the epoch.
+            Default is *lifetime* seconds from now.
+        """
+        raise NotImplementedError()
+
+    def add(self, key, value=None, expires=None):
+        """ Stores a value under an ID unless the ID is already known.
+        This is atomic so it can be used to detect replays also when the
+        store is shared by several processes.
+
+        :return: True if the ID was added, False if it was already there
+        """
+        raise NotImplementedError()
+
+    def get(self, key):
+        """ Returns the value stored under an ID.
+
+        :return: The value, raises KeyError if the ID is not known or has
+            expired.
+        """
+        raise NotImplementedError()
+
+    def pop(self, key, *default):
+        """ Returns the value stored under an ID and forgets about the ID.
+
+        :return: The value, if the ID is unknown *default* if given otherwise
+            KeyError is raised.
+        """
+        raise NotImplementedError()
+
+    def remove_expired(self, now=None):
+        """ Removes all expired entries.
+
+        :param now: Point in time, as seconds since the epoch, to compare
+            with. Default is the current time.
+        :return: The number of entries removed
+        """
+        raise NotImplementedError()
+
+    def keys(self):
+        raise NotImplementedError()
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.store(key, value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+        except KeyError:
+            return False
+        return True
+
+
+class IdStoreMemory(IdStore):
+    """ In memory storage of IDs, bounded in size and time. When full the
+    entries closest to expiration are dropped first.
+    """
+
+    def __init__(self, lifetime=REQUEST_LIFETIME, max_entries=MAX_IDS):
+        IdStore.__init__(self, lifetime)
+        self.max_entries = max_entries
+        # key -> (expiration time, value)
+        self._db = {}
+        # heap of (expiration time, key)
+        self._expires = []
+        self._lock = threading.Lock()
+
+    def _drop(self, now, max_entries):
+        removed = 0
+        while self._expires:
+            expires, key = self._expires[0]
+            if expires >= now and len(self._db) <= max_entries:
+                break
+            heapq.heappop(self._expires)
+            try:
+                if self._db[key][0] != expires:  # has been stored again
+                    continue
+            except KeyError:  # already gone
+                continue
+            del self._db[key]
+            removed += 1
+        return removed
+
+    def _store(self, key, value, expires):
+        self._db[key] = (expires, value)
+        heapq.heappush(self._expires, (expires, key))
+        self._drop(utc_now(), self.max_entries)
+
+    def store(self, key, value=None, expires=None):
+        expires = self._expiration(expires)
+        with self._lock:
+            self._store(key, value, expires)
+
+    def add(self, key, value=None, expires=None):
+        expires = self._expiration(expires)
+        with self._lock:
+            try:
+                if self._db[key][0] >= utc_now():
+                    return False
+            except KeyError:
+                pass
+            self._store(key, value, expires)
+        return True
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._db[key]
+        if expires < utc_now():
+            raise KeyError(key)
+        return value
+
+    def pop(self, key, *default):
+        try:
+            with self._lock:
+                expires, value = self._db.pop(key)
+            if expires < utc_now():
+                raise KeyError(key)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        return value
+
+    def remove_expired(self, now=None):
+        if now is None:
+            now = utc_now()
+        with self._lock:
+            return self._drop(now, self.max_entries)
+
+    def keys(self):
+        now = utc_now()
+        with self._lock:
+            return [k for k, (e, _) in self._db.items() if e >= now]
+
+    def __len__(self):
+        return len(self._db)
+
+
+class IdStoreSQLite(IdStore):
+    """ IDs stored in a SQLite database. Can be shared between processes on
+    the same host. Values are pickled.
+    """
+
+    def __init__(self, filename, table, lifetime=REQUEST_LIFETIME):
+        IdStore.__init__(self, lifetime)
+        self.table = table
+        self._db = sqlite3.connect(filename, check_same_thread=False,
+                                   isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, "
+                "expires INTEGER, value BLOB)" % table)
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS %s_expires ON %s (expires)" % (
+                    table, table))
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql % self.table, args)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql % self.table, args).fetchall()
+
+    def store(self, key, value=None, expires=None):
+        self._execute("INSERT OR REPLACE INTO %s VALUES (?, ?, ?)",
+                      (key, self._expiration(expires),
+                       sqlite3.Binary(pickle.dumps(value, 2))))
+
+    def add(self, key, value=None, expires=None):
+        self._execute("DELETE FROM %s WHERE key = ? AND expires < ?",
+                      (key, utc_now()))
+        cur = self._execute("INSERT OR IGNORE INTO %s VALUES (?, ?, ?)",
+                            (key, self._expiration(expires),
+                             sqlite3.Binary(pickle.dumps(value, 2))))
+        return cur.rowcount == 1
+
+    def get(self, key):
+        rows = self._query(
+            "SELECT value FROM %s WHERE key = ? AND expires >= ?",
+            (key, utc_now()))
+        if not rows:
+            raise KeyError(key)
+        return pickle.loads(bytes(rows[0][0]))
+
+    def pop(self, key, *default):
+        try:
+            value = self.get(key)
+            # The delete decides who gets the value if two processes
+            # try to use the same ID.
+            if self._execute("DELETE FROM %s WHERE key = ?",
+                             (key,)).rowcount != 1:
+                raise KeyError(key)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        return value
+
+    def remove_expired(self, now=None):
+        if now is None:
+            now = utc_now()
+        return self._execute("DELETE FROM %s WHERE expires < ?",
+                             (now,)).rowcount
+
+    def keys(self):
+        return [r[0] for r in self._query(
+            "SELECT key FROM %s WHERE expires >= ?", (utc_now(),))]
+
+    def close(self):
+        self._db.close()
+
+
+class IdStoreMemcached(IdStore):
+    """ IDs stored in memcached, can be shared between hosts. Expiration is
+    handled by memcached. Listing the keys is not supported.
+    """
+
+    def __init__(self, servers, prefix, lifetime=REQUEST_LIFETIME):
+        import memcache
+
+        IdStore.__init__(self, lifetime)
+        self.prefix = prefix
+        self._cache = memcache.Client(servers)
+
+    def _key(self, key):
+        return "%s_%s" % (self.prefix, key)
+
+    def store(self, key, value=None, expires=None):
+        # Absolute times are used as is by memcached
+        if not self._cache.set(self._key(key), (value,),
+                               time=self._expiration(expires)):
+            raise KeyError(key)
+
+    def add(self, key, value=None, expires=None):
+        return bool(self._cache.add(self._key(key), (value,),
+                                    time=self._expiration(expires)))
+
+    def get(self, key):
+        res = self._cache.get(self._key(key))
+        if res is None:
+            raise KeyError(key)
+        return res[0]
+
+    def pop(self, key, *default):
+        _key = self._key(key)
+        res = self._cache.get(_key)
+        # Only the one who manages to delete the item may use it
+        if res is None or not self._cache.delete(_key):
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return res[0]
+
+    def remove_expired(self, now=None):
+        return 0
+
+    def keys(self):
+        return []
+
+
+def id_store_factory(spec, name, lifetime=None):
+    """ Creates an ID store according to a configuration specification.
+
+    :param spec: None or "memory" for an in memory store or a tuple
+        (type, data) where type is one of "memory", "sqlite", "memcached"
+        or "class". For "memory" data is the max number of entries, for
+        "sqlite" a file name, for "memcached" a list of servers and for
+        "class" the dotted path of a class that implements IdStore.
+    :param name: Name of the store, used to keep stores that share a
+        database apart.
+    :param lifetime: Default number of seconds an ID is kept
+    :return: An IdStore instance
+    """
+    if lifetime is None:
+        lifetime = REQUEST_LIFETIME
+
+    if not spec:
+        return IdStoreMemory(lifetime)
+    elif isinstance(spec, six.string_types):
+        if spec.lower() == "memory":
+            return IdStoreMemory(lifetime)
+    else:
+        typ, data = spec
+        typ = typ.lower()
+        if typ == "memory":
+            return IdStoreMemory(lifetime, data)
+        elif typ == "sqlite":
+            return IdStoreSQLite(data, name, lifetime)
+        elif typ == "memcached":
+            return IdStoreMemcached(data, name, lifetime)
+        elif typ == "class":
+            mod, clas = data.rsplit('.', 1)
+            mod = importlib.import_module(mod)
+            return getattr(mod, clas)(name=name, lifetime=lifetime)
+
+    raise SAMLError("Unknown ID storage type: %s" % (spec,))
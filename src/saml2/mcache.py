@@ -4,6 +4,7 @@ import logging
 import memcache
 from saml2 import time_util
 from saml2.cache import ToOld, CacheError
+from saml2.time_util import to_epoch
 
 # The assumption is that any subject may consist of data
 # gathered from several different sources, all with their own
@@ -15,8 +16,15 @@ def _key(prefix, name):
     return "%s_%s" % (prefix, name)
 
 class Cache(object):
+    """ Identity cache kept in memcached. The information about a subject
+    from an entity is stored with its not on or after time as expiration time
+    so memcached evicts it by itself. :py:meth:`remove_expired` removes
+    the references to evicted information from the subject and entity lists.
+    """
+
     def __init__(self, servers, debug=0):
         self._cache = memcache.Client(servers, debug)
+        self.evicted = 0
 
     def delete(self, subject_id):
         entities = self.entities(subject_id)
@@ -117,8 +125,9 @@ class Cache(object):
             if not self._cache.set(subject_id, entities):
                 raise CacheError("set failed")
 
-        # Should use memcache's expire
-        if not self._cache.set(_key(subject_id, entity_id), (timestamp, info)):
+        # Absolute times are used as is by memcached
+        if not self._cache.set(_key(subject_id, entity_id), (timestamp, info),
+                               to_epoch(timestamp)):
             raise CacheError("set failed")
 
     def reset(self, subject_id, entity_id):
@@ -200,3 +209,67 @@ class Cache(object):
 
         if not self._cache.set(_key(subject_id, entity_id), (newtime, info)):
             raise CacheError("valid_to failed")
+
+    def remove_expired(self, now=None, max_items=None):
+        """ Removes subjects and entities from the subject and entity lists
+        when the information about them has expired.
+
+        :param now: Point in time, as seconds since the epoch, to compare
+            with. Default is the current time.
+        :param max_items: Max number of subjects to look at, None means all.
+        :return: The number of (subject, entity) entries removed
+        """
+        if now is None:
+            now = time_util.utc_now()
+
+        subjects = self._cache.get("subjects") or []
+        if max_items is not None:
+            todo = subjects[:max_items]
+        else:
+            todo = subjects
+
+        removed = 0
+        gone = []
+        for subject_id in todo:
+            entities = self._cache.get(subject_id) or []
+            items = self._cache.get_multi(entities, subject_id + '_')
+            live = []
+            for entity_id in entities:
+                try:
+                    (timestamp, _) = items[entity_id]
+                except (KeyError, TypeError, ValueError):
+                    pass
+                else:
+                    expires = to_epoch(timestamp)
+                    if not expires or expires >= now:
+                        live.append(entity_id)
+                        continue
+                    self._cache.delete(_key(subject_id, entity_id))
+                removed += 1
+
+            if not live:
+                self._cache.delete(subject_id)
+                gone.append(subject_id)
+            elif len(live) != len(entities):
+                if not self._cache.set(subject_id, live):
+                    raise CacheError("set failed")
+
+        if gone:
+            subjects = [s for s in self._cache.get("subjects") or []
+                        if s not in gone]
+            if not self._cache.set("subjects", subjects):
+                raise CacheError("set failed")
+
+        self.evicted += removed
+        return removed
+
+    def stats(self):
+        """ Number of (subject, entity) entries listed in the cache and the
+        number that has been evicted by this instance.
+
+        :return: A dictionary with the keys 'live' and 'evicted'
+        """
+        live = 0
+        for subject_id in self._cache.get("subjects") or []:
+            live += len(self._cache.get(subject_id) or [])
+        return {"live": live, "evicted": self.evicted}
@@ -11,11 +11,27 @@ from datetime import datetime
 from saml2 import time_util
 from saml2.cache import ToOld
 from saml2.time_util import TIME_FORMAT
+from saml2.time_util import to_epoch
 
 logger = logging.getLogger(__name__)
 
 
+def _expires_at(timestamp):
+    """ The not on or after time as a datetime, which is what MongoDB's TTL
+    index works with, or None if there is no such time.
+    """
+    expires = to_epoch(timestamp)
+    if expires:
+        return datetime.utcfromtimestamp(expires)
+    return None
+
+
 class Cache(object):
+    """ Identity cache kept in MongoDB. Every document carries an
+    'expires_at' date covered by a TTL index so MongoDB evicts expired
+    information by itself, :py:meth:`remove_expired` does it at once.
+    """
+
     def __init__(self, server=None, debug=0, db=None):
         if server:
             connection = MongoClient(server)
@@ -28,7 +44,10 @@ class Cache(object):
             self._db = connection.pysaml2
 
         self._cache = self._db.collection
+        self._cache.create_index("expires_at", expireAfterSeconds=0)
+        self._cache.create_index([("subject_id", 1), ("entity_id", 1)])
         self.debug = debug
+        self.evicted = 0
 
     def delete(self, subject_id):
         self._cache.remove({"subject_id": subject_id})
@@ -123,6 +142,9 @@ class Cache(object):
                "entity_id": entity_id,
                "info": info,
                "timestamp": timestamp}
+        expires_at = _expires_at(timestamp)
+        if expires_at:
+            doc["expires_at"] = expires_at
 
         _ = self._cache.insert(doc)
 
@@ -135,7 +157,8 @@ class Cache(object):
         :return:
         """
         self._cache.update({"subject_id": subject_id, "entity_id": entity_id},
-                           {"$set": {"info": {}, "timestamp": 0}})
+                           {"$set": {"info": {}, "timestamp": 0},
+                            "$unset": {"expires_at": ""}})
 
     def entities(self, subject_id):
         """ Returns all the entities of assertions for a subject, disregarding
@@ -192,8 +215,39 @@ class Cache(object):
 
     def valid_to(self, subject_id, entity_id, newtime):
         """ """
+        _set = {"timestamp": newtime}
+        expires_at = _expires_at(newtime)
+        if expires_at:
+            _set["expires_at"] = expires_at
+            change = {"$set": _set}
+        else:
+            change = {"$set": _set, "$unset": {"expires_at": ""}}
         self._cache.update({"subject_id": subject_id, "entity_id": entity_id},
-                           {"$set": {"timestamp": newtime}})
+                           change)
+
+    def remove_expired(self, now=None):
+        """ Removes the information that is no longer valid without waiting
+        for the TTL monitor.
+
+        :param now: Point in time, as seconds since the epoch, to compare
+            with. Default is the current time.
+        :return: The number of (subject, entity) entries removed
+        """
+        if now is None:
+            now = time_util.utc_now()
+        res = self._cache.remove(
+            {"expires_at": {"$lt": datetime.utcfromtimestamp(now)}})
+        removed = res.get("n", 0) if res else 0
+        self.evicted += removed
+        return removed
+
+    def stats(self):
+        """ Number of (subject, entity) entries in the cache and the number
+        that has been evicted by this instance.
+
+        :return: A dictionary with the keys 'live' and 'evicted'
+        """
+        return {"live": self._cache.count(), "evicted": self.evicted}
 
     def clear(self):
         self._cache.remove()
\ No newline at end of file
@@ -3,10 +3,13 @@ import hashlib
 import importlib
 import json
 import logging
+import multiprocessing
 import os
 import sys
+import time
 
 from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 from os.path import isfile
 from os.path import join
 
@@ -26,15 +29,18 @@ from saml2 import BINDING_SOAP
 from saml2.httpbase import HTTPBase
 from saml2.extension.idpdisc import BINDING_DISCO
 from saml2.extension.idpdisc import DiscoveryResponse
+from saml2.filter import Filter
 from saml2.md import EntitiesDescriptor
 from saml2.mdie import to_dict
 from saml2.s_utils import UnsupportedBinding
 from saml2.s_utils import UnknownSystemEntity
 from saml2.sigver import split_len
 from saml2.validate import valid_instance
+from saml2.time_util import utc_now
 from saml2.time_util import valid
 from saml2.validate import NotValid
 from saml2.sigver import security_context
+from saml2.sigver import SignatureError
 
 __author__ = 'rolandh'
 
@@ -428,6 +434,53 @@ class MetaData(object):
         return res
 
 
+# The role descriptors an entity descriptor may have
+ROLE_DESCRIPTORS = ["spsso", "idpsso", "role", "authn_authority",
+                    "attribute_authority", "pdp", "affiliation"]
+
+# Max number of protocol support enumerations that are remembered
+MAX_PROTOCOL_ENUMERATIONS = 256
+# protocolSupportEnumeration -> True if SAML 2.0 is supported
+_saml2_support = {}
+
+
+def supports_saml2(enumeration):
+    """ Whether a protocolSupportEnumeration includes SAML 2.0. Feeds use
+    a handful of different values, so the answers are remembered.
+
+    :param enumeration: The protocolSupportEnumeration value
+    :return: True or False
+    """
+    try:
+        return _saml2_support[enumeration]
+    except KeyError:
+        pass
+
+    res = samlp.NAMESPACE in enumeration.split(" ")
+    if len(_saml2_support) < MAX_PROTOCOL_ENUMERATIONS:
+        _saml2_support[six.moves.intern(str(enumeration))] = res
+    return res
+
+
+def has_saml2_role(entity_descr):
+    """ Whether any role of an entity supports SAML 2.0. Affiliations are
+    not protocol specific and always count.
+
+    :param entity_descr: An EntityDescriptor instance
+    :return: True or False
+    """
+    for descr in ROLE_DESCRIPTORS:
+        _items = getattr(entity_descr, "%s_descriptor" % descr, None)
+        if not _items:
+            continue
+        if descr == "affiliation":
+            return True
+        if any(supports_saml2(item.protocol_support_enumeration or "")
+               for item in _items):
+            return True
+    return False
+
+
 class InMemoryMetaData(MetaData):
     def __init__(self, attrc, metadata="", node_name=None,
                  check_validity=True, security=None, **kwargs):
@@ -438,6 +491,10 @@ class InMemoryMetaData(MetaData):
         self.entities_descr = None
         self.entity_descr = None
         self.check_validity = check_validity
+        # Seconds spent in each phase of the last parse
+        self.load_timings = {}
+        # True while parse() adds entities it already has checked
+        self._checked = False
         try:
             self.filter = kwargs["filter"]
         except KeyError:
@@ -468,15 +525,11 @@ class InMemoryMetaData(MetaData):
         del self.entity[key]
 
     def do_entity_descriptor(self, entity_descr):
-        if self.check_validity:
-            try:
-                if not valid(entity_descr.valid_until):
-                    logger.error("Entity descriptor (entity id:%s) to old",
-                                 entity_descr.entity_id)
-                    self.to_old.append(entity_descr.entity_id)
-                    return
-            except AttributeError:
-                pass
+        # parse() checks validUntil and protocol support for all the
+        # entities of an EntitiesDescriptor in one go
+        if self.check_validity and not self._checked:
+            if self.expired([entity_descr])[0]:
+                return
 
         # have I seen this entity_id before ? If so if log: ignore it
         if entity_descr.entity_id in self.entity:
@@ -484,11 +537,48 @@ class InMemoryMetaData(MetaData):
                   entity_descr.entity_id, file=sys.stderr)
             return
 
+        # Not worth converting if no role supports SAML2
+        if not self._checked and not has_saml2_role(entity_descr):
+            return
+
+        self._add_entity(entity_descr)
+
+    def expired(self, entity_descrs, now=None):
+        """ Checks the validUntil of a number of entity descriptors in one go.
+        Entities share a few validUntil values, each is only compared
+        once.
+
+        :param entity_descrs: A list of EntityDescriptor instances
+        :param now: Seconds since the epoch to compare against
+        :return: A list of booleans, True for each entity that is too old
+        """
+        if now is None:
+            now = utc_now()
+
+        # validUntil -> valid or not
+        _valid = {}
+        res = []
+        for entity_descr in entity_descrs:
+            until = getattr(entity_descr, "valid_until", None)
+            if not until:
+                res.append(False)
+                continue
+            try:
+                ok = _valid[until]
+            except KeyError:
+                ok = _valid[until] = valid(until, now)
+            if not ok:
+                logger.error("Entity descriptor (entity id:%s) to old",
+                             entity_descr.entity_id)
+                self.to_old.append(entity_descr.entity_id)
+            res.append(not ok)
+        return res
+
+    def _add_entity(self, entity_descr):
         _ent = to_dict(entity_descr, metadata_modules())
         flag = 0
         # verify support for SAML2
-        for descr in ["spsso", "idpsso", "role", "authn_authority",
-                      "attribute_authority", "pdp", "affiliation"]:
+        for descr in ROLE_DESCRIPTORS:
             _res = []
             try:
                 _items = _ent["%s_descriptor" % descr]
@@ -500,11 +590,9 @@ class InMemoryMetaData(MetaData):
                 continue
 
             for item in _items:
-                for prot in item["protocol_support_enumeration"].split(" "):
-                    if prot == samlp.NAMESPACE:
-                        item["protocol_support_enumeration"] = prot
-                        _res.append(item)
-                        break
+                if supports_saml2(item["protocol_support_enumeration"]):
+                    item["protocol_support_enumeration"] = samlp.NAMESPACE
+                    _res.append(item)
             if not _res:
                 del _ent["%s_descriptor" % descr]
             else:
@@ -519,13 +607,19 @@ class InMemoryMetaData(MetaData):
             self.entity[entity_descr.entity_id] = _ent
 
     def parse(self, xmlstr):
+        timings = self.load_timings = {}
+        start = time.time()
         self.entities_descr = md.entities_descriptor_from_string(xmlstr)
+        # All entities are checked against the same now
+        now = utc_now()
 
         if not self.entities_descr:
             self.entity_descr = md.entity_descriptor_from_string(xmlstr)
+            timings["parse"] = time.time() - start
             if self.entity_descr:
                 self.do_entity_descriptor(self.entity_descr)
         else:
+            timings["parse"] = time.time() - start
             try:
                 valid_instance(self.entities_descr)
             except NotValid as exc:
@@ -534,7 +628,7 @@ class InMemoryMetaData(MetaData):
 
             if self.check_validity:
                 try:
-                    if not valid(self.entities_descr.valid_until):
+                    if not valid(self.entities_descr.valid_until, now):
                         raise ToOld(
                             "Metadata not valid anymore, it's only valid "
                             "until %s" % (
@@ -542,8 +636,28 @@ class InMemoryMetaData(MetaData):
                 except AttributeError:
                     pass
 
-            for entity_descr in self.entities_descr.entity_descriptor:
-                self.do_entity_descriptor(entity_descr)
+            # Filter on validUntil and protocol support in bulk before
+            # anything is converted
+            start = time.time()
+            entity_descrs = self.entities_descr.entity_descriptor
+            if self.check_validity:
+                too_old = self.expired(entity_descrs, now)
+            else:
+                too_old = [False] * len(entity_descrs)
+            wanted = [ed for ed, old in zip(entity_descrs, too_old)
+                      if not old and has_saml2_role(ed)]
+            timings["validity"] = time.time() - start
+
+            start = time.time()
+            self._checked = True
+            try:
+                for entity_descr in wanted:
+                    self.do_entity_descriptor(entity_descr)
+            finally:
+                self._checked = False
+            timings["convert"] = time.time() - start
+
+        logger.debug("Metadata load timings: %s", timings)
 
     def service(self, entity_id, typ, service, binding=None):
         """ Get me all services with a specified
@@ -657,6 +771,10 @@ class MetaDataFile(InMemoryMetaData):
     the SAML Metadata format.
     """
 
+    # False when the file was loaded in another process, which doesn't send
+    # back the descriptors, they are parsed from the file when asked for.
+    descriptors_parsed = True
+
     def __init__(self, attrc, filename=None, cert=None, **kwargs):
         super(MetaDataFile, self).__init__(attrc, **kwargs)
         if not filename:
@@ -664,6 +782,33 @@ class MetaDataFile(InMemoryMetaData):
         self.filename = filename
         self.cert = cert
 
+    def _parse_descriptors(self):
+        self.descriptors_parsed = True
+        xmlstr = self.get_metadata_content()
+        self._entities_descr = md.entities_descriptor_from_string(xmlstr)
+        if not self._entities_descr:
+            self._entity_descr = md.entity_descriptor_from_string(xmlstr)
+
+    @property
+    def entities_descr(self):
+        if not self.descriptors_parsed:
+            self._parse_descriptors()
+        return self._entities_descr
+
+    @entities_descr.setter
+    def entities_descr(self, value):
+        self._entities_descr = value
+
+    @property
+    def entity_descr(self):
+        if not self.descriptors_parsed:
+            self._parse_descriptors()
+        return self._entity_descr
+
+    @entity_descr.setter
+    def entity_descr(self, value):
+        self._entity_descr = value
+
     def get_metadata_content(self):
         with open(self.filename, 'rb') as fp:
             return fp.read()
@@ -717,6 +862,131 @@ class MetaDataLoader(MetaDataFile):
         return self.metadata_provider_callable()
 
 
+class MetaDataDirectory(InMemoryMetaData):
+    """
+    Handles a directory of metadata files on the same machine. Every file
+    is loaded as a :py:class:`MetaDataFile`. On :py:meth:`refresh` only the
+    files that were added or changed since the last time are loaded again,
+    and the entities of removed files are dropped.
+    """
+
+    def __init__(self, attrc, directory=None, cert=None, check_interval=0,
+                 security=None, **kwargs):
+        """
+        :param attrc: Attribute converters
+        :param directory: The directory the metadata files are in
+        :param cert: Certificate used to verify the signature of the files
+        :param check_interval: Min number of seconds between two checks of
+            the directory, refresh() does nothing if called more often.
+        :param security: The security context used to verify the signatures
+        """
+        super(MetaDataDirectory, self).__init__(attrc, security=security,
+                                                **kwargs)
+        if not directory:
+            raise SAMLError('No directory specified.')
+        self.directory = directory
+        self.cert = cert
+        self.check_interval = check_interval
+        self.last_check = 0
+        # file name -> (mtime, size, digest of content, MetaDataFile)
+        self.files = {}
+        self._file_args = kwargs
+
+    def load(self, *args, **kwargs):
+        self.refresh(force=True, strict=True)
+
+    def _load_file(self, filename, content):
+        _md = MetaDataFile(self.attrc, filename, cert=self.cert,
+                           security=self.security, **self._file_args)
+        if not _md.parse_and_check_signature(content):
+            raise SignatureError(
+                "Could not verify the signature of %s" % filename)
+        return _md
+
+    def refresh(self, force=False, strict=False):
+        """ Loads files that were added or changed and drops the ones that
+        were removed. Files whose modification time and size are the same as
+        last time are not read.
+
+        :param force: Check the directory even if the last check was less
+            than check_interval seconds ago
+        :param strict: Raise exceptions when files can not be loaded, if
+            False the error is logged and the previous content of the file is
+            kept.
+        :return: True if the content of the directory changed
+        """
+        now = time.time()
+        if not force and now - self.last_check < self.check_interval:
+            return False
+        self.last_check = now
+
+        changed = False
+        files = {}
+        for fil in os.listdir(self.directory):
+            _fil = join(self.directory, fil)
+            if not isfile(_fil):
+                continue
+            try:
+                stat = os.stat(_fil)
+            except OSError:
+                # Removed after listdir
+                continue
+
+            try:
+                mtime, size, digest, _md = self.files[_fil]
+            except KeyError:
+                digest = _md = None
+            else:
+                if (mtime, size) == (stat.st_mtime, stat.st_size):
+                    files[_fil] = self.files[_fil]
+                    continue
+
+            try:
+                with open(_fil, 'rb') as fp:
+                    content = fp.read()
+                _digest = sha1(content).digest()
+                if _digest != digest:
+                    _md = self._load_file(_fil, content)
+                    changed = True
+            except Exception as err:
+                if strict:
+                    raise
+                logger.error("Could not load metadata from %s: %s", _fil, err)
+                if _fil in self.files:
+                    # Keep what was loaded before
+                    files[_fil] = self.files[_fil]
+                continue
+
+            files[_fil] = (stat.st_mtime, stat.st_size, _digest, _md)
+
+        if set(files) != set(self.files):
+            changed = True
+        self.files = files
+
+        if changed:
+            self._merge()
+        return changed
+
+    def _merge(self):
+        """ Collects the entities of all the files, files are gone through
+        in name order so the result does not depend on the order of the
+        directory listing. """
+        self.entity = {}
+        self.to_old = []
+        self.entities_descr = EntitiesDescriptor()
+        for fil in sorted(self.files):
+            _md = self.files[fil][3]
+            self.entity.update(_md.entity)
+            self.to_old.extend(_md.to_old)
+            try:
+                self.entities_descr.entity_descriptor.extend(
+                    _md.entities_descr.entity_descriptor)
+            except AttributeError:
+                if _md.entity_descr:
+                    self.entities_descr.entity_descriptor.append(
+                        _md.entity_descr)
+
+
 class MetaDataExtern(InMemoryMetaData):
     """
     Class that handles metadata store somewhere on the net.
@@ -832,16 +1102,39 @@ class MetaDataMDX(InMemoryMetaData):
                             "single_sign_on_service", binding)
 
 
+# What a worker process sends back after loading metadata. The parsed
+# descriptors are left behind, sending them costs about as much as parsing
+# the file, MetaDataFile parses them again if they are asked for.
+LOADED_ATTRIBUTES = ["entity", "to_old", "load_timings"]
+
+
+def _load_in_process(_md):
+    """ Loads metadata in a worker process """
+    _md.load()
+    return dict([(attr, getattr(_md, attr, None))
+                 for attr in LOADED_ATTRIBUTES])
+
+
+def _process_loadable(_md):
+    """ Only plain metadata files, with nothing that can't be sent to
+    another process, are parsed in worker processes. """
+    if type(_md) is not MetaDataFile or _md.cert:
+        return False
+    return _md.filter is None or isinstance(_md.filter, Filter)
+
+
 class MetadataStore(MetaData):
     def __init__(self, attrc, config, ca_certs=None,
                  check_validity=True,
                  disable_ssl_certificate_validation=False,
-                 filter=None):
+                 filter=None, load_workers=None):
         """
         :params attrc:
         :params config: Config()
         :params ca_certs:
         :params disable_ssl_certificate_validation:
+        :params load_workers: Load the metadata sources in parallel. The
+            number of threads or a tuple (threads, processes).
         """
         MetaData.__init__(self, attrc, check_validity=check_validity)
 
@@ -856,8 +1149,13 @@ class MetadataStore(MetaData):
         self.check_validity = check_validity
         self.filter = filter
         self.to_old = {}
+        if isinstance(load_workers, (list, tuple)):
+            self.load_threads, self.load_processes = load_workers
+        else:
+            self.load_threads, self.load_processes = load_workers, None
 
-    def load(self, *args, **kwargs):
+    def _sources(self, *args, **kwargs):
+        """ The metadata instances, not yet loaded, for a source """
         if self.filter:
             _args = {"filter": self.filter}
         else:
@@ -869,12 +1167,9 @@ class MetadataStore(MetaData):
             # if library read every file in the library
             if os.path.isdir(key):
                 files = [f for f in os.listdir(key) if isfile(join(key, f))]
-                for fil in files:
-                    _fil = join(key, fil)
-                    _md = MetaDataFile(self.attrc, _fil, **_args)
-                    _md.load()
-                    self.metadata[_fil] = _md
-                return
+                return [(join(key, fil),
+                         MetaDataFile(self.attrc, join(key, fil), **_args))
+                        for fil in files]
             else:
                 # else it's just a plain old file so read it
                 _md = MetaDataFile(self.attrc, key, **_args)
@@ -899,6 +1194,21 @@ class MetadataStore(MetaData):
             _md = MetaDataExtern(self.attrc,
                                  kwargs["url"], self.security,
                                  kwargs["cert"], self.http, **_args)
+        elif typ == "directory":
+            if len(args) > 1:
+                key = args[1]
+            elif "directory" in kwargs:
+                key = kwargs["directory"]
+            else:
+                raise ValueError("Directory metadata must be a path or a dict containing the key 'directory'")
+            for _key in ["node_name", "check_validity", "cert",
+                         "check_interval"]:
+                try:
+                    _args[_key] = kwargs[_key]
+                except KeyError:
+                    pass
+            _md = MetaDataDirectory(self.attrc, key, security=self.security,
+                                    **_args)
         elif typ == "mdfile":
             key = args[1]
             _md = MetaDataMD(self.attrc, args[1], **_args)
@@ -910,10 +1220,15 @@ class MetadataStore(MetaData):
             _md = MetaDataMDX(args[1])
         else:
             raise SAMLError("Unknown metadata type '%s'" % typ)
-        _md.load()
-        self.metadata[key] = _md
+        return [(key, _md)]
 
-    def imp(self, spec):
+    def load(self, *args, **kwargs):
+        self._load_sources(self._sources(*args, **kwargs))
+
+    def _imp_sources(self, spec):
+        """ The metadata instances, not yet loaded, for a metadata
+        specification """
+        sources = []
         # This serves as a backwards compatibility
         if type(spec) is dict:
             # Old style...
@@ -922,56 +1237,123 @@ class MetadataStore(MetaData):
                     if isinstance(val, dict):
                         if not self.check_validity:
                             val["check_validity"] = False
-                        self.load(key, **val)
+                        sources.extend(self._sources(key, **val))
                     else:
-                        self.load(key, val)
-        else:
-            for item in spec:
-                try:
-                    key = item['class']
-                except (KeyError, AttributeError):
-                    raise SAMLError("Misconfiguration in metadata %s" % item)
-                mod, clas = key.rsplit('.', 1)
-                try:
-                    mod = importlib.import_module(mod)
-                    MDloader = getattr(mod, clas)
-                except (ImportError, AttributeError):
-                    raise SAMLError("Unknown metadata loader %s" % key)
-
-                # Separately handle MDExtern
-                if MDloader == MetaDataExtern:
-                    kwargs = {
-                        'http': self.http,
-                        'security': self.security
-                    }
+                        sources.extend(self._sources(key, val))
+            return sources
+
+        for item in spec:
+            try:
+                key = item['class']
+            except (KeyError, AttributeError):
+                raise SAMLError("Misconfiguration in metadata %s" % item)
+            mod, clas = key.rsplit('.', 1)
+            try:
+                mod = importlib.import_module(mod)
+                MDloader = getattr(mod, clas)
+            except (ImportError, AttributeError):
+                raise SAMLError("Unknown metadata loader %s" % key)
+
+            # Separately handle MDExtern
+            if MDloader == MetaDataExtern:
+                kwargs = {
+                    'http': self.http,
+                    'security': self.security
+                }
+            else:
+                kwargs = {}
+
+            if self.filter:
+                kwargs["filter"] = self.filter
+
+            for key in item['metadata']:
+                # Separately handle MetaDataFile and directory
+                if MDloader == MetaDataFile and os.path.isdir(key[0]):
+                    files = [f for f in os.listdir(key[0]) if
+                             isfile(join(key[0], f))]
+                    for fil in files:
+                        _fil = join(key[0], fil)
+                        sources.append((_fil, MetaDataFile(self.attrc, _fil)))
+                    return sources
+
+                if len(key) == 2:
+                    kwargs["cert"] = key[1]
+
+                sources.append((key[0], MDloader(self.attrc, key[0],
+                                                 **kwargs)))
+        return sources
+
+    def imp(self, spec):
+        self._load_sources(self._imp_sources(spec))
+
+    def _add_source(self, key, _md):
+        self.metadata[key] = _md
+        if _md.to_old:
+            self.to_old[key] = _md.to_old
+
+    def refresh(self, force=False):
+        """ Refreshes the sources that can be refreshed, like metadata
+        directories.
+
+        :param force: Refresh even if the sources were checked recently
+        :return: True if any source changed
+        """
+        changed = False
+        for key, _md in self.metadata.items():
+            try:
+                refresh = _md.refresh
+            except AttributeError:
+                continue
+            if refresh(force=force):
+                changed = True
+                if _md.to_old:
+                    self.to_old[key] = _md.to_old
+                else:
+                    self.to_old.pop(key, None)
+        return changed
+
+    def _load_sources(self, sources):
+        """ Loads metadata sources, in parallel if so configured. The
+        sources end up in the store in the given order whatever order they
+        finished loading in.
+
+        :param sources: A list of (key, metadata instance) tuples
+        """
+        if not (self.load_threads or self.load_processes) or \
+                len(sources) < 2:
+            for key, _md in sources:
+                _md.load()
+                self._add_source(key, _md)
+            return
+
+        threads = ThreadPool(self.load_threads or 1)
+        processes = None
+        loadable = [bool(self.load_processes) and _process_loadable(_md)
+                    for _, _md in sources]
+        if any(loadable):
+            processes = multiprocessing.Pool(self.load_processes)
+
+        try:
+            pending = []
+            for (key, _md), in_process in zip(sources, loadable):
+                if in_process:
+                    pending.append((key, _md, True, processes.apply_async(
+                        _load_in_process, (_md,))))
                 else:
-                    kwargs = {}
-
-                if self.filter:
-                    kwargs["filter"] = self.filter
-
-                for key in item['metadata']:
-                    # Separately handle MetaDataFile and directory
-                    if MDloader == MetaDataFile and os.path.isdir(key[0]):
-                        files = [f for f in os.listdir(key[0]) if
-                                 isfile(join(key[0], f))]
-                        for fil in files:
-                            _fil = join(key[0], fil)
-                            _md = MetaDataFile(self.attrc, _fil)
-                            _md.load()
-                            self.metadata[_fil] = _md
-                            if _md.to_old:
-                                self.to_old[_fil] = _md.to_old
-                        return
-
-                    if len(key) == 2:
-                        kwargs["cert"] = key[1]
-
-                    _md = MDloader(self.attrc, key[0], **kwargs)
-                    _md.load()
-                    self.metadata[key[0]] = _md
-                    if _md.to_old:
-                        self.to_old[key[0]] = _md.to_old
+                    pending.append((key, _md, False,
+                                    threads.apply_async(_md.load)))
+
+            for key, _md, in_process, res in pending:
+                loaded = res.get()
+                if in_process:
+                    for attr, val in loaded.items():
+                        setattr(_md, attr, val)
+                    _md.descriptors_parsed = False
+                self._add_source(key, _md)
+        finally:
+            threads.terminate()
+            if processes:
+                processes.terminate()
 
     def service(self, entity_id, typ, service, binding=None):
         known_entity = False
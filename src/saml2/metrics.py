@@ -0,0 +1,171 @@
+"""
+Timings and counts of the hot paths of an entity.
+
+An entity reports to the sink given by the *metrics* configuration option,
+any object with the methods of :py:class:`MetricsSink`. Without a sink
+nothing is measured and a timed method costs no more than an attribute
+lookup.
+
+The timings nest, parsing a response includes unravelling it, verifying
+its signatures and decrypting it. A sink may be called from more than one
+thread at the same time.
+"""
+import threading
+import time
+from functools import wraps
+
+UNRAVEL = "unravel"
+PARSE = "parse"
+VERIFY = "signature_verify"
+DECRYPT = "decrypt"
+POLICY_FILTER = "policy_filter"
+ASSERTION_CONSTRUCT = "assertion_construct"
+SIGN = "sign"
+ENCRYPT = "encrypt"
+BINDING_ENCODE = "binding_encode"
+AUTHN_REQUEST_CREATE = "authn_request_create"
+AUTHN_RESPONSE_CREATE = "authn_response_create"
+AUTHN_RESPONSE_PARSE = "authn_response_parse"
+
+# Appended to the name of an operation that raised an exception
+ERROR = ".error"
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+class MetricsSink(object):
+    """ Receives the measurements, does nothing with them. """
+
+    def __deepcopy__(self, memo):
+        # The configuration is copied when it is loaded, the entity must
+        # report to the sink that was configured
+        return self
+
+    def timing(self, name, seconds):
+        """ An operation has finished
+
+        :param name: Name of the operation, one of the constants in this
+            module
+        :param seconds: How long it took
+        """
+        pass
+
+    def count(self, name, value=1):
+        """ Something happened
+
+        :param name: What happened
+        :param value: How many times
+        """
+        pass
+
+
+class Collector(MetricsSink):
+    """ Keeps the number of calls and the total, min and max time of each
+    operation in memory.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counts = {}
+
+    def timing(self, name, seconds):
+        with self._lock:
+            try:
+                num, total, low, high = self._timings[name]
+            except KeyError:
+                self._timings[name] = (1, seconds, seconds, seconds)
+            else:
+                self._timings[name] = (num + 1, total + seconds,
+                                       min(low, seconds), max(high, seconds))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    def stats(self):
+        """ The measurements so far
+
+        :return: A dictionary with the names of the operations as keys and
+            dictionaries with count, total, mean, min and max as values
+        """
+        res = {}
+        with self._lock:
+            for name, (num, total, low, high) in self._timings.items():
+                res[name] = {"count": num, "total": total,
+                             "mean": total / num, "min": low, "max": high}
+            for name, num in self._counts.items():
+                res.setdefault(name, {})["count"] = num
+        return res
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._counts.clear()
+
+
+class _Measure(object):
+    __slots__ = ["sink", "name", "start"]
+
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.sink.timing(self.name, timer() - self.start)
+        if exc_type is not None:
+            self.sink.count(self.name + ERROR)
+        return False
+
+
+class _NoMeasure(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_MEASURE = _NoMeasure()
+
+
+def measure(sink, name):
+    """ A context manager that times the block it wraps
+
+    :param sink: The MetricsSink to report to, may be None
+    :param name: Name of the operation
+    """
+    if sink is None:
+        return _NO_MEASURE
+    return _Measure(sink, name)
+
+
+def timed(name):
+    """ Decorator that times a method. The sink is read from the *metrics*
+    attribute of the instance the method is bound to.
+
+    :param name: Name of the operation
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            sink = self.metrics
+            if sink is None:
+                return func(self, *args, **kwargs)
+            start = timer()
+            try:
+                return func(self, *args, **kwargs)
+            except Exception:
+                sink.count(name + ERROR)
+                raise
+            finally:
+                sink.timing(name, timer() - start)
+        return wrapper
+    return decorator
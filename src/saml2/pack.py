@@ -11,13 +11,14 @@ import base64
 import html
 import logging
 
+from string import Formatter
+
 import saml2
-from saml2.s_utils import deflate_and_base64_encode
-from saml2.sigver import REQ_ORDER, RESP_ORDER
+from saml2.s_utils import deflate
 from saml2.xmldsig import SIG_ALLOWED_ALG
 
 import six
-from six.moves.urllib.parse import urlencode, urlparse
+from six.moves.urllib.parse import quote_plus, urlencode, urlparse
 
 try:
     from xml.etree import cElementTree as ElementTree
@@ -64,6 +65,54 @@ HTML_FORM_SPEC = """<!DOCTYPE html>
 </html>"""
 
 
+def compile_template(spec):
+    """ Splits a format string into its literal text and the names of its
+    replacement fields once, so rendering it is only a join.
+
+    :param spec: A format string with only named fields
+    :return: A list of (literal, text) tuples, text is the name of a field
+        if literal is False
+    """
+    template = []
+    for literal, field, _, _ in Formatter().parse(spec):
+        if literal:
+            template.append((True, literal))
+        if field is not None:
+            template.append((False, field))
+    return template
+
+
+def render_template(template, **kwargs):
+    """ Renders a template made by :py:func:`compile_template`
+
+    :param template: The compiled template
+    :param kwargs: The values of the fields
+    :return: The rendered text
+    """
+    return "".join([text if literal else kwargs[text]
+                    for literal, text in template])
+
+
+_INPUT_TEMPLATE = compile_template(HTML_INPUT_ELEMENT_SPEC)
+_FORM_TEMPLATE = compile_template(HTML_FORM_SPEC)
+
+
+def _message_bytes(message):
+    if not isinstance(message, six.string_types):
+        message = str(message)
+    if not isinstance(message, six.binary_type):
+        message = message.encode('utf-8')
+    return message
+
+
+def _post_encode(message, typ):
+    """ The value of the form control the message is sent in """
+    message = _message_bytes(message)
+    if typ == "SAMLRequest" or typ == "SAMLResponse":
+        return base64.b64encode(message).decode('ascii')
+    return message.decode('ascii')
+
+
 def http_form_post_message(message, location, relay_state="",
                            typ="SAMLRequest", **kwargs):
     """The HTTP POST binding defines a mechanism by which SAML protocol
@@ -75,33 +124,19 @@ def http_form_post_message(message, location, relay_state="",
     :param relay_state: for preserving and conveying state information
     :return: A tuple containing header information and a HTML message.
     """
-    if not isinstance(message, six.string_types):
-        message = str(message)
-    if not isinstance(message, six.binary_type):
-        message = message.encode('utf-8')
-
-    if typ == "SAMLRequest" or typ == "SAMLResponse":
-        _msg = base64.b64encode(message)
-    else:
-        _msg = message
-    _msg = _msg.decode('ascii')
-
-    saml_response_input = HTML_INPUT_ELEMENT_SPEC.format(
-            name=html.escape(typ),
-            val=html.escape(_msg),
-            type='hidden')
+    saml_response_input = render_template(
+        _INPUT_TEMPLATE, name=html.escape(typ),
+        val=html.escape(_post_encode(message, typ)), type='hidden')
 
     relay_state_input = ""
     if relay_state:
-        relay_state_input = HTML_INPUT_ELEMENT_SPEC.format(
-                name='RelayState',
-                val=html.escape(relay_state),
-                type='hidden')
+        relay_state_input = render_template(
+            _INPUT_TEMPLATE, name='RelayState', val=html.escape(relay_state),
+            type='hidden')
 
-    response = HTML_FORM_SPEC.format(
-        saml_response_input=saml_response_input,
-        relay_state_input=relay_state_input,
-        action=location)
+    response = render_template(
+        _FORM_TEMPLATE, saml_response_input=saml_response_input,
+        relay_state_input=relay_state_input, action=location)
 
     return {"headers": [("Content-type", "text/html")], "data": response}
 
@@ -113,18 +148,7 @@ def http_post_message(message, relay_state="", typ="SAMLRequest", **kwargs):
     :param relay_state: for preserving and conveying state information
     :return: A tuple containing header information and a HTML message.
     """
-    if not isinstance(message, six.string_types):
-        message = str(message)
-    if not isinstance(message, six.binary_type):
-        message = message.encode('utf-8')
-
-    if typ == "SAMLRequest" or typ == "SAMLResponse":
-        _msg = base64.b64encode(message)
-    else:
-        _msg = message
-    _msg = _msg.decode('ascii')
-
-    part = {typ: _msg}
+    part = {typ: _post_encode(message, typ)}
     if relay_state:
         part["RelayState"] = relay_state
 
@@ -150,39 +174,29 @@ def http_redirect_message(message, location, relay_state="", typ="SAMLRequest",
     :param signer: A signature function that can be used to sign the message
     :return: A tuple containing header information and a HTML message.
     """
-
-    if not isinstance(message, six.string_types):
-        message = "%s" % (message,)
-
-    _order = None
     if typ in ["SAMLRequest", "SAMLResponse"]:
-        if typ == "SAMLRequest":
-            _order = REQ_ORDER
-        else:
-            _order = RESP_ORDER
-        args = {typ: deflate_and_base64_encode(message)}
+        value = base64.b64encode(deflate(_message_bytes(message)))
     elif typ == "SAMLart":
-        args = {typ: message}
+        value = message
     else:
         raise Exception("Unknown message type: %s" % typ)
 
+    # The parameters are URL encoded once, in the order they are signed in
+    # (REQ_ORDER/RESP_ORDER), so the signed string is the start of the query.
+    parts = ["%s=%s" % (typ, quote_plus(value))]
     if relay_state:
-        args["RelayState"] = relay_state
+        parts.append("RelayState=%s" % quote_plus(relay_state))
 
     if signer:
         # sigalgs, should be one defined in xmldsig
         assert sigalg in [b for a, b in SIG_ALLOWED_ALG]
-        args["SigAlg"] = sigalg
-
-        string = "&".join([urlencode({k: args[k]})
-                           for k in _order if k in args]).encode('ascii')
-        args["Signature"] = base64.b64encode(signer.sign(string))
-        string = urlencode(args)
-    else:
-        string = urlencode(args)
+        parts.append("SigAlg=%s" % quote_plus(sigalg))
+        signature = base64.b64encode(
+            signer.sign("&".join(parts).encode('ascii')))
+        parts.append("Signature=%s" % quote_plus(signature))
 
     glue_char = "&" if urlparse(location).query else "?"
-    login_url = glue_char.join([location, string])
+    login_url = glue_char.join([location, "&".join(parts)])
     headers = [('Location', str(login_url))]
     body = []
 
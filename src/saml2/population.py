@@ -1,5 +1,6 @@
 import logging
 import six
+from saml2 import SAMLError
 from saml2.cache import Cache
 from saml2.ident import code
 
@@ -11,6 +12,16 @@ class Population(object):
         if cache:
             if isinstance(cache, six.string_types):
                 self.cache = Cache(cache)
+            elif isinstance(cache, tuple):
+                # (type, address)
+                typ, addr = cache
+                if typ == "sqlite":
+                    from saml2.sql_store import CacheSQL
+
+                    self.cache = CacheSQL(addr)
+                else:
+                    raise SAMLError(
+                        "No such cache type implemented: %s" % typ)
             else:
                 self.cache = cache
         else:
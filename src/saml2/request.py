@@ -7,6 +7,7 @@ from saml2.s_utils import OtherError
 from saml2.validate import valid_instance
 from saml2.validate import NotValid
 from saml2.response import IncorrectlySigned
+from saml2.response import ISSUE_INSTANT_WINDOW
 
 logger = logging.getLogger(__name__)
 
@@ -58,7 +59,7 @@ class Request(object):
             logger.info("Response: %s", xmldata)
             raise IncorrectlySigned()
 
-        logger.info("request: %s", self.message)
+        logger.debug("request: %s", self.message)
 
         try:
             valid_instance(self.message)
@@ -70,14 +71,11 @@ class Request(object):
 
     def issue_instant_ok(self):
         """ Check that the request was issued at a reasonable time """
-        upper = time_util.shift_time(time_util.time_in_a_while(days=1),
-                                     self.timeslack).timetuple()
-        lower = time_util.shift_time(time_util.time_a_while_ago(days=1),
-                                     - self.timeslack).timetuple()
-        # print("issue_instant: %s" % self.message.issue_instant)
-        # print("%s < x < %s" % (lower, upper))
-        issued_at = time_util.str_to_time(self.message.issue_instant)
-        return issued_at > lower and issued_at < upper
+        now = time_util.utc_now()
+        upper = now + ISSUE_INSTANT_WINDOW + self.timeslack
+        lower = now - ISSUE_INSTANT_WINDOW - self.timeslack
+        issued_at = time_util.parse_date_time(self.message.issue_instant)
+        return lower < issued_at < upper
 
     def _verify(self):
         assert self.message.version == "2.0"
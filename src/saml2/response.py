@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 #
 
-import calendar
 import logging
 import six
 from saml2.samlp import STATUS_VERSION_MISMATCH
@@ -35,7 +34,6 @@ from saml2 import class_name
 from saml2 import saml
 from saml2 import extension_elements_to_elements
 from saml2 import SAMLError
-from saml2 import time_util
 
 from saml2.s_utils import RequestVersionTooLow
 from saml2.s_utils import RequestVersionTooHigh
@@ -48,7 +46,9 @@ from saml2.sigver import security_context
 from saml2.sigver import SignatureError
 from saml2.sigver import signed
 from saml2.attribute_converter import to_local
-from saml2.time_util import str_to_time, later_than
+from saml2.time_util import later_than
+from saml2.time_util import parse_date_time
+from saml2.time_util import utc_now
 
 from saml2.validate import validate_on_or_after
 from saml2.validate import validate_before
@@ -58,6 +58,9 @@ from saml2.validate import NotValid
 
 logger = logging.getLogger(__name__)
 
+# How far, in seconds, from now the issue instant of a message may be
+ISSUE_INSTANT_WINDOW = 24 * 3600
+
 
 # ---------------------------------------------------------------------------
 
@@ -82,6 +85,10 @@ class UnsolicitedResponse(SAMLError):
     pass
 
 
+class ReplayedResponse(SAMLError):
+    pass
+
+
 class StatusVersionMismatch(StatusError):
     pass
 
@@ -274,12 +281,20 @@ class StatusResponse(object):
         self.asynchop = asynchop
         self.do_not_verify = False
         self.conv_info = conv_info or {}
+        # All time checks on a message are done against the same now
+        self.now = 0
 
     def _clear(self):
         self.xmlstr = ""
         self.name_id = None
         self.response = None
         self.not_on_or_after = 0
+        self.now = 0
+
+    def _now(self):
+        if not self.now:
+            self.now = utc_now()
+        return self.now
 
     def _postamble(self):
         if not self.response:
@@ -301,6 +316,7 @@ class StatusResponse(object):
         return self
 
     def load_instance(self, instance):
+        self.now = utc_now()
         if signed(instance):
             # This will check signature on Assertion which is the default
             try:
@@ -319,6 +335,7 @@ class StatusResponse(object):
 
         # own copy
         self.xmlstr = xmldata[:]
+        self.now = utc_now()
         logger.debug("xmlstr: %s", self.xmlstr)
         if origxml:
             self.origxml = origxml
@@ -372,13 +389,10 @@ class StatusResponse(object):
 
     def issue_instant_ok(self):
         """ Check that the response was issued at a reasonable time """
-        upper = time_util.shift_time(time_util.time_in_a_while(days=1),
-                                     self.timeslack).timetuple()
-        lower = time_util.shift_time(time_util.time_a_while_ago(days=1),
-                                     -self.timeslack).timetuple()
-        # print("issue_instant: %s" % self.response.issue_instant)
-        # print("%s < x < %s" % (lower, upper))
-        issued_at = str_to_time(self.response.issue_instant)
+        now = self._now()
+        upper = now + ISSUE_INSTANT_WINDOW + self.timeslack
+        lower = now - ISSUE_INSTANT_WINDOW - self.timeslack
+        issued_at = parse_date_time(self.response.issue_instant)
         return lower < issued_at < upper
 
     def _verify(self):
@@ -555,10 +569,9 @@ class AuthnResponse(StatusResponse):
         authn_statement = self.assertion.authn_statement[0]
         if authn_statement.session_not_on_or_after:
             if validate_on_or_after(authn_statement.session_not_on_or_after,
-                                    self.timeslack):
-                self.session_not_on_or_after = calendar.timegm(
-                    time_util.str_to_time(
-                        authn_statement.session_not_on_or_after))
+                                    self.timeslack, self._now()):
+                self.session_not_on_or_after = parse_date_time(
+                    authn_statement.session_not_on_or_after)
             else:
                 return False
         return True
@@ -588,9 +601,10 @@ class AuthnResponse(StatusResponse):
         try:
             if conditions.not_on_or_after:
                 self.not_on_or_after = validate_on_or_after(
-                    conditions.not_on_or_after, self.timeslack)
+                    conditions.not_on_or_after, self.timeslack, self._now())
             if conditions.not_before:
-                validate_before(conditions.not_before, self.timeslack)
+                validate_before(conditions.not_before, self.timeslack,
+                                self._now())
         except Exception as excp:
             logger.error("Exception on conditions: %s", excp)
             if not lax:
@@ -679,8 +693,9 @@ class AuthnResponse(StatusResponse):
                 # verify that I got it from the correct sender
 
         # These two will raise exception if untrue
-        validate_on_or_after(data.not_on_or_after, self.timeslack)
-        validate_before(data.not_before, self.timeslack)
+        validate_on_or_after(data.not_on_or_after, self.timeslack,
+                             self._now())
+        validate_before(data.not_before, self.timeslack, self._now())
 
         # not_before must be < not_on_or_after
         if not later_than(data.not_on_or_after, data.not_before):
@@ -7,6 +7,7 @@ import logging
 import random
 import string
 import sys
+import threading
 import time
 import traceback
 import zlib
@@ -21,6 +22,13 @@ from saml2.time_util import instant
 
 logger = logging.getLogger(__name__)
 
+# Max size, in bytes, of a message as received
+MAX_ENCODED_SIZE = 2 * 1024 * 1024
+# Max size, in bytes, of a message after base64 decoding and inflating
+MAX_DECODED_SIZE = 8 * 1024 * 1024
+# How much is inflated at a time
+INFLATE_CHUNK = 64 * 1024
+
 
 class SamlException(Exception):
     pass
@@ -78,6 +86,10 @@ class UnravelError(Exception):
     pass
 
 
+class MessageTooLarge(UnravelError):
+    pass
+
+
 EXCEPTION2STATUS = {
     VersionMismatch: samlp.STATUS_VERSION_MISMATCH,
     UnknownPrincipal: samlp.STATUS_UNKNOWN_PRINCIPAL,
@@ -125,14 +137,142 @@ def valid_email(emailaddress, domains=GENERIC_DOMAINS):
         return False  # Email address has funny characters.
 
 
-def decode_base64_and_inflate(string):
+class MessageDecoder(object):
+    """ Decodes the messages received over the bindings, refusing messages
+    that are, or would become, larger than the limits. Inflating is done a
+    chunk at a time and stops as soon as the limit is passed.
+
+    :param max_encoded: Max size of a message as received
+    :param max_decoded: Max size of a message after decoding
+    """
+
+    def __init__(self, max_encoded=MAX_ENCODED_SIZE,
+                 max_decoded=MAX_DECODED_SIZE):
+        self.max_encoded = max_encoded
+        self.max_decoded = max_decoded
+        self._lock = threading.Lock()
+        self._stats = {"decoded": 0, "rejected_encoded": 0,
+                       "rejected_decoded": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def check_size(self, string):
+        """ Refuses a message that is too large as received
+
+        :param string: The message as received
+        :return: The message
+        """
+        if self.max_encoded and len(string) > self.max_encoded:
+            self._count("rejected_encoded")
+            logger.warning("Refused message of %d bytes, max is %d",
+                           len(string), self.max_encoded)
+            raise MessageTooLarge("Message larger than %d bytes" %
+                                  self.max_encoded)
+        return string
+
+    def _too_large(self):
+        self._count("rejected_decoded")
+        logger.warning("Refused message larger than %d bytes when decoded",
+                       self.max_decoded)
+        raise MessageTooLarge("Decoded message larger than %d bytes" %
+                              self.max_decoded)
+
+    def b64decode(self, string):
+        """ base64 decodes a message
+
+        :param string: a base64 encoded string
+        :return: the string after decoding
+        """
+        res = base64.b64decode(self.check_size(string))
+        if self.max_decoded and len(res) > self.max_decoded:
+            self._too_large()
+        self._count("decoded")
+        return res
+
+    def inflate(self, data):
+        """ Inflates according to RFC1951
+
+        :param data: deflated data
+        :return: the data after inflating
+        """
+        dobj = zlib.decompressobj(-15)
+        res = []
+        size = 0
+        while data:
+            if self.max_decoded:
+                chunk = dobj.decompress(
+                    data, min(INFLATE_CHUNK, self.max_decoded - size + 1))
+            else:
+                chunk = dobj.decompress(data, INFLATE_CHUNK)
+            size += len(chunk)
+            if self.max_decoded and size > self.max_decoded:
+                self._too_large()
+            res.append(chunk)
+            data = dobj.unconsumed_tail
+            if not chunk and data:
+                raise zlib.error("No progress inflating data")
+        chunk = dobj.flush()
+        size += len(chunk)
+        if self.max_decoded and size > self.max_decoded:
+            self._too_large()
+        if getattr(dobj, "eof", True) is False:
+            raise zlib.error("Incomplete or truncated stream")
+        res.append(chunk)
+        return b"".join(res)
+
+    def decode_base64_and_inflate(self, string):
+        """ base64 decodes and then inflates according to RFC1951
+
+        :param string: a deflated and encoded string
+        :return: the string after decoding and inflating
+        """
+        res = self.inflate(base64.b64decode(self.check_size(string)))
+        self._count("decoded")
+        return res
+
+    def stats(self):
+        """ Counters for the decoded messages.
+
+        :return: A dictionary with the number of decoded messages and of
+            messages refused because they were too large as received or
+            when decoded.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+# Used when no other decoder is given
+message_decoder = MessageDecoder()
+
+
+def decode_base64_and_inflate(string, decoder=None):
     """ base64 decodes and then inflates according to RFC1951
 
     :param string: a deflated and encoded string
+    :param decoder: The MessageDecoder that sets the size limits
     :return: the string after decoding and inflating
     """
 
-    return zlib.decompress(base64.b64decode(string), -15)
+    return (decoder or message_decoder).decode_base64_and_inflate(string)
+
+
+# Raw deflate (RFC1951), no zlib header or checksum. Never used itself, only
+# copied so the compressor doesn't have to be set up for every message.
+_DEFLATE = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                            -zlib.MAX_WBITS)
+
+
+def deflate(data):
+    """
+    Deflates according to RFC1951
+
+    :param data: The bytes to deflate
+    :return: The deflated bytes
+    """
+    compressor = _DEFLATE.copy()
+    return compressor.compress(data) + compressor.flush()
 
 
 def deflate_and_base64_encode(string_val):
@@ -144,7 +284,7 @@ def deflate_and_base64_encode(string_val):
     """
     if not isinstance(string_val, six.binary_type):
         string_val = string_val.encode('utf-8')
-    return base64.b64encode(zlib.compress(string_val)[2:-4])
+    return base64.b64encode(deflate(string_val))
 
 
 def rndstr(size=16, alphabet=""):
@@ -438,3 +578,31 @@ def rec_factory(cls, **kwargs):
                     break
 
     return _inst
+
+
+class Sweeper(object):
+    """ Calls a function every *interval* seconds in a background thread.
+    Used to remove expired items from stores.
+    """
+
+    def __init__(self, func, interval, name="Sweeper"):
+        self.func = func
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.func()
+            except Exception as err:
+                logger.error("%s failed: %s", self._thread.name, err)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -1839,6 +1839,8 @@ def factory(tag, **kwargs):
 
 
 def any_response_from_string(xmlstr):
+    # Parsed once, not once per response type tried
+    xmlstr = saml2.parsed_xml(xmlstr)
     resp = None
     for func in [status_response_type__from_string, response_from_string,
                  artifact_response_from_string, logout_response_from_string,
@@ -1,8 +1,15 @@
+import calendar
+import heapq
 import logging
+import threading
 
+from collections import OrderedDict
 from hashlib import sha1
 
 from saml2.ident import code_binary
+from saml2.s_utils import Sweeper
+from saml2.time_util import str_to_time
+from saml2.time_util import utc_now
 
 from saml2 import md
 from saml2 import saml
@@ -19,33 +26,134 @@ __author__ = 'rolandh'
 
 logger = logging.getLogger(__name__)
 
+# How long, in seconds, to keep an assertion that carries no time limits
+DEFAULT_LIFETIME = 8 * 3600
+# Max number of expired assertions removed while holding the lock
+SWEEP_BATCH = 500
+
 
 def context_match(cfilter, cntx):
     # TODO
     return True
 
+
+def class_ref(statement):
+    """ Returns the authn context class reference of an authn statement
+    or None if there is none.
+    """
+    try:
+        return statement.authn_context.authn_context_class_ref.text.strip()
+    except AttributeError:
+        return None
+
+
+def assertion_expiration(assertion, lifetime=DEFAULT_LIFETIME, now=None):
+    """ Figures out when an assertion, including the authn session it
+    describes, is no longer of any use.
+
+    :param assertion: A saml.Assertion instance
+    :param lifetime: Number of seconds to use if the assertion doesn't say
+    :param now: Current time as seconds since the epoch
+    :return: Expiration time as seconds since the epoch
+    """
+    points = []
+    try:
+        points.append(assertion.conditions.not_on_or_after)
+    except AttributeError:
+        pass
+    for statement in assertion.authn_statement:
+        points.append(statement.session_not_on_or_after)
+
+    points = [calendar.timegm(str_to_time(p)) for p in points if p]
+    if points:
+        return max(points)
+
+    if now is None:
+        now = utc_now()
+    return now + lifetime
+
 # The key to the stored authn statement is placed encrypted in the cookie
 
 
 class SessionStorage(object):
-    """ In memory storage of session information """
+    """ In memory storage of session information.
+
+    Authn statements are indexed on subject, session index and authn context
+    class reference. Assertions are forgotten when they expire, either
+    incrementally when new assertions are stored, by calling
+    :py:meth:`remove_expired` or by a background sweeper.
+    """
 
-    def __init__(self):
+    def __init__(self, lifetime=DEFAULT_LIFETIME, sweep_interval=0):
         self.db = {"assertion": {}, "authn": {}}
+        # assertion id -> (assertion, to_sign)
         self.assertion = self.db["assertion"]
+        # subject key -> {assertion id: list of authn statements}
         self.authn = self.db["authn"]
+        # (subject key, session index) -> set of assertion ids
+        self.session_index = {}
+        # (subject key, authn context class ref) -> set of assertion ids
+        self.context = {}
+        # assertion id -> (subject key, session indexes, class refs, expires)
+        self._keys = {}
+        # heap of (expiration time, assertion id)
+        self._expires = []
+        self.lifetime = lifetime
+        self.lock = threading.RLock()
+        self._sweeper = None
+        if sweep_interval:
+            self.start_sweeper(sweep_interval)
+
+    @staticmethod
+    def _subject_key(name_id):
+        return sha1(code_binary(name_id)).hexdigest()
 
     def store_assertion(self, assertion, to_sign):
-        self.assertion[assertion.id] = (assertion, to_sign)
-        key = sha1(code_binary(assertion.subject.name_id)).hexdigest()
-        try:
-            self.authn[key].append(assertion.authn_statement)
-        except KeyError:
-            self.authn[key] = [assertion.authn_statement]
+        now = utc_now()
+        key = self._subject_key(assertion.subject.name_id)
+        statements = assertion.authn_statement
+        sids = set([s.session_index for s in statements if s.session_index])
+        refs = set([r for r in [class_ref(s) for s in statements] if r])
+        expires = assertion_expiration(assertion, self.lifetime, now)
+
+        with self.lock:
+            # Amortize the cleaning over the insertions
+            self._remove_expired(now, SWEEP_BATCH)
+
+            if assertion.id in self._keys:
+                self._forget(assertion.id)
+
+            self.assertion[assertion.id] = (assertion, to_sign)
+            try:
+                self.authn[key][assertion.id] = statements
+            except KeyError:
+                self.authn[key] = OrderedDict([(assertion.id, statements)])
+            for sid in sids:
+                self.session_index.setdefault((key, sid), set()).add(
+                    assertion.id)
+            for ref in refs:
+                self.context.setdefault((key, ref), set()).add(assertion.id)
+            self._keys[assertion.id] = (key, sids, refs, expires)
+            heapq.heappush(self._expires, (expires, assertion.id))
 
     def get_assertion(self, cid):
         return self.assertion[cid]
 
+    def _context_ids(self, key, requested_context):
+        """ The assertion ids that match a requested authn context or None
+        if the index can not be used for this comparison.
+        """
+        if requested_context.comparison not in [None, "exact"]:
+            return None
+        refs = requested_context.authn_context_class_ref
+        if not refs:
+            return None
+
+        res = set()
+        for ref in refs:
+            res.update(self.context.get((key, ref.text.strip()), set()))
+        return res
+
     def get_authn_statements(self, name_id, session_index=None,
                              requested_context=None):
         """
@@ -55,28 +163,140 @@ class SessionStorage(object):
         :param requested_context:
         :return:
         """
-        result = []
-        key = sha1(code_binary(name_id)).hexdigest()
-        try:
-            statements = self.authn[key]
-        except KeyError:
-            logger.info("Unknown subject %s", name_id)
-            return []
+        key = self._subject_key(name_id)
+        with self.lock:
+            try:
+                statements = self.authn[key]
+            except KeyError:
+                logger.info("Unknown subject %s", name_id)
+                return []
 
-        for statement in statements:
             if session_index:
-                if statement.session_index != session_index:
-                    continue
+                ids = self.session_index.get((key, session_index), set())
+            else:
+                ids = None
+
             if requested_context:
-                if not context_match(requested_context,
-                                     statement[0].authn_context):
-                    continue
-            result.append(statement)
+                _ids = self._context_ids(key, requested_context)
+                if _ids is not None:
+                    if ids is None:
+                        ids = _ids
+                    else:
+                        ids = ids.intersection(_ids)
+
+            if ids is None:
+                ids = list(statements.keys())
+            else:
+                # keep the order they were stored in
+                ids = [i for i in statements.keys() if i in ids]
+
+            result = []
+            for aid in ids:
+                if requested_context:
+                    if not [s for s in statements[aid] if context_match(
+                            requested_context, s.authn_context)]:
+                        continue
+                result.append(statements[aid])
 
         return result
 
+    def _unindex(self, aid):
+        try:
+            key, sids, refs, _ = self._keys[aid]
+        except KeyError:
+            return
+
+        try:
+            del self.authn[key][aid]
+        except KeyError:
+            pass
+        else:
+            if not self.authn[key]:
+                del self.authn[key]
+
+        for idx, _keys in [(self.session_index, sids), (self.context, refs)]:
+            for _key in _keys:
+                try:
+                    idx[(key, _key)].discard(aid)
+                    if not idx[(key, _key)]:
+                        del idx[(key, _key)]
+                except KeyError:
+                    pass
+
+    def _forget(self, aid):
+        self._unindex(aid)
+        self._keys.pop(aid, None)
+        self.assertion.pop(aid, None)
+
     def remove_authn_statements(self, name_id):
         logger.debug("remove authn about: %s", name_id)
-        nkey = sha1(code_binary(name_id)).hexdigest()
+        nkey = self._subject_key(name_id)
+
+        with self.lock:
+            for aid in list(self.authn[nkey].keys()):
+                self._unindex(aid)
+
+    def _remove_expired(self, now, max_items=None):
+        removed = 0
+        while self._expires and self._expires[0][0] < now:
+            if max_items is not None and removed >= max_items:
+                break
+            expires, aid = heapq.heappop(self._expires)
+            try:
+                if self._keys[aid][3] != expires:  # has been stored again
+                    continue
+            except KeyError:  # already gone
+                continue
+            self._forget(aid)
+            removed += 1
+        return removed
+
+    def remove_expired(self, now=None, max_items=None):
+        """ Removes expired assertions and the authn statements they carry.
+
+        :param now: Point in time, as seconds since the epoch, to compare
+            with. Default is the current time.
+        :param max_items: Max number of assertions to remove, None means
+            all that has expired.
+        :return: The number of assertions removed
+        """
+        if now is None:
+            now = utc_now()
+
+        removed = 0
+        while True:
+            batch = SWEEP_BATCH
+            if max_items is not None:
+                batch = min(batch, max_items - removed)
+            # Release the lock between batches so requests aren't held up
+            with self.lock:
+                _removed = self._remove_expired(now, batch)
+            removed += _removed
+            if _removed < batch:
+                break
+            if max_items is not None and removed >= max_items:
+                break
+
+        if removed:
+            logger.debug("Removed %d expired assertions", removed)
+        return removed
+
+    def start_sweeper(self, interval):
+        """ Starts a background thread that removes expired assertions every
+        *interval* seconds.
+        """
+        if self._sweeper is None:
+            self._sweeper = Sweeper(self.remove_expired, interval,
+                                    "SessionStorageSweeper")
+            self._sweeper.start()
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.stop()
+            self._sweeper = None
+
+    def close(self):
+        self.stop_sweeper()
 
-        del self.authn[nkey]
+    def __len__(self):
+        return len(self.assertion)
@@ -23,6 +23,11 @@ from saml2.argtree import add_path, is_set
 from saml2.entity import Entity
 from saml2.eptid import Eptid
 from saml2.eptid import EptidShelve
+from saml2.metrics import ASSERTION_CONSTRUCT
+from saml2.metrics import AUTHN_RESPONSE_CREATE
+from saml2.metrics import POLICY_FILTER
+from saml2.metrics import measure
+from saml2.metrics import timed
 from saml2.samlp import NameIDMappingResponse
 from saml2.sdb import SessionStorage
 from saml2.schema import soapenv
@@ -111,10 +116,17 @@ class Server(Entity):
                 return SessionStorage()
         else:  # Should be tuple
             typ, data = _spec
-            if typ.lower() == "mongodb":
+            if typ.lower() == "memory":
+                # data is the interval for the background sweeper
+                return SessionStorage(sweep_interval=data)
+            elif typ.lower() == "mongodb":
                 from saml2.mongo_store import SessionStorageMDB
 
                 return SessionStorageMDB(database=data, collection="session")
+            elif typ.lower() == "sqlite":
+                from saml2.sql_store import SessionStorageSQL
+
+                return SessionStorageSQL(data)
 
         raise NotImplementedError("No such storage type implemented")
 
@@ -151,12 +163,16 @@ class Server(Entity):
 
                 self.ident = IdentMDB(database=addr, collection="ident")
 
+            elif typ == "sqlite":
+                from saml2.sql_store import IdentSQL
+
+                self.ident = IdentSQL(addr)
             elif typ == "identdb":
                 mod, clas = addr.rsplit('.', 1)
                 mod = importlib.import_module(mod)
                 self.ident = getattr(mod, clas)()
 
-        if typ == "mongodb" or typ == "identdb":
+        if typ in ["mongodb", "sqlite", "identdb"]:
             pass
         elif idb is not None:
             self.ident = IdentDB(idb)
@@ -185,6 +201,10 @@ class Server(Entity):
 
                     self.eptid = EptidMDB(secret, database=addr,
                                           collection="eptid")
+                elif typ == "sqlite":
+                    from saml2.sql_store import EptidSQL
+
+                    self.eptid = EptidSQL(secret, addr)
                 else:
                     self.eptid = Eptid(secret)
         except Exception:
@@ -222,17 +242,22 @@ class Server(Entity):
         return False
 
     # -------------------------------------------------------------------------
-    def parse_authn_request(self, enc_request, binding=BINDING_HTTP_REDIRECT):
+    def parse_authn_request(self, enc_request, binding=BINDING_HTTP_REDIRECT,
+                            saml_msg=None):
         """Parse a Authentication Request
 
         :param enc_request: The request in its transport format
         :param binding: Which binding that was used to transport the message
             to this entity.
+        :param saml_msg: The query string, as a dictionary with strings as
+            values, if the HTTP-Redirect binding was used. A signature on it
+            is verified before the request is parsed.
         :return: A request instance
         """
 
         return self._parse_request(enc_request, AuthnRequest,
-                                   "single_sign_on_service", binding)
+                                   "single_sign_on_service", binding,
+                                   saml_msg=saml_msg)
 
     def parse_attribute_query(self, xml_string, binding):
         """ Parse an attribute query
@@ -353,7 +378,8 @@ class Server(Entity):
         if policy is None:
             policy = Policy()
         try:
-            ast.apply_policy(sp_entity_id, policy, self.metadata)
+            with measure(self.metrics, POLICY_FILTER):
+                ast.apply_policy(sp_entity_id, policy, self.metadata)
         except MissingValue as exc:
             if not best_effort:
                 return self.create_error_response(in_response_to, consumer_url,
@@ -368,24 +394,27 @@ class Server(Entity):
                  k in AUTHN_DICT_MAP])
             authn_args.update(kwargs)
 
-            assertion = ast.construct(
-                sp_entity_id, self.config.attribute_converters, policy,
-                issuer=_issuer, farg=farg['assertion'], name_id=name_id,
-                session_not_on_or_after=session_not_on_or_after,
-                **authn_args)
+            with measure(self.metrics, ASSERTION_CONSTRUCT):
+                assertion = ast.construct(
+                    sp_entity_id, self.config.attribute_converters, policy,
+                    issuer=_issuer, farg=farg['assertion'], name_id=name_id,
+                    session_not_on_or_after=session_not_on_or_after,
+                    **authn_args)
 
         elif authn_statement:  # Got a complete AuthnStatement
-            assertion = ast.construct(
-                sp_entity_id, self.config.attribute_converters, policy,
-                issuer=_issuer, authn_statem=authn_statement,
-                farg=farg['assertion'], name_id=name_id,
-                **kwargs)
+            with measure(self.metrics, ASSERTION_CONSTRUCT):
+                assertion = ast.construct(
+                    sp_entity_id, self.config.attribute_converters, policy,
+                    issuer=_issuer, authn_statem=authn_statement,
+                    farg=farg['assertion'], name_id=name_id,
+                    **kwargs)
         else:
-            assertion = ast.construct(
-                sp_entity_id, self.config.attribute_converters, policy,
-                issuer=_issuer, farg=farg['assertion'], name_id=name_id,
-                session_not_on_or_after=session_not_on_or_after,
-                **kwargs)
+            with measure(self.metrics, ASSERTION_CONSTRUCT):
+                assertion = ast.construct(
+                    sp_entity_id, self.config.attribute_converters, policy,
+                    issuer=_issuer, farg=farg['assertion'], name_id=name_id,
+                    session_not_on_or_after=session_not_on_or_after,
+                    **kwargs)
         return assertion
 
     def _authn_response(self, in_response_to, consumer_url,
@@ -542,7 +571,8 @@ class Server(Entity):
             _issuer = self._issuer(issuer)
             ast = Assertion(identity)
             if policy:
-                ast.apply_policy(sp_entity_id, policy, self.metadata)
+                with measure(self.metrics, POLICY_FILTER):
+                    ast.apply_policy(sp_entity_id, policy, self.metadata)
             else:
                 policy = Policy()
 
@@ -550,10 +580,11 @@ class Server(Entity):
                 restr = restriction_from_attribute_spec(attributes)
                 ast = filter_attribute_value_assertions(ast)
 
-            assertion = ast.construct(
-                sp_entity_id, self.config.attribute_converters, policy,
-                issuer=_issuer, name_id=name_id,
-                farg=farg['assertion'])
+            with measure(self.metrics, ASSERTION_CONSTRUCT):
+                assertion = ast.construct(
+                    sp_entity_id, self.config.attribute_converters, policy,
+                    issuer=_issuer, name_id=name_id,
+                    farg=farg['assertion'])
 
             if sign_assertion:
                 assertion.signature = pre_signature_part(assertion.id,
@@ -676,6 +707,7 @@ class Server(Entity):
 
         return args
 
+    @timed(AUTHN_RESPONSE_CREATE)
     def create_authn_response(self, identity, in_response_to, destination,
                               sp_entity_id, name_id_policy=None, userid=None,
                               name_id=None, authn=None, issuer=None,
@@ -899,6 +931,15 @@ class Server(Entity):
 
     def close(self):
         self.ident.close()
+        try:
+            self.session_db.close()
+        except AttributeError:
+            pass
+        try:
+            # Stops the crypto workers if there are any
+            self.sec.close()
+        except AttributeError:
+            pass
 
     def clean_out_user(self, name_id):
         """
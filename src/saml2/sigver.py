@@ -8,14 +8,18 @@ Based on the use of xmlsec1 binaries and not the python xmlsec module.
 from OpenSSL import crypto
 
 import base64
+import defusedxml.ElementTree
 import hashlib
 import logging
 import os
 import ssl
 import six
+import threading
 
+from collections import OrderedDict
 from time import mktime
 from binascii import hexlify
+from multiprocessing.pool import ThreadPool
 
 from future.backports.urllib.parse import urlencode
 
@@ -25,6 +29,13 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.hazmat.primitives.serialization import PublicFormat
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+from cryptography.x509 import ExtensionNotFound
+from cryptography.x509 import NameOID
+from cryptography.x509 import SubjectKeyIdentifier
+from cryptography.x509 import load_der_x509_certificate
 from cryptography.x509 import load_pem_x509_certificate
 
 from tempfile import NamedTemporaryFile
@@ -43,9 +54,15 @@ from saml2 import VERSION
 from saml2.cert import OpenSSLWrapper
 from saml2.extension import pefim
 from saml2.extension.pefim import SPCertEnc
+from saml2.metrics import DECRYPT
+from saml2.metrics import ENCRYPT
+from saml2.metrics import SIGN
+from saml2.metrics import VERIFY
+from saml2.metrics import timed
 from saml2.saml import EncryptedAssertion
 
 import saml2.xmldsig as ds
+import saml2.xmlenc as xenc
 
 from saml2.s_utils import sid
 from saml2.s_utils import Unsupported
@@ -77,6 +94,13 @@ PREFIX2 = '<?xml version="1.0" encoding="UTF-8"?>'
 
 backend = default_backend()
 
+# Number of threads used to verify batches of signed messages
+VERIFY_POOL_SIZE = 4
+# Max number of keys of each kind kept by a KeyManager
+MAX_CACHED_KEYS = 128
+# Max number of templates and certificates the xmlsec1 backend keeps in files
+MAX_XMLSEC_FILES = 128
+
 
 class SigverError(SAMLError):
     pass
@@ -547,7 +571,234 @@ def pem_format(key):
 
 
 def import_rsa_key_from_file(filename):
-    return load_pem_private_key(read_file(filename, 'rb'), None, backend)
+    return key_manager.private_key(filename)
+
+
+class PemData(six.binary_type):
+    """ A PEM encoded key or certificate that is given to a backend in
+    place of the name of a file holding it.
+    """
+    pass
+
+
+class KeyManager(object):
+    """ Keeps parsed keys so that a key is only read and parsed once.
+
+    Private keys are kept per file name and are reloaded when the file
+    changes. Where a file name is expected a PemData instance may be used
+    instead. Public keys are kept per fingerprint of the certificate,
+    since certificates from metadata end up in a new temporary file every
+    time they are used.
+    """
+
+    def __init__(self, max_keys=MAX_CACHED_KEYS):
+        self.max_keys = max_keys
+        # file name -> ((mtime, size), private key)
+        self._private = OrderedDict()
+        # (fingerprint, cert type) -> public key
+        self._public = OrderedDict()
+        # (key file, cert file) -> ((mtime, size), key fingerprints)
+        self._identities = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(data):
+        if not isinstance(data, six.binary_type):
+            data = str(data).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def _stamp(key_file):
+        if isinstance(key_file, PemData):
+            return None
+        _stat = os.stat(key_file)
+        return _stat.st_mtime, _stat.st_size
+
+    @staticmethod
+    def _read(key_file):
+        if isinstance(key_file, PemData):
+            return key_file
+        return read_file(key_file, 'rb')
+
+    def _keep(self, cache, key, value):
+        with self._lock:
+            cache[key] = value
+            while len(cache) > self.max_keys:
+                cache.popitem(last=False)
+        return value
+
+    def private_key(self, key_file):
+        """ Returns the private key in a PEM file.
+
+        :param key_file: The file name or a PemData instance
+        :return: A cryptography private key object
+        """
+        stamp = self._stamp(key_file)
+        try:
+            _stamp, key = self._private[key_file]
+        except KeyError:
+            pass
+        else:
+            if _stamp == stamp:
+                return key
+
+        key = load_pem_private_key(self._read(key_file), None, backend)
+        return self._keep(self._private, key_file, (stamp, key))[1]
+
+    def public_key(self, cert_file, cert_type="pem"):
+        """ Returns the public key in a certificate or public key file.
+
+        :param cert_file: The file name or a PemData instance
+        :param cert_type: "pem" or "der"
+        :return: A cryptography public key object
+        """
+        data = self._read(cert_file)
+        index = (self.fingerprint(data), cert_type)
+        try:
+            return self._public[index]
+        except KeyError:
+            pass
+
+        if cert_type == "der":
+            key = load_der_x509_certificate(data, backend).public_key()
+        elif cert_type != "pem":
+            raise Unsupported("Certificate type: %s" % cert_type)
+        elif b"-----BEGIN CERTIFICATE-----" in data:
+            key = load_pem_x509_certificate(data, backend).public_key()
+        else:
+            key = load_pem_public_key(data, backend)
+        return self._keep(self._public, index, key)
+
+    def cert_public_key(self, cert):
+        """ Returns the public key in a certificate, as found in metadata.
+
+        :param cert: A base64 encoded DER certificate or a PEM certificate
+        :return: A cryptography public key object
+        """
+        index = (self.fingerprint(cert), "x509")
+        try:
+            return self._public[index]
+        except KeyError:
+            pass
+
+        if "-----BEGIN" not in cert:
+            cert = pem_format(cert)
+        elif not isinstance(cert, six.binary_type):
+            cert = cert.encode('ascii')
+        key = load_pem_x509_certificate(cert, backend).public_key()
+        return self._keep(self._public, index, key)
+
+    def identities(self, key_file, cert_file=None):
+        """ Returns the ways a private key can be referred to in a KeyInfo
+        element, see key_info_hints().
+
+        :param key_file: The private key file
+        :param cert_file: The certificate that goes with the key, if known
+        :return: A set of (kind, value) tuples
+        """
+        stamp = self._stamp(key_file)
+        index = (key_file, cert_file)
+        try:
+            _stamp, ids = self._identities[index]
+        except KeyError:
+            pass
+        else:
+            if _stamp == stamp:
+                return ids
+
+        pub = self.private_key(key_file).public_key()
+        ids = {("spki", spki_digest(pub)),
+               ("ski", SubjectKeyIdentifier.from_public_key(pub).digest)}
+        if cert_file:
+            try:
+                cert = load_pem_x509_certificate(self._read(cert_file),
+                                                 backend)
+            except (IOError, ValueError) as err:
+                logger.warning("Could not read %s: %s", cert_file, err)
+            else:
+                ids.update(_cert_identities(cert))
+        return self._keep(self._identities, index, (stamp, ids))[1]
+
+
+key_manager = KeyManager()
+
+DS11_NAMESPACE = "http://www.w3.org/2009/xmldsig11#"
+
+# Digests of certificates that may appear in a X509Digest element
+CERT_DIGESTS = {
+    ds.DIGEST_SHA1: hashes.SHA1,
+    ds.DIGEST_SHA256: hashes.SHA256,
+    ds.DIGEST_SHA512: hashes.SHA512,
+}
+
+
+def spki_digest(public_key):
+    return hashlib.sha256(public_key.public_bytes(
+        Encoding.DER, PublicFormat.SubjectPublicKeyInfo)).digest()
+
+
+def _cert_identities(cert):
+    ids = {("spki", spki_digest(cert.public_key())),
+           ("serial", cert.serial_number)}
+    for alg, hash_cls in CERT_DIGESTS.items():
+        ids.add(("digest", alg, cert.fingerprint(hash_cls())))
+    try:
+        ids.add(("ski", cert.extensions.get_extension_for_class(
+            SubjectKeyIdentifier).value.digest))
+    except ExtensionNotFound:
+        pass
+    for attr in cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME):
+        ids.add(("name", attr.value))
+    return ids
+
+
+def key_info_hints(enctext):
+    """ Collects what the EncryptedKey elements of a document tell about
+    the key that was used to encrypt them.
+
+    :param enctext: The XML document as a string
+    :return: A set of (kind, value) tuples that can be matched against
+        KeyManager.identities()
+    """
+    try:
+        tree = defusedxml.ElementTree.fromstring(enctext)
+    except Exception:
+        return set()
+
+    hints = set()
+    for encrypted_key in tree.iter("{%s}EncryptedKey" % xenc.NAMESPACE):
+        key_info = encrypted_key.find("{%s}KeyInfo" % ds.NAMESPACE)
+        if key_info is None:
+            continue
+        for elem in key_info:
+            if elem.tag == "{%s}KeyName" % ds.NAMESPACE and elem.text:
+                hints.add(("name", elem.text.strip()))
+            elif elem.tag != "{%s}X509Data" % ds.NAMESPACE:
+                continue
+            for item in elem:
+                try:
+                    hints.update(_x509_hint(item))
+                except (ValueError, TypeError, AttributeError) as err:
+                    logger.debug("Bad X509Data in KeyInfo: %s", err)
+    return hints
+
+
+def _x509_hint(item):
+    if item.tag == "{%s}X509IssuerSerial" % ds.NAMESPACE:
+        serial = item.find("{%s}X509SerialNumber" % ds.NAMESPACE)
+        return [("serial", int(serial.text.strip()))]
+    elif not item.text:
+        return []
+    elif item.tag == "{%s}X509Certificate" % ds.NAMESPACE:
+        cert = load_der_x509_certificate(
+            base64.b64decode("".join(item.text.split())), backend)
+        return [("spki", spki_digest(cert.public_key()))]
+    elif item.tag == "{%s}X509SKI" % ds.NAMESPACE:
+        return [("ski", base64.b64decode(item.text.strip()))]
+    elif item.tag == "{%s}X509Digest" % DS11_NAMESPACE:
+        return [("digest", item.get("Algorithm"),
+                 base64.b64decode(item.text.strip()))]
+    return []
 
 
 def parse_xmlsec_output(output):
@@ -639,6 +890,39 @@ class RSACrypto(object):
         return signer
 
 
+def redirect_signature_parts(saml_msg):
+    """ Picks out what is needed to verify the signature of a message sent
+    using the HTTP-Redirect binding. Only the query string values are used,
+    nothing is inflated or parsed.
+
+    :param saml_msg: A dictionary with strings as values, *NOT* lists as
+        produced by parse_qs.
+    :return: A tuple of signer, signed string and signature or None if the
+        signature algorithm is missing or not supported.
+    """
+    try:
+        signer = SIGNER_ALGS[saml_msg.get("SigAlg")]
+    except KeyError:
+        return None
+
+    if "SAMLRequest" in saml_msg:
+        _order = REQ_ORDER
+    elif "SAMLResponse" in saml_msg:
+        _order = RESP_ORDER
+    else:
+        raise Unsupported(
+            "Verifying signature on something that should not be signed")
+
+    string = "&".join([urlencode({k: saml_msg[k]}) for k in _order if
+                       k in saml_msg]).encode('ascii')
+    try:
+        _sign = base64.b64decode(saml_msg["Signature"])
+    except (KeyError, TypeError, ValueError):
+        raise SignatureError("Malformed signature")
+
+    return signer, string, _sign
+
+
 def verify_redirect_signature(saml_msg, crypto, cert=None, sigkey=None):
     """
 
@@ -649,33 +933,64 @@ def verify_redirect_signature(saml_msg, crypto, cert=None, sigkey=None):
     """
 
     try:
-        signer = crypto.get_signer(saml_msg["SigAlg"], sigkey)
-    except KeyError:
-        raise Unsupported("Signature algorithm: %s" % saml_msg["SigAlg"])
+        parts = redirect_signature_parts(saml_msg)
+    except SignatureError:
+        return False
+
+    if parts is None:
+        raise Unsupported("Signature algorithm: %s" % saml_msg.get("SigAlg"))
+
+    signer, string, _sign = parts
+    if cert:
+        _key = key_manager.cert_public_key(cert)
+    elif sigkey:
+        _key = sigkey
     else:
-        if saml_msg["SigAlg"] in SIGNER_ALGS:
-            if "SAMLRequest" in saml_msg:
-                _order = REQ_ORDER
-            elif "SAMLResponse" in saml_msg:
-                _order = RESP_ORDER
-            else:
-                raise Unsupported(
-                    "Verifying signature on something that should not be "
-                    "signed")
-            _args = saml_msg.copy()
-            del _args["Signature"]  # everything but the signature
-            string = "&".join(
-                [urlencode({k: _args[k]}) for k in _order if k in
-                 _args]).encode('ascii')
-
-            if cert:
-                _key = extract_rsa_key_from_x509_cert(pem_format(cert))
-            else:
-                _key = sigkey
+        _key = crypto.key
+
+    return bool(signer.verify(string, _sign, _key))
 
-            _sign = base64.b64decode(saml_msg["Signature"])
 
-            return bool(signer.verify(string, _sign, _key))
+def peek_issuer(xmlstr):
+    """ Finds the issuer of a message without building SAML objects from
+    it.
+
+    :param xmlstr: The message as a XML string
+    :return: The issuer or None if there is none
+    :raises SignatureError: If the message has more than one issuer
+    """
+    if not isinstance(xmlstr, six.binary_type):
+        xmlstr = xmlstr.encode('utf-8')
+
+    tag = "{%s}Issuer" % saml.NAMESPACE
+    depth = 0
+    issuers = []
+    try:
+        for event, elem in defusedxml.ElementTree.iterparse(
+                six.BytesIO(xmlstr), events=("start", "end")):
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            # Only the issuer of the message itself
+            if depth != 1:
+                continue
+            if elem.tag == tag:
+                issuers.append((elem.text or "").strip())
+            elif not issuers:
+                # The Issuer is the first child of a message
+                return None
+            # Only the issuers are needed
+            elem.clear()
+    except Exception as err:
+        logger.debug("Could not find issuer: %s", err)
+        return None
+
+    if not issuers:
+        return None
+    elif len(issuers) > 1:
+        raise SignatureError("More than one issuer")
+    return issuers[0] or None
 
 
 LOG_LINE = 60 * "=" + "\n%s\n" + 60 * "-" + "\n%s" + 60 * "="
@@ -739,6 +1054,27 @@ class CryptoBackend():
     def version(self):
         raise NotImplementedError()
 
+    def key_file(self, key):
+        """ Makes a key or certificate that is given as a string usable
+        where the backend expects a file name.
+
+        :param key: A PEM encoded key or certificate
+        :return: 2-tuple with a file pointer, that must be kept until the
+            backend is done with the key, and what to use as file name
+        """
+        return make_temp(key, suffix=".pem", decode=False)
+
+    def cert_file(self, cert):
+        """ Like key_file() but for the certificates of other entities,
+        which a backend may keep in files between calls.
+
+        :param cert: A PEM encoded certificate
+        :return: 2-tuple with a file pointer, that must be kept until the
+            backend is done with the certificate, and what to use as file
+            name
+        """
+        return self.key_file(cert)
+
     def encrypt(self, text, recv_key, template, key_type):
         raise NotImplementedError()
 
@@ -784,6 +1120,11 @@ class CryptoBackendXmlSec1(CryptoBackend):
         except KeyError:
             pass
 
+        # template or certificate -> temporary file holding it, least
+        # recently used first
+        self._files = OrderedDict()
+        self._files_lock = threading.Lock()
+
     def version(self):
         com_list = [self.xmlsec, "--version"]
         pof = Popen(com_list, stderr=PIPE, stdout=PIPE)
@@ -821,6 +1162,31 @@ class CryptoBackendXmlSec1(CryptoBackend):
             output = output.decode('utf-8')
         return output
 
+    def _file(self, content, suffix=""):
+        """ Templates and certificates are written to a file once. A file
+        that is dropped from the cache is removed when the last call using
+        it is done.
+
+        :param content: What the file should contain
+        :param suffix: The suffix of the file name
+        :return: The temporary file holding the content
+        """
+        content = str(content)
+        with self._files_lock:
+            try:
+                ntf = self._files.pop(content)
+            except KeyError:
+                ntf, _ = make_temp(content.encode('utf-8'), suffix=suffix,
+                                   decode=False)
+            self._files[content] = ntf
+            while len(self._files) > MAX_XMLSEC_FILES:
+                self._files.popitem(last=False)
+        return ntf
+
+    def cert_file(self, cert):
+        ntf = self._file(cert, ".pem")
+        return ntf, ntf.name
+
     def encrypt_assertion(self, statement, enc_key, template,
                           key_type="des-192", node_xpath=None, node_id=None):
         """
@@ -838,7 +1204,9 @@ class CryptoBackendXmlSec1(CryptoBackend):
 
         _, fil = make_temp(str(statement).encode('utf-8'), decode=False,
                            delete=False)
-        _, tmpl = make_temp(str(template).encode('utf-8'), decode=False)
+        # Keeps the file while xmlsec reads it
+        _tmpl = self._file(template)
+        tmpl = _tmpl.name
 
         if not node_xpath:
             node_xpath = ASSERT_XPATH
@@ -1106,6 +1474,18 @@ def security_context(conf, debug=None):
             raise SigverError(
                 "xmlsec binary not in '%s' !" % xmlsec_binary)
         crypto = _get_xmlsec_cryptobackend(xmlsec_binary, debug=debug)
+    elif conf.crypto_backend == 'native':
+        # in process, built on the cryptography package and lxml
+        from saml2.crypto_native import CryptoBackendNative
+        crypto = CryptoBackendNative(debug=debug)
+    elif conf.crypto_backend == 'XMLSecurity':
+        # new and somewhat untested pyXMLSecurity crypto backend.
+        crypto = CryptoBackendXMLSecurity(debug=debug)
+    else:
+        raise SigverError('Unknown crypto_backend %s' % (
+            repr(conf.crypto_backend)))
+
+    if conf.crypto_backend in ('xmlsec1', 'native'):
         _file_name = conf.getattr("key_file", "")
         if _file_name:
             try:
@@ -1116,13 +1496,6 @@ def security_context(conf, debug=None):
                 raise
             else:
                 sec_backend = RSACrypto(rsa_key)
-    elif conf.crypto_backend == 'XMLSecurity':
-        # new and somewhat untested pyXMLSecurity crypto backend.
-        crypto = CryptoBackendXMLSecurity(debug=debug)
-    else:
-        raise SigverError('Unknown crypto_backend %s' % (
-            repr(conf.crypto_backend)))
-
 
     enc_key_files = []
     if conf.encryption_keypairs is not None:
@@ -1140,7 +1513,7 @@ def security_context(conf, debug=None):
         validate_certificate=conf.validate_certificate,
         enc_key_files=enc_key_files,
         encryption_keypairs=conf.encryption_keypairs,
-        sec_backend=sec_backend)
+        sec_backend=sec_backend, metrics=getattr(conf, "metrics", None))
 
 
 def encrypt_cert_from_item(item):
@@ -1315,6 +1688,7 @@ class CertHandler(object):
 # openssl rsa -inform pem -noout -in publickey.pem -pubin -modulus
 class SecurityContext(object):
     my_cert = None
+    metrics = None
 
     def __init__(self, crypto, key_file="", key_type="pem",
                  cert_file="", cert_type="pem", metadata=None,
@@ -1324,7 +1698,7 @@ class SecurityContext(object):
                  tmp_key_file=None, validate_certificate=None,
                  enc_key_files=None, enc_key_type="pem",
                  encryption_keypairs=None, enc_cert_type="pem",
-                 sec_backend=None):
+                 sec_backend=None, metrics=None):
 
         self.crypto = crypto
         assert (isinstance(self.crypto, CryptoBackend))
@@ -1348,6 +1722,10 @@ class SecurityContext(object):
         # Your public key for encryption
         self.encryption_keypairs = encryption_keypairs
         self.enc_cert_type = enc_cert_type
+        # Used to find the key an encrypted message was made for
+        self._enc_cert_files = dict(
+            (_pair["key_file"], _pair.get("cert_file"))
+            for _pair in encryption_keypairs or [] if "key_file" in _pair)
 
         self.my_cert = read_cert_from_file(cert_file, cert_type)
 
@@ -1369,6 +1747,11 @@ class SecurityContext(object):
             self.template = template
 
         self.encrypt_key_type = encrypt_key_type
+        # A saml2.metrics.MetricsSink
+        self.metrics = metrics
+        self.verify_pool_size = VERIFY_POOL_SIZE
+        self._pool = None
+        self._pool_lock = threading.Lock()
         # keep certificate files to debug xmlsec invocations
         if os.environ.get('PYSAML2_KEEP_XMLSEC_TMP', None):
             self._xmlsec_delete_tmpfiles = False
@@ -1398,6 +1781,7 @@ class SecurityContext(object):
 
         return self.crypto.encrypt(text, recv_key, template, key_type)
 
+    @timed(ENCRYPT)
     def encrypt_assertion(self, statement, enc_key, template,
                           key_type="des-192", node_xpath=None):
         """
@@ -1412,44 +1796,77 @@ class SecurityContext(object):
         return self.crypto.encrypt_assertion(statement, enc_key, template,
                                              key_type, node_xpath)
 
+    def _decryption_key_files(self, enctext, extra=()):
+        """ Lists the keys to try when decrypting a document. The keys the
+        EncryptedKey elements point to, by certificate, key identifier,
+        certificate digest, serial number or key name, come first. If
+        there are no such hints all keys are tried in the configured order.
+
+        :param enctext: The encrypted document
+        :param extra: Key files to try after the configured ones
+        :return: A list of key file names
+        """
+        key_files = list(self.enc_key_files or []) + list(extra)
+        if len(key_files) < 2:
+            return key_files
+
+        if isinstance(enctext, SamlBase):
+            enctext = "%s" % enctext
+        hints = key_info_hints(enctext)
+        if not hints:
+            return key_files
+
+        matching = []
+        for key_file in key_files:
+            try:
+                ids = key_manager.identities(
+                    key_file, self._enc_cert_files.get(key_file))
+            except (IOError, OSError, ValueError, TypeError) as err:
+                logger.warning("Could not read key %s: %s", key_file, err)
+                continue
+            if ids & hints:
+                matching.append(key_file)
+
+        if not matching:
+            return key_files
+        # The others are only used if the hints were misleading
+        return matching + [k for k in key_files if k not in matching]
+
+    @timed(DECRYPT)
     def decrypt_keys(self, enctext, keys=None):
         """ Decrypting an encrypted text by the use of a private key.
 
         :param enctext: The encrypted text as a string
         :return: The decrypted text
         """
-        _enctext = None
         if not isinstance(keys, list):
             keys = [keys]
-        if self.enc_key_files is not None:
-            for _enc_key_file in self.enc_key_files:
-                _enctext = self.crypto.decrypt(enctext, _enc_key_file)
-                if _enctext is not None and len(_enctext) > 0:
-                    return _enctext
-        for _key in keys:
-            if _key is not None and len(_key.strip()) > 0:
-                if not isinstance(_key, six.binary_type):
-                    _key = str(_key).encode('ascii')
-                _, key_file = make_temp(_key, decode=False)
+        _files = [self.crypto.key_file(_key) for _key in keys
+                  if _key is not None and len(_key.strip()) > 0]
+        try:
+            for key_file in self._decryption_key_files(
+                    enctext, [_name for _, _name in _files]):
                 _enctext = self.crypto.decrypt(enctext, key_file)
                 if _enctext is not None and len(_enctext) > 0:
                     return _enctext
+        finally:
+            for _fp, _ in _files:
+                if _fp is not None:
+                    _fp.close()
         return enctext
 
+    @timed(DECRYPT)
     def decrypt(self, enctext, key_file=None):
         """ Decrypting an encrypted text by the use of a private key.
 
         :param enctext: The encrypted text as a string
         :return: The decrypted text
         """
-        _enctext = None
-        if self.enc_key_files is not None:
-            for _enc_key_file in self.enc_key_files:
-                _enctext = self.crypto.decrypt(enctext, _enc_key_file)
-                if _enctext is not None and len(_enctext) > 0:
-                    return _enctext
+        extra = []
         if key_file is not None and len(key_file.strip()) > 0:
-            _enctext = self.crypto.decrypt(enctext, key_file)
+            extra.append(key_file)
+        for _key_file in self._decryption_key_files(enctext, extra):
+            _enctext = self.crypto.decrypt(enctext, _key_file)
             if _enctext is not None and len(_enctext) > 0:
                 return _enctext
         return enctext
@@ -1480,10 +1897,8 @@ class SecurityContext(object):
                                               node_name=node_name,
                                               node_id=node_id, id_attr=id_attr)
 
-    def _check_signature(self, decoded_xml, item, node_name=NODE_NAME,
-                         origdoc=None, id_attr="", must=False,
-                         only_valid_cert=False, issuer=None):
-        # print(item)
+    @staticmethod
+    def _issuer_id(item, issuer=None):
         try:
             _issuer = item.issuer.text.strip()
         except AttributeError:
@@ -1494,22 +1909,38 @@ class SecurityContext(object):
                 _issuer = issuer.text.strip()
             except AttributeError:
                 _issuer = None
+        return _issuer
+
+    def _metadata_certs(self, _issuer):
+        if not self.metadata:
+            return []
+
+        try:
+            _certs = self.metadata.certs(_issuer, "any", "signing")
+        except KeyError:
+            _certs = []
+        certs = []
+        for cert in _certs:
+            if isinstance(cert, six.string_types):
+                certs.append(make_temp(pem_format(cert), suffix=".pem",
+                                       decode=False,
+                                       delete=self._xmlsec_delete_tmpfiles))
+            else:
+                certs.append(cert)
+        return certs
+
+    def _signing_certs(self, item, _issuer, issuer=None, metadata_certs=None):
+        """ Finds the certificates that may have been used to sign an item.
+
+        :param metadata_certs: The issuer's certificates from the metadata
+            if they already have been looked up
+        :return: A list of (temporary file, file name) tuples
+        """
         # More trust in certs from metadata then certs in the XML document
-        if self.metadata:
-            try:
-                _certs = self.metadata.certs(_issuer, "any", "signing")
-            except KeyError:
-                _certs = []
-            certs = []
-            for cert in _certs:
-                if isinstance(cert, six.string_types):
-                    certs.append(make_temp(pem_format(cert), suffix=".pem",
-                                           decode=False,
-                                           delete=self._xmlsec_delete_tmpfiles))
-                else:
-                    certs.append(cert)
+        if metadata_certs is None:
+            certs = self._metadata_certs(_issuer)
         else:
-            certs = []
+            certs = metadata_certs
 
         if not certs and not self.only_use_keys_in_metadata:
             logger.debug("==== Certs from instance ====")
@@ -1523,8 +1954,15 @@ class SecurityContext(object):
 
         if not certs:
             raise MissingKey("%s" % issuer)
+        return certs
 
-        # print(certs)
+    @timed(VERIFY)
+    def _check_signature(self, decoded_xml, item, node_name=NODE_NAME,
+                         origdoc=None, id_attr="", must=False,
+                         only_valid_cert=False, issuer=None, certs=None):
+        if certs is None:
+            certs = self._signing_certs(item, self._issuer_id(item, issuer),
+                                        issuer)
 
         verified = False
         last_pem_file = None
@@ -1738,6 +2176,95 @@ class SecurityContext(object):
 
         return response
 
+    def _verify_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.verify_pool_size)
+        return self._pool
+
+    def close(self):
+        """ Stops the threads that verify batches of responses """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def correctly_signed_responses(self, items, only_valid_cert=False,
+                                   require_response_signature=False):
+        """ Checks the signatures of a batch of responses.
+
+        The signing certificates are looked up once per issuer and the
+        verifications are run in parallel by a pool of threads. The
+        xmlsec1 backend does the crypto in subprocesses so this uses more
+        than one core.
+
+        :param items: A list of (decoded_xml, issuer) tuples. If issuer is
+            given, the entity ID of the expected issuer, the response must
+            come from that entity.
+        :param only_valid_cert:
+        :param require_response_signature: Whether the responses must be
+            signed
+        :return: A list of (response, error) tuples in the same order as
+            *items*. One of the two is always None.
+        """
+        result = [None] * len(items)
+        # issuer -> certificates from the metadata
+        certs = {}
+        jobs = []
+        for index, (decoded_xml, issuer) in enumerate(items):
+            try:
+                response = samlp.any_response_from_string(decoded_xml)
+                if not response:
+                    raise TypeError("Not a Response")
+
+                _issuer = self._issuer_id(response)
+                if issuer:
+                    if _issuer is None:
+                        _issuer = issuer
+                    elif _issuer != issuer:
+                        raise SignatureError(
+                            "Unexpected issuer: %s" % _issuer)
+
+                if not response.signature:
+                    if require_response_signature:
+                        raise SignatureError("Signature missing for response")
+                    result[index] = (response, None)
+                    continue
+            except Exception as err:
+                result[index] = (None, err)
+                continue
+
+            try:
+                if _issuer not in certs:
+                    certs[_issuer] = self._metadata_certs(_issuer)
+                _certs = self._signing_certs(response, _issuer,
+                                             metadata_certs=certs[_issuer])
+            except Exception as err:
+                result[index] = (None, err)
+                continue
+            jobs.append((index, decoded_xml, response, _certs))
+
+        def _verify(job):
+            index, decoded_xml, response, _certs = job
+            try:
+                self._check_signature(decoded_xml, response,
+                                      class_name(response),
+                                      only_valid_cert=only_valid_cert,
+                                      certs=_certs)
+            except Exception as err:
+                return index, (None, err)
+            return index, (response, None)
+
+        if len(jobs) > 1:
+            done = self._verify_pool().map(_verify, jobs)
+        else:
+            done = [_verify(job) for job in jobs]
+
+        for index, res in done:
+            result[index] = res
+        return result
+
     # --------------------------------------------------------------------------
     # SIGNATURE PART
     # --------------------------------------------------------------------------
@@ -1745,6 +2272,7 @@ class SecurityContext(object):
         """ Deprecated function. See sign_statement(). """
         return self.sign_statement(statement, **kwargs)
 
+    @timed(SIGN)
     def sign_statement(self, statement, node_name, key=None,
                        key_file=None, node_id=None, id_attr=""):
         """Sign a SAML statement.
@@ -1761,14 +2289,22 @@ class SecurityContext(object):
         if not id_attr:
             id_attr = ID_ATTR
 
+        _fp = None
         if not key_file and key:
-            _, key_file = make_temp(str(key).encode('utf-8'), ".pem")
+            # The key is a base64 encoded PEM key
+            if not isinstance(key, six.binary_type):
+                key = key.encode('utf-8')
+            _fp, key_file = self.crypto.key_file(base64.b64decode(key))
 
         if not key and not key_file:
             key_file = self.key_file
 
-        return self.crypto.sign_statement(statement, node_name, key_file,
-                                          node_id, id_attr)
+        try:
+            return self.crypto.sign_statement(statement, node_name, key_file,
+                                              node_id, id_attr)
+        finally:
+            if _fp is not None:
+                _fp.close()
 
     def sign_assertion_using_xmlsec(self, statement, **kwargs):
         """ Deprecated function. See sign_assertion(). """
@@ -1910,20 +2446,28 @@ def pre_signature_part(ident, public_key=None, identifier=None,
 # </EncryptedData>
 
 def pre_encryption_part(msg_enc=TRIPLE_DES_CBC, key_enc=RSA_1_5,
-                        key_name="my-rsa-key"):
+                        key_name="my-rsa-key", encrypt_cert=None):
     """
 
     :param msg_enc:
     :param key_enc:
     :param key_name:
+    :param encrypt_cert: The certificate of the receiver, base64 encoded.
+        If given it is included so the receiver can tell which of its keys
+        to decrypt with.
     :return:
     """
     msg_encryption_method = EncryptionMethod(algorithm=msg_enc)
     key_encryption_method = EncryptionMethod(algorithm=key_enc)
+    x509_data = None
+    if encrypt_cert:
+        x509_data = [ds.X509Data(
+            x509_certificate=[ds.X509Certificate(text=encrypt_cert)])]
     encrypted_key = EncryptedKey(id="EK",
                                  encryption_method=key_encryption_method,
                                  key_info=ds.KeyInfo(
-                                     key_name=ds.KeyName(text=key_name)),
+                                     key_name=ds.KeyName(text=key_name),
+                                     x509_data=x509_data),
                                  cipher_data=CipherData(
                                      cipher_value=CipherValue(text="")))
     key_info = ds.KeyInfo(encrypted_key=encrypted_key)
@@ -1936,6 +2480,44 @@ def pre_encryption_part(msg_enc=TRIPLE_DES_CBC, key_enc=RSA_1_5,
     return encrypted_data
 
 
+# Max number of encryption templates kept
+MAX_ENCRYPTION_TEMPLATES = 64
+
+# (encrypt_cert, msg_enc, key_enc) -> pre_encryption_part() as a string,
+# least recently used first
+_encryption_templates = OrderedDict()
+_encryption_templates_lock = threading.Lock()
+
+
+def encryption_template(encrypt_cert=None, msg_enc=TRIPLE_DES_CBC,
+                        key_enc=RSA_1_5):
+    """ Returns the pre encryption part as a string. It is built once per
+    certificate and algorithms. Since the certificate is part of the index
+    a certificate that changes in the metadata gets a new template.
+
+    :param encrypt_cert: The certificate of the receiver, base64 encoded,
+        to include in the template. None if the template should not name
+        the receivers key.
+    :param msg_enc: The algorithm used to encrypt the data
+    :param key_enc: The algorithm used to encrypt the session key
+    :return: The template as a string
+    """
+    key = (encrypt_cert, msg_enc, key_enc)
+    with _encryption_templates_lock:
+        template = _encryption_templates.pop(key, None)
+        if template is not None:
+            _encryption_templates[key] = template
+            return template
+
+    template = "%s" % pre_encryption_part(msg_enc=msg_enc, key_enc=key_enc,
+                                          encrypt_cert=encrypt_cert)
+    with _encryption_templates_lock:
+        _encryption_templates[key] = template
+        while len(_encryption_templates) > MAX_ENCRYPTION_TEMPLATES:
+            _encryption_templates.popitem(last=False)
+    return template
+
+
 def pre_encrypt_assertion(response):
     """
     Move the assertion to within a encrypted_assertion
@@ -7,6 +7,7 @@ Suppport for the client part of the SAML2.0 SOAP binding.
 """
 import logging
 
+from saml2 import ParsedXml
 from saml2 import create_class_from_element_tree
 from saml2.samlp import NAMESPACE as SAMLP_NAMESPACE
 from saml2.schema import soapenv
@@ -126,13 +127,20 @@ def parse_soap_enveloped_saml_authn_response(text):
 #    expected_tag = '{%s}LogoutResponse' % SAMLP_NAMESPACE
 #    return parse_soap_enveloped_saml_thingy(text, [expected_tag])
 
+def _parsed_part(element):
+    """ The text of a part of a SOAP message, with the element it came from
+    so that it is not parsed again """
+    return ParsedXml(ElementTree.tostring(element, encoding="UTF-8"), element)
+
+
 def parse_soap_enveloped_saml_thingy(text, expected_tags):
     """Parses a SOAP enveloped SAML thing and returns the thing as
     a string.
 
     :param text: The SOAP object as XML string
     :param expected_tags: What the tag of the SAML thingy is expected to be.
-    :return: SAML thingy as a string
+    :return: SAML thingy as a string, a :py:class:`saml2.ParsedXml` that
+        carries the already parsed element
     """
     envelope = defusedxml.ElementTree.fromstring(text)
 
@@ -152,7 +160,7 @@ def parse_soap_enveloped_saml_thingy(text, expected_tags):
 
     saml_part = body[0]
     if saml_part.tag in expected_tags:
-        return ElementTree.tostring(saml_part, encoding="UTF-8")
+        return _parsed_part(saml_part)
     else:
         raise WrongMessageType("Was '%s' expected one of %s" % (saml_part.tag,
                                                                 expected_tags))
@@ -221,11 +229,10 @@ def open_soap_envelope(text):
     for part in envelope:
         if part.tag == '{%s}Body' % soapenv.NAMESPACE:
             assert len(part) == 1
-            content["body"] = ElementTree.tostring(part[0], encoding="UTF-8")
+            content["body"] = _parsed_part(part[0])
         elif part.tag == "{%s}Header" % soapenv.NAMESPACE:
             for item in part:
-                _str = ElementTree.tostring(item, encoding="UTF-8")
-                content["header"].append(_str)
+                content["header"].append(_parsed_part(item))
 
     return content
 
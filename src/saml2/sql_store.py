@@ -0,0 +1,404 @@
+"""
+SQL (SQLite) backed implementations of the IdP session storage, the
+identifier database, the eduPersonTargetedID store and the SP identity cache.
+
+Unlike the shelve based stores these can be shared between processes.
+The database is opened in WAL mode so readers don't block the writer.
+Writes can be batched, by default every write is committed immediately.
+"""
+import json
+import logging
+import sqlite3
+import threading
+
+from hashlib import sha1
+
+import six
+from six.moves import cPickle as pickle
+
+from saml2 import time_util
+from saml2.cache import Cache
+from saml2.cache import ToOld
+from saml2.eptid import Eptid
+from saml2.ident import IdentDB
+from saml2.ident import code
+from saml2.ident import code_binary
+from saml2.ident import decode
+from saml2.saml import assertion_from_string
+from saml2.sdb import DEFAULT_LIFETIME
+from saml2.sdb import assertion_expiration
+from saml2.sdb import class_ref
+from saml2.sdb import context_match
+from saml2.time_util import to_epoch
+from saml2.time_util import utc_now
+
+logger = logging.getLogger(__name__)
+
+
+class SQLDatabase(object):
+    """ A connection to a SQLite database shared by the threads of a process.
+
+    :param filename: The database file
+    :param batch_size: Number of write operations that are grouped into one
+        transaction. With 1 every write is committed immediately.
+    :param timeout: How long to wait for a lock held by another process
+    """
+
+    def __init__(self, filename, batch_size=1, timeout=10.0):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(filename, timeout=timeout,
+                                    check_same_thread=False)
+        self.lock = threading.RLock()
+        self._pending = 0
+        # The statements written since the last commit
+        self._batch = []
+        with self.lock:
+            if filename != ":memory:":
+                self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def create(self, *statements):
+        with self.lock:
+            for statement in statements:
+                self.conn.execute(statement)
+            self.conn.commit()
+
+    def query(self, sql, args=()):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def query_one(self, sql, args=()):
+        with self.lock:
+            return self.conn.execute(sql, args).fetchone()
+
+    def write(self, sql, args=()):
+        """ Executes a data modifying statement, commits when enough writes
+        has been batched.
+
+        :return: Number of rows affected
+        """
+        return self.write_many([(sql, args)])
+
+    def write_many(self, statements):
+        """ Executes a set of data modifying statements in the same
+        transaction.
+
+        :param statements: list of (sql, args) tuples
+        :return: Number of rows affected by the last statement
+        """
+        with self.lock:
+            cur = None
+            try:
+                for sql, args in statements:
+                    cur = self.conn.execute(sql, args)
+            except Exception:
+                self.conn.rollback()
+                # Only these statements should fail, not the writes
+                # batched before them
+                self._redo()
+                raise
+            self._pending += 1
+            if self.batch_size > 1:
+                self._batch.extend(statements)
+            if self._pending >= self.batch_size:
+                self.flush()
+            return cur.rowcount
+
+    def _redo(self):
+        batch, self._batch = self._batch, []
+        self._pending = 0
+        try:
+            for sql, args in batch:
+                self.conn.execute(sql, args)
+        except Exception as err:
+            self.conn.rollback()
+            logger.error("Could not redo the batched writes: %s", err)
+            return
+        if batch:
+            self.conn.commit()
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self._pending = 0
+            self._batch = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+
+def _database(db, batch_size=1):
+    if isinstance(db, SQLDatabase):
+        return db
+    return SQLDatabase(db, batch_size)
+
+
+def _subject_key(name_id):
+    return sha1(code_binary(name_id)).hexdigest()
+
+
+# -----------------------------------------------------------------------------
+
+
+class SessionStorageSQL(object):
+    """ Session information stored in a SQL database. Same interface as
+    saml2.sdb.SessionStorage.
+    """
+
+    def __init__(self, database, lifetime=DEFAULT_LIFETIME, batch_size=1):
+        self.db = _database(database, batch_size)
+        self.lifetime = lifetime
+        self.db.create(
+            "CREATE TABLE IF NOT EXISTS assertion ("
+            "assertion_id TEXT PRIMARY KEY, name_id_key TEXT, "
+            "expires INTEGER, assertion TEXT, to_sign TEXT)",
+            "CREATE INDEX IF NOT EXISTS assertion_expires "
+            "ON assertion (expires)",
+            "CREATE TABLE IF NOT EXISTS authn_statement ("
+            "assertion_id TEXT, name_id_key TEXT, session_index TEXT, "
+            "class_ref TEXT)",
+            "CREATE INDEX IF NOT EXISTS authn_statement_subject "
+            "ON authn_statement (name_id_key, session_index)",
+            "CREATE INDEX IF NOT EXISTS authn_statement_assertion "
+            "ON authn_statement (assertion_id)")
+
+    def store_assertion(self, assertion, to_sign):
+        key = _subject_key(assertion.subject.name_id)
+        expires = assertion_expiration(assertion, self.lifetime)
+        statements = [
+            ("INSERT OR REPLACE INTO assertion VALUES (?, ?, ?, ?, ?)",
+             (assertion.id, key, expires, "%s" % assertion,
+              json.dumps(to_sign))),
+            ("DELETE FROM authn_statement WHERE assertion_id = ?",
+             (assertion.id,))]
+        for statement in assertion.authn_statement:
+            statements.append(
+                ("INSERT INTO authn_statement VALUES (?, ?, ?, ?)",
+                 (assertion.id, key, statement.session_index,
+                  class_ref(statement))))
+        self.db.write_many(statements)
+
+    def get_assertion(self, cid):
+        row = self.db.query_one(
+            "SELECT assertion, to_sign FROM assertion WHERE assertion_id = ? "
+            "AND expires >= ?", (cid, utc_now()))
+        if row is None:
+            raise KeyError(cid)
+        return (assertion_from_string(row[0]),
+                [tuple(t) for t in json.loads(row[1])])
+
+    def get_authn_statements(self, name_id, session_index=None,
+                             requested_context=None):
+        key = _subject_key(name_id)
+        sql = ("SELECT DISTINCT a.assertion_id, a.assertion "
+               "FROM authn_statement s JOIN assertion a "
+               "ON s.assertion_id = a.assertion_id "
+               "WHERE s.name_id_key = ? AND a.expires >= ?")
+        args = [key, utc_now()]
+        if session_index:
+            sql += " AND s.session_index = ?"
+            args.append(session_index)
+        if requested_context and requested_context.comparison in [None,
+                                                                  "exact"]:
+            refs = [r.text.strip() for r in
+                    requested_context.authn_context_class_ref]
+            if refs:
+                sql += " AND s.class_ref IN (%s)" % ",".join("?" * len(refs))
+                args.extend(refs)
+        sql += " ORDER BY a.rowid"
+
+        result = []
+        for _, xmlstr in self.db.query(sql, args):
+            statements = assertion_from_string(xmlstr).authn_statement
+            if requested_context:
+                if not [s for s in statements if context_match(
+                        requested_context, s.authn_context)]:
+                    continue
+            result.append(statements)
+        return result
+
+    def remove_authn_statements(self, name_id):
+        logger.debug("remove authn about: %s", name_id)
+        self.db.write("DELETE FROM authn_statement WHERE name_id_key = ?",
+                      (_subject_key(name_id),))
+
+    def remove_expired(self, now=None):
+        if now is None:
+            now = utc_now()
+        return self.db.write_many([
+            ("DELETE FROM authn_statement WHERE assertion_id IN "
+             "(SELECT assertion_id FROM assertion WHERE expires < ?)",
+             (now,)),
+            ("DELETE FROM assertion WHERE expires < ?", (now,))])
+
+    def close(self):
+        self.db.close()
+
+
+# -----------------------------------------------------------------------------
+
+
+class SQLDict(object):
+    """ A minimal dictionary like interface to a key/value table """
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.db.create("CREATE TABLE IF NOT EXISTS %s ("
+                       "key TEXT PRIMARY KEY, value TEXT)" % table)
+
+    def __getitem__(self, key):
+        row = self.db.query_one(
+            "SELECT value FROM %s WHERE key = ?" % self.table, (key,))
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key, value):
+        self.db.write("INSERT OR REPLACE INTO %s VALUES (?, ?)" % self.table,
+                      (key, value))
+
+    def __delitem__(self, key):
+        if not self.db.write("DELETE FROM %s WHERE key = ?" % self.table,
+                             (key,)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.db.query_one(
+            "SELECT 1 FROM %s WHERE key = ?" % self.table,
+            (key,)) is not None
+
+    def keys(self):
+        return [r[0] for r in self.db.query("SELECT key FROM %s" % self.table)]
+
+    def sync(self):
+        self.db.flush()
+
+    def close(self):
+        self.db.close()
+
+
+class IdentSQL(IdentDB):
+    """ The identifier database stored in a SQL database """
+
+    def __init__(self, database, domain="", name_qualifier="", batch_size=1):
+        IdentDB.__init__(self, SQLDict(_database(database, batch_size),
+                                       "ident"),
+                         domain, name_qualifier)
+
+
+class EptidSQL(Eptid):
+    """ eduPersonTargetedIDs stored in a SQL database """
+
+    def __init__(self, secret, database, batch_size=1):
+        Eptid.__init__(self, secret)
+        self._db = SQLDict(_database(database, batch_size), "eptid")
+
+    def close(self):
+        self._db.close()
+
+
+# -----------------------------------------------------------------------------
+
+
+class CacheSQL(Cache):
+    """ The SP identity cache stored in a SQL database. Each (subject, entity)
+    pair is a row of its own, so a write only touches one entry.
+    """
+
+    def __init__(self, database, batch_size=1, sweep_interval=0):
+        Cache.__init__(self)
+        self._sql = _database(database, batch_size)
+        self._sql.create(
+            "CREATE TABLE IF NOT EXISTS identity ("
+            "subject TEXT, entity_id TEXT, not_on_or_after INTEGER, "
+            "info BLOB, PRIMARY KEY (subject, entity_id))",
+            "CREATE INDEX IF NOT EXISTS identity_not_on_or_after "
+            "ON identity (not_on_or_after)")
+        if sweep_interval:
+            self.start_sweeper(sweep_interval)
+
+    def delete(self, name_id):
+        self._sql.write("DELETE FROM identity WHERE subject = ?",
+                        (code(name_id),))
+
+    def _item(self, name_id, entity_id):
+        row = self._sql.query_one(
+            "SELECT not_on_or_after, info FROM identity WHERE subject = ? AND "
+            "entity_id = ?", (code(name_id), entity_id))
+        if row is None:
+            raise KeyError(entity_id)
+        return row[0], pickle.loads(bytes(row[1]))
+
+    def get(self, name_id, entity_id, check_not_on_or_after=True):
+        (timestamp, info) = self._item(name_id, entity_id)
+        if check_not_on_or_after and time_util.after(timestamp):
+            raise ToOld("past %s" % str(timestamp))
+
+        if 'name_id' in info and isinstance(info['name_id'],
+                                            six.string_types):
+            info['name_id'] = decode(info['name_id'])
+        return info or None
+
+    def set(self, name_id, entity_id, info, not_on_or_after=0):
+        info = dict(info)
+        if 'name_id' in info and not isinstance(info['name_id'],
+                                                six.string_types):
+            info['name_id'] = code(name_id)
+
+        self._sql.write(
+            "INSERT OR REPLACE INTO identity VALUES (?, ?, ?, ?)",
+            (code(name_id), entity_id, to_epoch(not_on_or_after),
+             sqlite3.Binary(pickle.dumps(info, 2))))
+
+    def entities(self, name_id):
+        res = [r[0] for r in self._sql.query(
+            "SELECT entity_id FROM identity WHERE subject = ?",
+            (code(name_id),))]
+        if not res:
+            raise KeyError(code(name_id))
+        return res
+
+    def active(self, name_id, entity_id):
+        try:
+            (timestamp, info) = self._item(name_id, entity_id)
+        except KeyError:
+            return False
+
+        if not info:
+            return False
+        else:
+            return time_util.not_on_or_after(timestamp)
+
+    def subjects(self):
+        return [decode(r[0]) for r in self._sql.query(
+            "SELECT DISTINCT subject FROM identity")]
+
+    def remove_expired(self, now=None, max_items=None):
+        if now is None:
+            now = utc_now()
+        sql = ("DELETE FROM identity WHERE not_on_or_after > 0 AND "
+               "not_on_or_after < ?")
+        args = [now]
+        if max_items is not None:
+            sql = ("DELETE FROM identity WHERE rowid IN (SELECT rowid FROM "
+                   "identity WHERE not_on_or_after > 0 AND "
+                   "not_on_or_after < ? LIMIT ?)")
+            args.append(max_items)
+        removed = self._sql.write(sql, args)
+        self.evicted += removed
+        return removed
+
+    def stats(self):
+        return {"live": self._sql.query_one(
+            "SELECT COUNT(*) FROM identity")[0], "evicted": self.evicted}
+
+    def flush(self):
+        self._sql.flush()
+
+    def close(self):
+        self.stop_sweeper()
+        self._sql.close()
@@ -19,6 +19,13 @@ import six
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 TIME_FORMAT_WITH_FRAGMENT = re.compile(
     "^(\d{4,4}-\d{2,2}-\d{2,2}T\d{2,2}:\d{2,2}:\d{2,2})(\.\d*)?Z?$")
+XSD_DATE_TIME = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.\d*)?"
+    r"(Z|[+-]\d{2}:\d{2})?$")
+
+# Max number of parsed points in time that are kept
+MAX_CACHED_TIMES = 1024
+_epoch_cache = {}
 
 # ---------------------------------------------------------------------------
 # I'm sure this is implemented somewhere else can't find it now though, so I
@@ -229,6 +236,45 @@ def shift_time(dtime, shift):
 # ---------------------------------------------------------------------------
 
 
+def parse_date_time(timestr):
+    """ Parses a xs:dateTime value. Much faster than time.strptime and
+    the result is remembered, the same points in time turn up again and
+    again.
+
+    :param timestr: The xs:dateTime as a string
+    :return: Seconds since the epoch
+    """
+    try:
+        return _epoch_cache[timestr]
+    except KeyError:
+        pass
+
+    match = XSD_DATE_TIME.match(timestr)
+    if not match:
+        raise ValueError("Not a xs:dateTime: %s" % timestr)
+
+    (year, month, day, hour, minute, sec) = [int(v) for v in
+                                             match.groups()[:6]]
+    if not 1 <= month <= 12 or \
+            not 1 <= day <= calendar.monthrange(year, month)[1] or \
+            hour > 23 or minute > 59 or sec > 61:
+        raise ValueError("Not a xs:dateTime: %s" % timestr)
+
+    epoch = calendar.timegm((year, month, day, hour, minute, sec, 0, 0, 0))
+    zone = match.group(7)
+    if zone and zone != "Z":
+        offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+        if zone[0] == "+":
+            epoch -= offset
+        else:
+            epoch += offset
+
+    if len(_epoch_cache) >= MAX_CACHED_TIMES:
+        _epoch_cache.clear()
+    _epoch_cache[timestr] = epoch
+    return epoch
+
+
 def str_to_time(timestr, format=TIME_FORMAT):
     """
 
@@ -238,6 +284,9 @@ def str_to_time(timestr, format=TIME_FORMAT):
     """
     if not timestr:
         return 0
+    if format == TIME_FORMAT:
+        return time.gmtime(parse_date_time(timestr))
+
     try:
         then = time.strptime(timestr, format)
     except ValueError:  # assume it's a format problem
@@ -263,32 +312,51 @@ def instant(format=TIME_FORMAT, time_stamp=0):
 def utc_now():
     return calendar.timegm(time.gmtime())
 
+
+def to_epoch(point):
+    """ Seconds since the epoch for a point in time given as a number, a
+    time.struct_time, a datetime (UTC) or a xs:dateTime string.
+
+    :return: The number of seconds, 0 if no point in time was given
+    """
+    if not point:
+        return 0
+    elif isinstance(point, six.string_types):
+        return parse_date_time(point)
+    elif isinstance(point, time.struct_time):
+        return calendar.timegm(point)
+    elif isinstance(point, datetime):
+        return calendar.timegm(point.utctimetuple())
+    return int(point)
+
 # ---------------------------------------------------------------------------
 
 
-def before(point):
+def before(point, now=None):
     """ True if point datetime specification is before now.
 
     NOTE: If point is specified it is supposed to be in local time.
     Not UTC/GMT !! This is because that is what gmtime() expects.
+
+    :param point: The point in time
+    :param now: Seconds since the epoch to use as now, so that all checks
+        on one message use the same now
     """
     if not point:
         return True
 
-    if isinstance(point, six.string_types):
-        point = str_to_time(point)
-    elif isinstance(point, int):
-        point = time.gmtime(point)
+    if now is None:
+        now = utc_now()
 
-    return time.gmtime() <= point
+    return now <= to_epoch(point)
 
 
-def after(point):
+def after(point, now=None):
     """ True if point datetime specification is equal or after now """
     if not point:
         return True
     else:
-        return not before(point)
+        return not before(point, now)
 
 
 not_before = after
@@ -307,18 +375,8 @@ def utc_time_sans_frac():
 
 def later_than(after, before):
     """ True if then is later or equal to that """
-    if isinstance(after, six.string_types):
-        after = str_to_time(after)
-    elif isinstance(after, int):
-        after = time.gmtime(after)
-
-    if isinstance(before, six.string_types):
-        before = str_to_time(before)
-    elif isinstance(before, int):
-        before = time.gmtime(before)
-
     if before is None:
         return True
     if after is None:
         return False
-    return after >= before
+    return to_epoch(after) >= to_epoch(before)
@@ -1,4 +1,3 @@
-import calendar
 from six.moves.urllib.parse import urlparse
 import re
 import struct
@@ -69,7 +68,7 @@ def valid_any_uri(item):
 
 def valid_date_time(item):
     try:
-        time_util.str_to_time(item)
+        time_util.parse_date_time(item)
     except Exception:
         raise NotValid("dateTime")
     return True
@@ -86,10 +85,11 @@ def valid_url(url):
     return True
 
 
-def validate_on_or_after(not_on_or_after, slack):
+def validate_on_or_after(not_on_or_after, slack, now=None):
     if not_on_or_after:
-        now = time_util.utc_now()
-        nooa = calendar.timegm(time_util.str_to_time(not_on_or_after))
+        if now is None:
+            now = time_util.utc_now()
+        nooa = time_util.parse_date_time(not_on_or_after)
         if now > nooa + slack:
             now_str=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))
             raise ResponseLifetimeExceed(
@@ -100,10 +100,11 @@ def validate_on_or_after(not_on_or_after, slack):
         return False
 
 
-def validate_before(not_before, slack):
+def validate_before(not_before, slack, now=None):
     if not_before:
-        now = time_util.utc_now()
-        nbefore = calendar.timegm(time_util.str_to_time(not_before))
+        if now is None:
+            now = time_util.utc_now()
+        nbefore = time_util.parse_date_time(not_before)
         if nbefore > now + slack:
             now_str = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))
             raise ToEarly("Can't use response yet: (now=%s + slack=%d) "
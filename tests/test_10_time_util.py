@@ -6,6 +6,9 @@ import time
 from saml2.time_util import f_quotient, modulo, parse_duration, add_duration
 from saml2.time_util import str_to_time, instant, valid, in_a_while
 from saml2.time_util import before, after, not_before, not_on_or_after
+from saml2.time_util import later_than, parse_date_time
+
+from py.test import raises
 
 
 def test_f_quotient():
@@ -125,6 +128,28 @@ def test_str_to_time():
     t = calendar.timegm(str_to_time("2000-01-12T00:00:00"))
     assert t == 947635200
 
+def test_parse_date_time():
+    assert parse_date_time("2000-01-12T00:00:00Z") == 947635200
+    assert parse_date_time("2000-01-12T00:00:00.123Z") == 947635200
+    assert parse_date_time("2000-01-12T00:00:00") == 947635200
+    assert parse_date_time("2000-01-12T02:30:00+02:30") == 947635200
+    assert parse_date_time("2000-01-11T22:00:00-02:00") == 947635200
+    for bad in ["2000-13-12T00:00:00Z", "2000-02-30T00:00:00Z",
+                "2000-01-12 00:00:00Z", "2000-01-12T00:00:00ZZ", "today"]:
+        raises(ValueError, parse_date_time, bad)
+
+
+def test_one_now():
+    now = 947635200
+    assert before("2000-01-12T00:00:00Z", now)
+    assert not before("2000-01-11T23:59:59Z", now)
+    assert after("2000-01-11T23:59:59Z", now)
+    assert not after("2000-01-12T00:00:01Z", now)
+    assert later_than("2000-01-12T00:00:01Z", "2000-01-12T00:00:00Z")
+    assert not later_than("2000-01-12T00:00:00Z", "2000-01-12T00:00:01Z")
+    assert later_than("2000-01-12T00:00:00Z", None)
+
+
 def test_instant():
     inst = str_to_time(instant())
     now = time.gmtime()
@@ -76,6 +76,27 @@ def test_inflate_then_deflate():
     assert bis == txt
 
 
+def test_bounded_decoding():
+    decoder = utils.MessageDecoder(max_encoded=2000, max_decoded=10000)
+    txt = b"<samlp:AuthnRequest/>" * 200
+    interm = utils.deflate_and_base64_encode(txt)
+    assert decoder.decode_base64_and_inflate(interm) == txt
+    assert decoder.b64decode(base64.b64encode(txt[:700])) == txt[:700]
+
+    # Inflates to much more than the limit
+    bomb = utils.deflate_and_base64_encode(b"a" * 1000000)
+    assert len(bomb) < 2000
+    raises(utils.MessageTooLarge, decoder.decode_base64_and_inflate, bomb)
+    raises(utils.MessageTooLarge, decoder.b64decode,
+           base64.b64encode(b"a" * 2000))
+    # Truncated
+    raises(Exception, decoder.decode_base64_and_inflate,
+           base64.b64encode(base64.b64decode(interm)[:-10]))
+
+    assert decoder.stats() == {"decoded": 2, "rejected_encoded": 1,
+                               "rejected_decoded": 1}
+
+
 def test_status_success():
     status = utils.success_status_factory()
     status_text = "%s" % status
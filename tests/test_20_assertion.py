@@ -942,6 +942,53 @@ def test_assertion_with_authn_instant():
     assert msg.authn_statement[0].authn_instant == "2009-02-13T23:31:30Z"
 
 
+def test_assertion_template():
+    policy = Policy({
+        "default": {
+            "lifetime": {"minutes": 240},
+            "attribute_restrictions": None,  # means all I have
+            "name_form": NAME_FORMAT_URI
+        },
+    })
+    name_id = NameID(format=NAMEID_FORMAT_TRANSIENT, text="foobar")
+    issuer = Issuer(text="entityid", format=NAMEID_FORMAT_ENTITY)
+
+    farg = add_path(
+        {},
+        ['subject', 'subject_confirmation', 'method', saml.SCM_BEARER])
+    add_path(
+        farg['subject']['subject_confirmation'],
+        ['subject_confirmation_data', 'in_response_to', 'in_response_to'])
+    add_path(
+        farg['subject']['subject_confirmation'],
+        ['subject_confirmation_data', 'recipient', 'consumer_url'])
+
+    acs = [AttributeConverterNOOP(NAME_FORMAT_URI)]
+    tmpl = policy.template("sp_entity_id")
+    assert policy.template("sp_entity_id") is tmpl
+    assert tmpl.converter(acs) is acs[0]
+
+    msgs = [Assertion({"urn:oid:2.5.4.4": val}).construct(
+        "sp_entity_id", acs, policy, issuer=issuer, farg=farg,
+        name_id=name_id) for val in ["Roland", "Hedberg"]]
+
+    assert msgs[0].id != msgs[1].id
+    for msg, val in zip(msgs, ["Roland", "Hedberg"]):
+        assert msg.conditions.audience_restriction[0].audience[
+            0].text == "sp_entity_id"
+        attr = msg.attribute_statement[0].attribute[0]
+        assert attr.name_format == NAME_FORMAT_URI
+        assert attr.attribute_value[0].text == val
+    # Changing one assertion doesn't change the others
+    msgs[0].conditions.audience_restriction[0].audience.append(
+        saml.Audience(text="other_sp"))
+    assert len(msgs[1].conditions.audience_restriction[0].audience) == 1
+
+    # A new policy gets new templates
+    policy.compile({"default": {"lifetime": {"minutes": 15}}})
+    assert policy.template("sp_entity_id") is not tmpl
+
+
 if __name__ == "__main__":
     test_assertion_2()
 
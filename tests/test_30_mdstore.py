@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import datetime
+import os
 import re
 from collections import OrderedDict
 
@@ -8,10 +9,14 @@ from future.backports.urllib.parse import quote_plus
 
 from saml2.config import Config
 from saml2.mdstore import MetadataStore, MetaDataExtern
+from saml2.mdstore import InMemoryMetaData
+from saml2.mdstore import MetaDataDirectory
 from saml2.mdstore import MetaDataMDX
 from saml2.mdstore import SAML_METADATA_CONTENT_TYPE
 from saml2.mdstore import destinations
 from saml2.mdstore import name
+from saml2.metadata import entities_descriptor
+from saml2 import md
 from saml2 import sigver
 from saml2.httpbase import HTTPBase
 from saml2 import BINDING_SOAP
@@ -22,6 +27,7 @@ from saml2 import config
 from saml2.attribute_converter import ac_factory
 from saml2.attribute_converter import d_to_local_name
 from saml2.s_utils import UnknownPrincipal
+from pytest import raises
 from pathutils import full_path
 
 import responses
@@ -362,6 +368,131 @@ def test_load_local_dir():
     assert len(mds.keys()) == 4  # number of idps
 
 
+def test_load_parallel():
+    spec = {"local": [full_path("swamid-1.0.xml"), full_path("metadata"),
+                      full_path("uu.xml")],
+            "inline": [TEST_METADATA_STRING]}
+
+    sequential = MetadataStore(ATTRCONV, sec_config,
+                               disable_ssl_certificate_validation=True)
+    sequential.imp(spec)
+
+    for workers in [4, (2, 2)]:
+        mds = MetadataStore(ATTRCONV, sec_config,
+                            disable_ssl_certificate_validation=True,
+                            load_workers=workers)
+        mds.imp(spec)
+        # Same sources, in the same order, with the same content
+        assert list(mds.metadata.keys()) == list(sequential.metadata.keys())
+        assert _eq(mds.keys(), sequential.keys())
+        for key, _md in sequential.metadata.items():
+            assert _md.entity == mds.metadata[key].entity
+            assert mds.metadata[key].entities_descr is not None or \
+                mds.metadata[key].entity_descr is not None
+        assert mds.dumps() == sequential.dumps()
+
+    # Worker processes don't send back the descriptors, they are parsed
+    # again when asked for
+    mds = MetadataStore(ATTRCONV, sec_config,
+                        disable_ssl_certificate_validation=True,
+                        load_workers=(1, 2))
+    mds.imp(spec)
+    key = full_path("swamid-1.0.xml")
+    _md = mds.metadata[key]
+    assert _md.descriptors_parsed is False
+    assert "%s" % _md.entities_descr == \
+        "%s" % sequential.metadata[key].entities_descr
+    assert _md.descriptors_parsed is True
+
+    mds = MetadataStore(ATTRCONV, sec_config,
+                        disable_ssl_certificate_validation=True,
+                        load_workers=(2, 2))
+    with raises(IOError):
+        mds.imp({"local": [full_path("swamid-1.0.xml"),
+                           full_path("no_such_metadata.xml")]})
+
+
+def test_load_directory(tmpdir):
+    for fil in ["idp.xml", "idp_2.xml"]:
+        with open(full_path(os.path.join("metadata", fil))) as fp:
+            tmpdir.join(fil).write(fp.read())
+
+    mdd = MetaDataDirectory(ATTRCONV, str(tmpdir))
+    mdd.load()
+    assert _eq(mdd.keys(), ["urn:mace:example.com:saml:roland:idp",
+                            "http://example.com/SAML/IDP",
+                            "http://example.com/SAML/AA"])
+    _md = mdd.files[str(tmpdir.join("idp.xml"))][3]
+
+    # Nothing changed
+    assert mdd.refresh() is False
+
+    # Same content, new modification time, the file isn't parsed again
+    os.utime(str(tmpdir.join("idp.xml")), (1, 1))
+    assert mdd.refresh() is False
+    assert mdd.files[str(tmpdir.join("idp.xml"))][3] is _md
+
+    # One file added, one removed
+    with open(full_path(os.path.join("metadata", "idp_uiinfo.xml"))) as fp:
+        tmpdir.join("idp_uiinfo.xml").write(fp.read())
+    tmpdir.join("idp_2.xml").remove()
+    assert mdd.refresh() is True
+    assert _eq(mdd.keys(), ["urn:mace:example.com:saml:roland:idp",
+                            "http://example.com/saml2/idp.xml"])
+    assert mdd.files[str(tmpdir.join("idp.xml"))][3] is _md
+    assert len(mdd.entities_descr.entity_descriptor) == 2
+
+    # A broken file keeps its old content
+    tmpdir.join("idp_uiinfo.xml").write("<broken")
+    assert mdd.refresh() is False
+    assert "http://example.com/saml2/idp.xml" in mdd
+
+    # Not checked again within the check interval
+    mdd.check_interval = 3600
+    tmpdir.join("idp_uiinfo.xml").remove()
+    assert mdd.refresh() is False
+    assert mdd.refresh(force=True) is True
+    assert list(mdd.keys()) == ["urn:mace:example.com:saml:roland:idp"]
+
+    # Configured with options
+    mds = MetadataStore(ATTRCONV, None)
+    mds.imp({"directory": [{"directory": str(tmpdir),
+                            "check_interval": 60}]})
+    mdd = mds.metadata[str(tmpdir)]
+    assert mdd.check_interval == 60
+    assert list(mds.keys()) == ["urn:mace:example.com:saml:roland:idp"]
+
+
+
+def test_load_signed_directory(tmpdir):
+    conf = config.SPConfig()
+    conf.load_file("server_conf")
+    secc = sigver.security_context(conf)
+    mdf = InMemoryMetaData(ATTRCONV, None)
+    with open(full_path("metadata/idp.xml")) as fp:
+        mdf.parse(fp.read())
+    _, xmldoc = entities_descriptor(
+        mdf.entities_descr.entity_descriptor, 1, None, None, True, secc)
+    tmpdir.join("idp.xml").write(xmldoc)
+
+    mds = MetadataStore(ATTRCONV, conf)
+    mds.imp({"directory": [{"directory": str(tmpdir),
+                            "cert": full_path("test.pem")}]})
+    mdd = mds.metadata[str(tmpdir)]
+    assert list(mds.keys()) == ["urn:mace:example.com:saml:roland:idp"]
+
+    # The signature doesn't match anymore, the file keeps its old content
+    tmpdir.join("idp.xml").write(
+        xmldoc.replace("roland:idp", "roland:evil"))
+    assert mdd.refresh(force=True) is False
+    assert list(mds.keys()) == ["urn:mace:example.com:saml:roland:idp"]
+
+    mds = MetadataStore(ATTRCONV, conf)
+    with raises(sigver.SignatureError):
+        mds.imp({"directory": [{"directory": str(tmpdir),
+                                "cert": full_path("test.pem")}]})
+
+
 def test_load_extern_incommon():
     sec_config.xmlsec_binary = sigver.get_xmlsec_binary(["/opt/local/bin"])
     mds = MetadataStore(ATTRCONV, sec_config,
@@ -460,6 +591,59 @@ def test_get_certs_from_metadata_without_keydescriptor():
     assert len(certs) == 0
 
 
+def test_bulk_validity_and_protocol_filter():
+    entity = """
+  <EntityDescriptor entityID="%s" %s>
+  <IDPSSODescriptor protocolSupportEnumeration="%s">
+    <SingleSignOnService
+        Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+        Location="https://idp.example.com/sso"/>
+  </IDPSSODescriptor>
+  </EntityDescriptor>"""
+    saml2 = "urn:oasis:names:tc:SAML:2.0:protocol"
+    saml1 = "urn:oasis:names:tc:SAML:1.1:protocol"
+    next_year = datetime.datetime.utcnow().year + 1
+    xmlstr = """<EntitiesDescriptor
+    xmlns="urn:oasis:names:tc:SAML:2.0:metadata">%s</EntitiesDescriptor>""" % (
+        "".join([
+            entity % ("https://old.example.com", 'validUntil="2000-01-01T00:00:00Z"',
+                      saml2),
+            entity % ("https://new.example.com",
+                      'validUntil="%d-01-01T00:00:00Z"' % next_year, saml2),
+            entity % ("https://saml1.example.com", "", saml1),
+            entity % ("https://both.example.com", "",
+                      "%s %s" % (saml1, saml2))]))
+
+    mdf = InMemoryMetaData(ATTRCONV)
+    mdf.parse(xmlstr)
+    assert set(mdf.keys()) == {"https://new.example.com",
+                               "https://both.example.com"}
+    assert mdf.to_old == ["https://old.example.com"]
+    assert mdf["https://both.example.com"]["idpsso_descriptor"][0][
+        "protocol_support_enumeration"] == saml2
+    assert set(mdf.load_timings.keys()) == {"parse", "validity", "convert"}
+
+    # Subclasses see the entity descriptors that passed the bulk checks
+    class Seen(InMemoryMetaData):
+        def do_entity_descriptor(self, entity_descr):
+            seen.append(entity_descr.entity_id)
+            InMemoryMetaData.do_entity_descriptor(self, entity_descr)
+
+    seen = []
+    mdf = Seen(ATTRCONV)
+    mdf.parse(xmlstr)
+    assert seen == ["https://new.example.com", "https://both.example.com"]
+    assert set(mdf.keys()) == set(seen)
+
+    # Added one by one the same checks are made
+    mdf = InMemoryMetaData(ATTRCONV)
+    for entity_descr in md.entities_descriptor_from_string(
+            xmlstr).entity_descriptor:
+        mdf.do_entity_descriptor(entity_descr)
+    assert set(mdf.keys()) == set(seen)
+    assert mdf.to_old == ["https://old.example.com"]
+
+
 def test_metadata_extension_algsupport():
     mds = MetadataStore(ATTRCONV, None)
     mds.imp(METADATACONF["12"])
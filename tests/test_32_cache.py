@@ -4,7 +4,7 @@ import time
 import py
 from saml2.saml import NameID, NAMEID_FORMAT_TRANSIENT
 from saml2.cache import Cache
-from saml2.time_util import in_a_while, str_to_time
+from saml2.time_util import in_a_while, str_to_time, utc_now
 from saml2.ident import code
 
 SESSION_INFO_PATTERN = {"ava": {}, "came from": "", "not_on_or_after": 0,
@@ -123,3 +123,109 @@ class TestClass:
         (ava, inactive) = self.cache.get_identity(nid[2])
         assert inactive == ["bcde"]
         assert ava == {}
+
+
+def test_shelve_batch(tmpdir):
+    filename = str(tmpdir.join("cache"))
+    cache = Cache(filename, batch_size=3)
+    not_on_or_after = str_to_time(in_a_while(days=1))
+    session_info = SESSION_INFO_PATTERN.copy()
+    session_info["ava"] = {"givenName": ["Derek"]}
+    cache.set(nid[0], "abcd", session_info, not_on_or_after)
+    cache.set(nid[1], "abcd", session_info, not_on_or_after)
+
+    # Not written yet but visible
+    assert code(nid[0]) not in cache._db
+    assert nid_eq(cache.subjects(), nid[0:2])
+    assert cache.get(nid[0], "abcd")["ava"] == {"givenName": ["Derek"]}
+
+    cache.delete(nid[1])
+    assert code(nid[0]) in cache._db
+    assert code(nid[1]) not in cache._db
+    assert nid_eq(cache.subjects(), nid[0:1])
+
+    cache.set(nid[0], "bcde", session_info, not_on_or_after)
+    cache.close()
+
+    cache = Cache(filename)
+    assert _eq(cache.entities(nid[0]), ["abcd", "bcde"])
+    cache.close()
+
+
+def test_shelve_flush_interval(tmpdir):
+    cache = Cache(str(tmpdir.join("cache")), batch_size=100,
+                  flush_interval=10)
+    cache.set(nid[0], "abcd", SESSION_INFO_PATTERN.copy(), 0)
+    time.sleep(0.5)
+    assert code(nid[0]) in cache._db
+    cache.close()
+
+
+def test_remove_expired():
+    cache = Cache()
+    session_info = SESSION_INFO_PATTERN.copy()
+    cache.set(nid[0], "abcd", session_info,
+              str_to_time(in_a_while(minutes=5)))
+    cache.set(nid[0], "bcde", session_info, str_to_time(in_a_while(days=1)))
+    cache.set(nid[1], "abcd", session_info,
+              str_to_time(in_a_while(minutes=5)))
+    # Stored again with a later time, the first one doesn't count
+    cache.set(nid[1], "abcd", session_info, str_to_time(in_a_while(hours=2)))
+    assert cache.stats() == {"live": 3, "evicted": 0}
+
+    assert cache.remove_expired(utc_now() + 600) == 1
+    assert cache.entities(nid[0]) == ["bcde"]
+    assert cache.stats() == {"live": 2, "evicted": 1}
+
+    assert cache.remove_expired(utc_now() + 3 * 3600) == 1
+    assert nid_eq(cache.subjects(), nid[0:1])
+    assert cache.stats() == {"live": 1, "evicted": 2}
+
+
+def test_shelve_expiry_index(tmpdir):
+    filename = str(tmpdir.join("cache"))
+    cache = Cache(filename)
+    cache.set(nid[0], "abcd", SESSION_INFO_PATTERN.copy(),
+              str_to_time(in_a_while(minutes=5)))
+    cache.set(nid[1], "abcd", SESSION_INFO_PATTERN.copy(), 0)
+    cache.close()
+
+    cache = Cache(filename, sweep_interval=60)
+    assert cache.stats()["live"] == 2
+    assert cache.remove_expired(utc_now() + 600) == 1
+    cache.close()
+
+    cache = Cache(filename)
+    assert nid_eq(cache.subjects(), nid[1:2])
+    cache.close()
+
+
+def test_shelve_evict_on_set(tmpdir, monkeypatch):
+    filename = str(tmpdir.join("cache"))
+    cache = Cache(filename)
+    for name_id in nid[:2]:
+        for entity_id in ["abcd", "bcde"]:
+            cache.set(name_id, entity_id, SESSION_INFO_PATTERN.copy(),
+                      str_to_time(in_a_while(minutes=5)))
+
+    now = utc_now() + 600
+    monkeypatch.setattr("saml2.cache.utc_now", lambda: now)
+
+    flushes = []
+    flush = cache.flush
+
+    def _flush():
+        flushes.append(dict(cache._dirty))
+        flush()
+
+    cache.flush = _flush
+    cache.set(nid[2], "abcd", SESSION_INFO_PATTERN.copy(), 0)
+    # The evicted entries are written together with the new one
+    assert len(flushes) == 1
+    assert _eq(flushes[0].keys(), [code(n) for n in nid])
+    assert cache.stats() == {"live": 1, "evicted": 4}
+    cache.close()
+
+    cache = Cache(filename)
+    assert nid_eq(cache.subjects(), nid[2:])
+    cache.close()
@@ -1,8 +1,15 @@
 #!/usr/bin/env python
+from pytest import raises
+
+from saml2 import SAMLError
+from saml2.cache import Cache
+from saml2.client import Saml2Client
+from saml2.config import SPConfig
 from saml2.ident import code
 from saml2.saml import NAMEID_FORMAT_TRANSIENT, NameID
 
 from saml2.population import Population
+from saml2.sql_store import CacheSQL
 from saml2.time_util import in_a_while
 
 IDP_ONE = "urn:mace:example.com:saml:one:idp"
@@ -178,3 +185,21 @@ class TestPopulationMemoryBased():
                                                     "name_id", "ava"])
         assert info["name_id"] == nid
         assert info["ava"] == {"eduPersonEntitlement": "Anka"}
+
+
+def test_cache_types(tmpdir):
+    population = Population(("sqlite", str(tmpdir.join("subject.db"))))
+    assert isinstance(population.cache, CacheSQL)
+    with raises(SAMLError):
+        Population(("memcached", "localhost:12121"))
+
+
+def test_sp_subject_data(tmpdir):
+    database = str(tmpdir.join("subject.db"))
+    conf = SPConfig().load_file("servera_conf")
+    conf.setattr("sp", "subject_data", ("sqlite", database))
+    assert isinstance(Saml2Client(conf).users.cache, CacheSQL)
+
+    # Other databases were never used by an SP, it keeps them in memory
+    conf.setattr("sp", "subject_data", ("memcached", "localhost:12121"))
+    assert isinstance(Saml2Client(conf).users.cache, Cache)
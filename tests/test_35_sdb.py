@@ -0,0 +1,100 @@
+import time
+
+from saml2 import saml
+from saml2 import samlp
+from saml2.authn_context import INTERNETPROTOCOLPASSWORD
+from saml2.authn_context import PASSWORDPROTECTEDTRANSPORT
+from saml2.saml import NAMEID_FORMAT_TRANSIENT
+from saml2.saml import NameID
+from saml2.sdb import SessionStorage
+from saml2.sdb import assertion_expiration
+from saml2.time_util import in_a_while
+from saml2.time_util import utc_now
+
+nid = [
+    NameID(name_qualifier="foo", format=NAMEID_FORMAT_TRANSIENT, text="1234"),
+    NameID(name_qualifier="foo", format=NAMEID_FORMAT_TRANSIENT, text="9876")]
+
+
+def _assertion(aid, name_id, session_index, cls_ref, minutes=15):
+    statement = saml.AuthnStatement(
+        authn_instant=in_a_while(), session_index=session_index,
+        authn_context=saml.AuthnContext(
+            authn_context_class_ref=saml.AuthnContextClassRef(text=cls_ref)))
+    return saml.Assertion(
+        id=aid, subject=saml.Subject(name_id=name_id),
+        conditions=saml.Conditions(
+            not_on_or_after=in_a_while(minutes=minutes)),
+        authn_statement=[statement])
+
+
+def test_lookup():
+    sdb = SessionStorage()
+    sdb.store_assertion(_assertion("id1", nid[0], "s1",
+                                   INTERNETPROTOCOLPASSWORD), [])
+    sdb.store_assertion(_assertion("id2", nid[0], "s2",
+                                   PASSWORDPROTECTEDTRANSPORT), [])
+    sdb.store_assertion(_assertion("id3", nid[1], "s1",
+                                   INTERNETPROTOCOLPASSWORD), [])
+
+    assert sdb.get_assertion("id2")[0].id == "id2"
+    assert len(sdb.get_authn_statements(nid[0])) == 2
+
+    res = sdb.get_authn_statements(nid[0], "s2")
+    assert len(res) == 1
+    assert res[0][0].session_index == "s2"
+
+    assert sdb.get_authn_statements(nid[0], "s3") == []
+
+    req = samlp.RequestedAuthnContext(
+        authn_context_class_ref=[
+            saml.AuthnContextClassRef(text=INTERNETPROTOCOLPASSWORD)])
+    res = sdb.get_authn_statements(nid[0], requested_context=req)
+    assert len(res) == 1
+    assert res[0][0].session_index == "s1"
+    assert sdb.get_authn_statements(nid[0], "s2", req) == []
+
+
+def test_remove_authn_statements():
+    sdb = SessionStorage()
+    sdb.store_assertion(_assertion("id1", nid[0], "s1",
+                                   INTERNETPROTOCOLPASSWORD), [])
+    sdb.remove_authn_statements(nid[0])
+    assert sdb.get_authn_statements(nid[0]) == []
+    assert sdb.get_authn_statements(nid[0], "s1") == []
+    # The assertion itself is still there until it expires
+    assert sdb.get_assertion("id1")
+
+
+def test_expiration():
+    sdb = SessionStorage()
+    sdb.store_assertion(_assertion("id1", nid[0], "s1",
+                                   INTERNETPROTOCOLPASSWORD, 5), [])
+    sdb.store_assertion(_assertion("id2", nid[1], "s1",
+                                   INTERNETPROTOCOLPASSWORD, 60), [])
+    assert len(sdb) == 2
+
+    assert sdb.remove_expired(utc_now() + 10 * 60) == 1
+    assert len(sdb) == 1
+    assert sdb.get_authn_statements(nid[0]) == []
+    assert sdb.session_index == {(sdb._subject_key(nid[1]), "s1"): {"id2"}}
+
+    assert sdb.remove_expired(utc_now() + 2 * 3600) == 1
+    assert len(sdb) == 0
+    assert sdb.authn == {}
+    assert sdb.context == {}
+
+
+def test_expiration_session_not_on_or_after():
+    assertion = _assertion("id1", nid[0], "s1", INTERNETPROTOCOLPASSWORD, 5)
+    assertion.authn_statement[0].session_not_on_or_after = in_a_while(hours=1)
+    assert assertion_expiration(assertion) > utc_now() + 3500
+
+
+def test_sweeper():
+    sdb = SessionStorage(sweep_interval=0.01)
+    sdb.store_assertion(_assertion("id1", nid[0], "s1",
+                                   INTERNETPROTOCOLPASSWORD, -1), [])
+    time.sleep(0.5)
+    sdb.close()
+    assert len(sdb) == 0
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
 import base64
+import os
+import threading
+from collections import OrderedDict
 from saml2.xmldsig import SIG_RSA_SHA256
+from saml2.xmldsig import TRANSFORM_ENVELOPED
 from saml2 import sigver
 from saml2 import extension_elements_to_elements
 from saml2 import class_name
@@ -17,6 +21,7 @@ from saml2.saml import assertion_from_string
 from saml2.saml import EncryptedAssertion
 from saml2.samlp import response_from_string
 from saml2.s_utils import factory, do_attribute_statement
+from saml2.s_utils import Unsupported
 
 import pytest
 from py.test import raises
@@ -100,6 +105,173 @@ def test_cert_from_instance_ssp():
     assert decoder.decode(der)
 
 
+def test_pre_signature_part():
+    sig1 = sigver.pre_signature_part("id-1", CERT1, 1,
+                                     sign_alg=SIG_RSA_SHA256)
+    sig2 = sigver.pre_signature_part("id-2", CERT1, 1,
+                                     sign_alg=SIG_RSA_SHA256)
+    assert sig1.signed_info.reference.uri == "#id-1"
+    assert sig2.signed_info.reference.uri == "#id-2"
+    assert sig1.signed_info.signature_method.algorithm == SIG_RSA_SHA256
+    assert sig1.key_info.x509_data.x509_certificate[0].text == CERT1
+    assert "%s" % sig1 == ("%s" % sig2).replace("#id-2", "#id-1")
+
+    # Changing the signature of one message doesn't change another
+    sig1.signed_info.reference.transforms.transform[0].algorithm = "foo"
+    sig1.key_info.x509_data.x509_certificate[0].text = "bar"
+    sig3 = sigver.pre_signature_part("id-3", CERT1, 1,
+                                     sign_alg=SIG_RSA_SHA256)
+    for sig in [sig2, sig3]:
+        assert sig.signed_info.reference.transforms.transform[
+            0].algorithm == TRANSFORM_ENVELOPED
+        assert sig.key_info.x509_data.x509_certificate[0].text == CERT1
+    assert sig3.signed_info.reference.uri == "#id-3"
+
+    sig4 = sigver.pre_signature_part("id-4", CERT_SSP)
+    assert sig4.key_info.x509_data.x509_certificate[0].text == CERT_SSP
+    assert sig4.signed_info.signature_method.algorithm != SIG_RSA_SHA256
+    assert sigver.pre_signature_part("id-5").key_info is None
+
+
+def test_key_manager(tmpdir):
+    manager = sigver.KeyManager(max_keys=2)
+    key_file = str(tmpdir.join("key.pem"))
+    with open(PRIV_KEY, "rb") as fp:
+        key_pem = fp.read()
+    with open(key_file, "wb") as fp:
+        fp.write(key_pem)
+
+    key = manager.private_key(key_file)
+    assert manager.private_key(key_file) is key
+
+    # A changed file is read again
+    with open(full_path("test_1.key"), "rb") as fp:
+        other_pem = fp.read()
+    with open(key_file, "wb") as fp:
+        fp.write(other_pem)
+    other = manager.private_key(key_file)
+    assert other is not key
+    assert other.private_numbers() != key.private_numbers()
+
+    # Keys given as strings are parsed from memory
+    assert manager.private_key(sigver.PemData(key_pem)).private_numbers() \
+        == key.private_numbers()
+    with open(PUB_KEY, "rb") as fp:
+        pub = manager.public_key(sigver.PemData(fp.read()))
+    assert pub.public_numbers() == key.public_key().public_numbers()
+
+    # The xmlsec backends get a file that is removed when closed
+    fp, name = sigver.CryptoBackend().key_file(key_pem.decode('ascii'))
+    assert manager.private_key(name).private_numbers() == \
+        key.private_numbers()
+    fp.close()
+    assert not os.path.exists(name)
+
+    pub = manager.public_key(PUB_KEY)
+    assert manager.public_key(PUB_KEY) is pub
+    assert pub.public_numbers() == key.public_key().public_numbers()
+
+
+def test_xmlsec_files(monkeypatch):
+    monkeypatch.setattr(sigver, "MAX_XMLSEC_FILES", 1)
+    crypto = sigver.CryptoBackendXmlSec1("xmlsec1")
+    tmpl = sigver.encryption_template()
+    ntf = crypto._file(tmpl)
+    assert crypto._file(tmpl) is ntf
+    with open(ntf.name) as fp:
+        assert fp.read() == tmpl
+
+    # A file dropped from the cache is kept as long as it is used
+    other = crypto._file(sigver.encryption_template(CERT1))
+    assert other is not ntf
+    assert os.path.exists(ntf.name)
+    assert crypto._file(tmpl) is not ntf
+
+    # Certificates are written once too
+    with open(PUB_KEY) as fp:
+        cert = fp.read()
+    ntf, name = crypto.cert_file(cert)
+    assert crypto.cert_file(cert) == (ntf, name)
+    assert name.endswith(".pem")
+    with open(name) as fp:
+        assert fp.read() == cert
+
+
+def test_encryption_template():
+    tmpl = sigver.encryption_template(CERT1)
+    assert sigver.encryption_template(CERT1) is tmpl
+    assert CERT1 in tmpl
+    # The receiver can tell which key to use from the certificate
+    hints = sigver.key_info_hints(tmpl)
+    assert ("name", "my-rsa-key") in hints
+    assert len(hints) == 2
+
+    other = sigver.encryption_template(CERT_SSP)
+    assert other != tmpl
+    assert sigver.encryption_template() == "%s" % pre_encryption_part()
+
+
+def test_encryption_template_lru(monkeypatch):
+    monkeypatch.setattr(sigver, "MAX_ENCRYPTION_TEMPLATES", 2)
+    monkeypatch.setattr(sigver, "_encryption_templates", OrderedDict())
+    tmpl = sigver.encryption_template(CERT1)
+    sigver.encryption_template(CERT_SSP)
+    # Used again, it is the most recently used one
+    assert sigver.encryption_template(CERT1) is tmpl
+    sigver.encryption_template()
+    assert list(sigver._encryption_templates) == [
+        (CERT1, sigver.TRIPLE_DES_CBC, sigver.RSA_1_5),
+        (None, sigver.TRIPLE_DES_CBC, sigver.RSA_1_5)]
+    assert sigver.encryption_template(CERT1) is tmpl
+
+
+def test_redirect_signature():
+    saml_msg = {"SAMLRequest": "fZBBT8MwDIX", "RelayState": "RS",
+                "SigAlg": SIG_RSA_SHA256}
+    signer, string, _ = sigver.redirect_signature_parts(
+        dict(saml_msg, Signature=""))
+    assert string.startswith(b"SAMLRequest=fZBBT8MwDIX&RelayState=RS")
+    saml_msg["Signature"] = base64.b64encode(signer.sign(
+        string, sigver.import_rsa_key_from_file(PRIV_KEY))).decode('ascii')
+
+    cert = sigver.read_cert_from_file(PUB_KEY, "pem")
+    assert sigver.key_manager.cert_public_key(cert) is \
+        sigver.key_manager.cert_public_key(cert)
+    assert sigver.verify_redirect_signature(saml_msg, None, cert)
+    assert not sigver.verify_redirect_signature(
+        dict(saml_msg, RelayState="other"), None, cert)
+    assert not sigver.verify_redirect_signature(
+        dict(saml_msg, Signature="A"), None, cert)
+    assert sigver.redirect_signature_parts(
+        dict(saml_msg, SigAlg="unknown")) is None
+    del saml_msg["SigAlg"]
+    assert sigver.redirect_signature_parts(saml_msg) is None
+    with pytest.raises(Unsupported):
+        sigver.verify_redirect_signature(saml_msg, None, cert)
+    with pytest.raises(Unsupported):
+        sigver.verify_redirect_signature(
+            dict(saml_msg, SigAlg="unknown"), None, cert)
+
+
+def test_peek_issuer():
+    request = samlp.AuthnRequest(
+        id="id1", version="2.0", issue_instant="2009-10-30T13:20:28Z",
+        issuer=saml.Issuer(text="urn:mace:example.com:sp"),
+        extensions=samlp.Extensions(extension_elements=[]))
+    assert sigver.peek_issuer("%s" % request) == "urn:mace:example.com:sp"
+    # Only the issuer of the message itself counts
+    request = samlp.AuthnRequest(id="id1", subject=saml.Subject(
+        name_id=saml.NameID(text="foo")))
+    assert sigver.peek_issuer("%s" % request) is None
+    assert sigver.peek_issuer("<not xml") is None
+    # A message can only have one
+    request = samlp.AuthnRequest(id="id1", issuer=[
+        saml.Issuer(text="urn:mace:example.com:sp"),
+        saml.Issuer(text="urn:mace:example.com:other")])
+    with pytest.raises(sigver.SignatureError):
+        sigver.peek_issuer("%s" % request)
+
+
 class FakeConfig():
     """
     Configuration parameters for signature validation test cases.
@@ -164,6 +336,63 @@ class TestSecurity():
         response = self.sec.correctly_signed_response(xml_response)
         assert response
 
+    def test_verify_batch(self):
+        with open(SIGNED) as fp:
+            signed = fp.read()
+        with open(UNSIGNED) as fp:
+            unsigned = fp.read()
+        issuer = "http://xenosmilus.umdc.umu.se/simplesaml/saml2/idp/metadata.php"
+
+        response = factory(samlp.Response,
+                           id="22222",
+                           version="2.0",
+                           issue_instant="2009-10-30T13:20:28Z",
+                           destination="http://lingon.catalogix.se:8087/",
+                           issuer=saml.Issuer(text="urn:mace:example.com:idp"),
+                           signature=sigver.pre_signature_part(
+                               "22222", self.sec.my_cert))
+        signed_response = self.sec.sign_statement(
+            "%s" % response, class_name(response), node_id="22222")
+        tampered = signed_response.replace("lingon.catalogix.se:8087",
+                                           "example.com")
+
+        verified = []
+        check_signature = self.sec._check_signature
+
+        def _check_signature(decoded_xml, item, *args, **kwargs):
+            verified.append((item.id, threading.current_thread()))
+            return check_signature(decoded_xml, item, *args, **kwargs)
+
+        self.sec._check_signature = _check_signature
+        try:
+            res = self.sec.correctly_signed_responses(
+                [(signed_response, None), (tampered, None), (signed, None),
+                 (signed, issuer), (unsigned, None),
+                 (signed, "urn:mace:example.com:idp"), ("<foo/>", None)])
+        finally:
+            del self.sec._check_signature
+
+        assert [r is not None for r, _ in res] == [True, False, True, True,
+                                                   True, False, False]
+        assert res[0][0].id == "22222"
+        assert isinstance(res[1][1], sigver.SignatureError)
+        assert isinstance(res[5][1], sigver.SignatureError)
+        # Only the responses signed at the Response level are verified and
+        # that is done by the pool
+        assert sorted(_id for _id, _ in verified) == ["22222", "22222"]
+        assert threading.current_thread() not in [t for _, t in verified]
+
+        res = self.sec.correctly_signed_responses(
+            [(unsigned, None)], require_response_signature=True)
+        assert isinstance(res[0][1], sigver.SignatureError)
+
+        # The threads are stopped and started again when needed
+        pool = self.sec._verify_pool()
+        self.sec.close()
+        assert self.sec._pool is None
+        assert self.sec._verify_pool() is not pool
+        self.sec.close()
+
     def test_sign_assertion(self):
         ass = self._assertion
         print(ass)
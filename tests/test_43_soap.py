@@ -16,6 +16,7 @@ from defusedxml.common import EntitiesForbidden
 
 from pytest import raises
 
+import saml2
 import saml2.samlp as samlp
 from saml2.samlp import NAMESPACE as SAMLP_NAMESPACE
 from saml2 import soap
@@ -72,6 +73,27 @@ def test_make_soap_envelope():
     assert saml_part.tag == '{%s}AuthnRequest' % SAMLP_NAMESPACE
 
 
+def test_parse_soap_enveloped_saml_thingy():
+    xmlstr = soap.parse_soap_enveloped_saml_response(example)
+    assert isinstance(xmlstr, saml2.ParsedXml)
+    assert xmlstr.element.tag == '{%s}Response' % SAMLP_NAMESPACE
+    assert samlp.response_from_string(xmlstr).id == "_6c3a4f8b9c2d"
+    # The text is still there for signature verification
+    assert samlp.response_from_string(
+        xmlstr.decode("utf-8")).id == "_6c3a4f8b9c2d"
+
+    # The element is used, the text is not parsed again
+    resp = samlp.any_response_from_string(
+        saml2.ParsedXml(b"not XML", xmlstr.element))
+    assert resp.id == "_6c3a4f8b9c2d"
+
+    with raises(soap.WrongMessageType):
+        soap.parse_soap_enveloped_saml_attribute_query(example)
+
+    content = soap.open_soap_envelope(example)
+    assert content["body"].element.tag == '{%s}Response' % SAMLP_NAMESPACE
+
+
 def test_parse_soap_enveloped_saml_thingy_xxe():
     xml = """<?xml version="1.0"?>
     <!DOCTYPE lolz [
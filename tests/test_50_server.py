@@ -630,6 +630,38 @@ class TestServer1():
         self.verify_assertion(resp.assertion)
 
 
+    def test_encrypt_cert_in_key_info(self):
+        def encrypted():
+            return "%s" % self.server.create_authn_response(
+                self.ava, "id12", "http://lingon.catalogix.se:8087/",
+                "urn:mace:example.com:saml:roland:sp", name_id=self.name_id,
+                sign_response=False, sign_assertion=False,
+                encrypt_assertion=True,
+                encrypt_assertion_self_contained=True)
+
+        def encrypted_key(text):
+            resp = response_from_string(text)
+            return resp.encrypted_assertion[0].encrypted_data.key_info \
+                .encrypted_key[0]
+
+        # Off by default
+        resp = encrypted()
+        assert encrypted_key(resp).key_info.x509_data == []
+
+        self.server.config._idp_encrypt_cert_in_key_info = True
+        try:
+            resp = encrypted()
+        finally:
+            self.server.config._idp_encrypt_cert_in_key_info = None
+        assert encrypted_key(resp).key_info.x509_data[0].x509_certificate
+
+        decr_text = self.server.sec.decrypt(
+            resp, self.client.config.encryption_keypairs[1]["key_file"])
+        resp = samlp.response_from_string(decr_text)
+        resp.assertion = extension_elements_to_elements(
+            resp.encrypted_assertion[0].extension_elements, [saml, samlp])
+        self.verify_assertion(resp.assertion)
+
     def test_encrypted_signed_response_3(self):
         cert_str, cert_key_str = generate_cert()
 
@@ -1,4 +1,5 @@
 import base64
+from pytest import raises
 from contextlib import closing
 from hashlib import sha1
 from six.moves.urllib.parse import urlparse
@@ -6,13 +7,20 @@ from six.moves.urllib.parse import parse_qs
 from saml2 import BINDING_HTTP_ARTIFACT
 from saml2 import BINDING_SOAP
 from saml2 import BINDING_HTTP_POST
+from saml2 import SAMLError
+from saml2.artifact_store import ArtifactStoreMemory
+from saml2.artifact_store import ArtifactStoreSQLite
+from saml2.artifact_store import artifact_store_factory
+from saml2.artifact_store import message_handle
 from saml2.authn_context import INTERNETPROTOCOLPASSWORD
 from saml2.client import Saml2Client
 
 from saml2.entity import create_artifact
 from saml2.entity import ARTIFACT_TYPECODE
 from saml2.s_utils import sid
+from saml2.samlp import AuthnRequest
 from saml2.server import Server
+from saml2.time_util import utc_now
 
 __author__ = 'rolandh'
 
@@ -230,3 +238,62 @@ def test_artifact_flow():
         sp_resp = sp.parse_artifact_resolve_response(msg)
 
         assert sp_resp.id == response.id
+
+
+def test_message_handle():
+    b64art = create_artifact(SP, b"aabbccddeeffgghhiijj", 1)
+    assert message_handle(b64art) == "6161626263636464656566666767686869696a6a"
+
+
+def _artifact_message(handle):
+    return (create_artifact(SP, handle),
+            AuthnRequest(id="id-%s" % handle.decode('ascii'),
+                         version="2.0", issue_instant="2018-01-01T00:00:00Z"))
+
+
+def test_artifact_store_memory_one_time():
+    store = ArtifactStoreMemory()
+    artifact, message = _artifact_message(b"aabbccddeeffgghhiijj")
+    store.store(artifact, message)
+
+    assert artifact in store
+    assert store[artifact] is message
+    assert store.pop(artifact) is message
+    assert artifact not in store
+    raises(KeyError, store.pop, artifact)
+
+
+def test_artifact_store_memory_bounded():
+    store = ArtifactStoreMemory(lifetime=60, max_entries=2)
+    items = [_artifact_message(b"%020d" % i) for i in range(3)]
+    for artifact, message in items:
+        store.store(artifact, message)
+
+    assert len(store) == 2
+    assert items[0][0] not in store
+    assert store.get(items[2][0]).id == items[2][1].id
+
+    assert store.remove_expired(utc_now() + 61) == 2
+    assert len(store) == 0
+
+
+def test_artifact_store_sqlite(tmpdir):
+    filename = str(tmpdir.join("artifact.db"))
+    store = ArtifactStoreSQLite(filename)
+    artifact, message = _artifact_message(b"aabbccddeeffgghhiijj")
+    store.store(artifact, message)
+
+    # Another worker using the same database
+    other = artifact_store_factory(("sqlite", filename))
+    msg = other.pop(artifact)
+    assert isinstance(msg, AuthnRequest)
+    assert msg.id == message.id
+    raises(KeyError, store.pop, artifact)
+
+    store.store(artifact, message)
+    assert store.remove_expired(utc_now() + store.lifetime + 1) == 1
+    raises(KeyError, other.get, artifact)
+
+
+def test_artifact_store_factory_unknown():
+    raises(SAMLError, artifact_store_factory, ("nosuch", None))
@@ -1,15 +1,25 @@
 from contextlib import closing
+from saml2.pack import compile_template
+from saml2.pack import http_form_post_message
 from saml2.pack import http_redirect_message
+from saml2.pack import render_template
+from saml2.s_utils import decode_base64_and_inflate
 from saml2.sigver import verify_redirect_signature
+from saml2.sigver import CertificateError
 from saml2.sigver import import_rsa_key_from_file
 from saml2.sigver import SIG_RSA_SHA1
+from saml2.sigver import SignatureError
+from saml2.sigver import RSACrypto
 from saml2.server import Server
 from saml2 import BINDING_HTTP_REDIRECT
 from saml2.client import Saml2Client
 from saml2.config import SPConfig
 from six.moves.urllib.parse import parse_qs
 
+from py.test import raises
+
 from pathutils import dotname
+from pathutils import full_path
 
 __author__ = 'rolandh'
 
@@ -51,5 +61,101 @@ def test():
         assert verified_ok
 
 
+def test_parse_signed_redirect():
+    with closing(Server(config_file=dotname("idp_all_conf"))) as idp:
+        conf = SPConfig()
+        conf.load_file(dotname("servera_conf"))
+        sp = Saml2Client(conf)
+
+        srvs = sp.metadata.single_sign_on_service(idp.config.entityid,
+                                                  BINDING_HTTP_REDIRECT)
+
+        destination = srvs[0]["location"]
+        req_id, req = sp.create_authn_request(destination, id="id1")
+
+        signer = sp.sec.sec_backend.get_signer(SIG_RSA_SHA1)
+
+        info = http_redirect_message(req, destination, relay_state="RS",
+                                     typ="SAMLRequest", sigalg=SIG_RSA_SHA1,
+                                     signer=signer)
+
+        loc = dict(info["headers"])["Location"]
+        saml_msg = list_values2simpletons(parse_qs(loc.split("?")[1]))
+
+        req = idp.parse_authn_request(saml_msg["SAMLRequest"],
+                                      BINDING_HTTP_REDIRECT,
+                                      saml_msg=saml_msg)
+        assert req.message.id == req_id
+
+        _msg = saml_msg.copy()
+        _msg["RelayState"] = "other"
+        raises(SignatureError, idp.parse_authn_request, _msg["SAMLRequest"],
+               BINDING_HTTP_REDIRECT, saml_msg=_msg)
+
+        # Refused before the message is looked at
+        _msg = saml_msg.copy()
+        _msg["SAMLRequest"] = "garbage"
+        _msg["Signature"] = "A"
+        raises(SignatureError, idp.parse_authn_request, _msg["SAMLRequest"],
+               BINDING_HTTP_REDIRECT, saml_msg=_msg)
+        _msg = saml_msg.copy()
+        del _msg["SigAlg"]
+        raises(SignatureError, idp.parse_authn_request, _msg["SAMLRequest"],
+               BINDING_HTTP_REDIRECT, saml_msg=_msg)
+
+        # A message with a second issuer, signed by the first one
+        issuer = "<ns1:Issuer"
+        xmlstr = "%s" % sp.create_authn_request(destination, id="id2")[1]
+        index = xmlstr.index(issuer)
+        end = xmlstr.index(">", xmlstr.index("</ns1:Issuer", index)) + 1
+        xmlstr = xmlstr[:end] + xmlstr[index:end].replace(
+            sp.config.entityid, "urn:example:other") + xmlstr[end:]
+        info = http_redirect_message(xmlstr, destination, relay_state="RS",
+                                     typ="SAMLRequest", sigalg=SIG_RSA_SHA1,
+                                     signer=signer)
+        loc = dict(info["headers"])["Location"]
+        _msg = list_values2simpletons(parse_qs(loc.split("?")[1]))
+        raises(SignatureError, idp.parse_authn_request, _msg["SAMLRequest"],
+               BINDING_HTTP_REDIRECT, saml_msg=_msg)
+
+        # The certificate from metadata must be valid if required
+        idp.config._idp_want_authn_requests_only_with_valid_cert = True
+        idp.sec.cert_handler.verify_cert = lambda cert_file: False
+        raises(CertificateError, idp.parse_authn_request,
+               saml_msg["SAMLRequest"], BINDING_HTTP_REDIRECT,
+               saml_msg=saml_msg)
+
+
+def test_redirect_encoding():
+    crypto = RSACrypto(import_rsa_key_from_file(full_path("test.key")))
+    signer = crypto.get_signer(SIG_RSA_SHA1)
+    message = '<samlp:AuthnRequest ID="id1"/>'
+
+    info = http_redirect_message(message, "https://idp.example.com/sso?a=b",
+                                 relay_state="https://sp/?x=1&y=\xe5",
+                                 typ="SAMLRequest", sigalg=SIG_RSA_SHA1,
+                                 signer=signer)
+    loc = dict(info["headers"])["Location"]
+    assert loc.startswith("https://idp.example.com/sso?a=b&SAMLRequest=")
+
+    # URL encoded once, the signed string is the start of the query
+    query = loc.split("?")[1].split("&", 1)[1]
+    assert [p.split("=")[0] for p in query.split("&")] == [
+        "SAMLRequest", "RelayState", "SigAlg", "Signature"]
+    saml_msg = list_values2simpletons(parse_qs(query))
+    assert saml_msg["RelayState"] == "https://sp/?x=1&y=\xe5"
+    assert decode_base64_and_inflate(
+        saml_msg["SAMLRequest"]).decode("utf-8") == message
+    assert verify_redirect_signature(saml_msg, crypto)
+
+    info = http_form_post_message(message, "https://sp.example.com/acs",
+                                  relay_state='"RS"', typ="SAMLResponse")
+    assert 'name="RelayState" value="&quot;RS&quot;"' in info["data"]
+    assert '<form action="https://sp.example.com/acs"' in info["data"]
+
+    template = compile_template("<{tag}>{text}</{tag}>")
+    assert render_template(template, tag="p", text="x") == "<p>x</p>"
+
+
 if __name__ == "__main__":
     test()
@@ -0,0 +1,138 @@
+import sqlite3
+
+from pytest import raises
+
+from saml2 import saml
+from saml2.authn_context import INTERNETPROTOCOLPASSWORD
+from saml2.ident import code
+from saml2.saml import NAMEID_FORMAT_PERSISTENT
+from saml2.saml import NAMEID_FORMAT_TRANSIENT
+from saml2.saml import NameID
+from saml2.sql_store import CacheSQL
+from saml2.sql_store import EptidSQL
+from saml2.sql_store import IdentSQL
+from saml2.sql_store import SQLDatabase
+from saml2.sql_store import SessionStorageSQL
+from saml2.time_util import in_a_while
+from saml2.time_util import str_to_time
+from saml2.time_util import utc_now
+
+nid = NameID(name_qualifier="foo", format=NAMEID_FORMAT_TRANSIENT,
+             text="1234")
+
+
+def _assertion(aid, session_index, minutes=15):
+    statement = saml.AuthnStatement(
+        authn_instant=in_a_while(), session_index=session_index,
+        authn_context=saml.AuthnContext(
+            authn_context_class_ref=saml.AuthnContextClassRef(
+                text=INTERNETPROTOCOLPASSWORD)))
+    return saml.Assertion(
+        id=aid, subject=saml.Subject(name_id=nid),
+        conditions=saml.Conditions(
+            not_on_or_after=in_a_while(minutes=minutes)),
+        authn_statement=[statement])
+
+
+def test_session_storage(tmpdir):
+    filename = str(tmpdir.join("session.db"))
+    sdb = SessionStorageSQL(filename)
+    sdb.store_assertion(_assertion("id1", "s1"),
+                        [("urn:oasis:names:tc:SAML:2.0:assertion:Assertion",
+                          "id1")])
+    sdb.store_assertion(_assertion("id2", "s2", 60), [])
+
+    # Another process
+    other = SessionStorageSQL(filename)
+    assertion, to_sign = other.get_assertion("id1")
+    assert assertion.id == "id1"
+    assert to_sign == [("urn:oasis:names:tc:SAML:2.0:assertion:Assertion",
+                        "id1")]
+
+    assert len(other.get_authn_statements(nid)) == 2
+    res = other.get_authn_statements(nid, "s2")
+    assert len(res) == 1
+    assert res[0][0].session_index == "s2"
+
+    assert sdb.remove_expired(utc_now() + 30 * 60) == 1
+    assert len(other.get_authn_statements(nid)) == 1
+
+    other.remove_authn_statements(nid)
+    assert sdb.get_authn_statements(nid) == []
+    assert sdb.get_assertion("id2")[0].id == "id2"
+
+
+def test_ident(tmpdir):
+    filename = str(tmpdir.join("ident.db"))
+    ident = IdentSQL(filename, name_qualifier="urn:mace:example.com:idp:2")
+    name_id = ident.persistent_nameid("foobar", "urn:mace:example.com:sp:1")
+    assert name_id.format == NAMEID_FORMAT_PERSISTENT
+    assert ident.find_local_id(name_id) == "foobar"
+
+    other = IdentSQL(filename)
+    assert other.persistent_nameid("foobar",
+                                   "urn:mace:example.com:sp:1") == name_id
+    assert [code(n) for n in other.find_nameid("foobar")] == [code(name_id)]
+
+    other.remove_local("foobar")
+    assert ident.find_local_id(name_id) is None
+    assert ident.find_nameid("foobar") == []
+
+
+def test_eptid(tmpdir):
+    filename = str(tmpdir.join("eptid.db"))
+    edb = EptidSQL("secret", filename)
+    e1 = edb.get("idp_entity_id", "sp_entity_id", "user_id", "some data")
+    assert e1.startswith("idp_entity_id!sp_entity_id!")
+    assert EptidSQL("secret", filename)[b"sp_entity_id__user_id"] == e1
+
+
+def test_failed_write_keeps_batch(tmpdir):
+    database = SQLDatabase(str(tmpdir.join("batch.db")), batch_size=10)
+    database.create("CREATE TABLE kv (key TEXT PRIMARY KEY, value TEXT)")
+    database.write("INSERT INTO kv VALUES (?, ?)", ("a", "1"))
+    with raises(sqlite3.IntegrityError):
+        database.write_many([("INSERT INTO kv VALUES (?, ?)", ("b", "2")),
+                             ("INSERT INTO kv VALUES (?, ?)", ("a", "3"))])
+    database.write("INSERT INTO kv VALUES (?, ?)", ("c", "4"))
+    database.close()
+
+    database = SQLDatabase(str(tmpdir.join("batch.db")))
+    assert database.query("SELECT key, value FROM kv ORDER BY key") == [
+        ("a", "1"), ("c", "4")]
+    database.close()
+
+
+def test_cache(tmpdir):
+    database = SQLDatabase(str(tmpdir.join("cache.db")), batch_size=10)
+    cache = CacheSQL(database)
+    not_on_or_after = str_to_time(in_a_while(days=1))
+    session_info = {"ava": {"givenName": ["Derek"]}, "name_id": nid,
+                    "came_from": "", "not_on_or_after": not_on_or_after}
+    cache.set(nid, "abcd", session_info, not_on_or_after)
+    cache.set(nid, "bcde", {"ava": {"surName": ["Jeter"]}}, not_on_or_after)
+
+    ava, inactive = cache.get_identity(nid)
+    assert inactive == []
+    assert ava == {"givenName": ["Derek"], "surName": ["Jeter"]}
+    assert code(cache.get(nid, "abcd")["name_id"]) == code(nid)
+    assert set(cache.entities(nid)) == {"abcd", "bcde"}
+    assert cache.active(nid, "abcd")
+    assert [code(s) for s in cache.subjects()] == [code(nid)]
+
+    cache.reset(nid, "bcde")
+    assert not cache.active(nid, "bcde")
+
+    cache.delete(nid)
+    assert cache.get_identity(nid) == ({}, [])
+    cache.close()
+
+
+def test_cache_remove_expired(tmpdir):
+    cache = CacheSQL(str(tmpdir.join("cache.db")))
+    cache.set(nid, "abcd", {"ava": {}}, str_to_time(in_a_while(minutes=5)))
+    cache.set(nid, "bcde", {"ava": {}}, 0)
+    assert cache.remove_expired(utc_now() + 600) == 1
+    assert cache.entities(nid) == ["bcde"]
+    assert cache.stats() == {"live": 1, "evicted": 1}
+    cache.close()
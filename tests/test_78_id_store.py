@@ -0,0 +1,85 @@
+from pytest import raises
+
+from saml2 import SAMLError
+from saml2.id_store import IdStoreMemory
+from saml2.id_store import IdStoreSQLite
+from saml2.id_store import id_store_factory
+from saml2.time_util import utc_now
+
+
+def test_memory():
+    store = IdStoreMemory(lifetime=60)
+    store["id1"] = "http://example.com/service"
+    assert "id1" in store
+    assert store["id1"] == "http://example.com/service"
+    assert store.keys() == ["id1"]
+
+    assert store.pop("id1") == "http://example.com/service"
+    assert "id1" not in store
+    assert store.pop("id1", None) is None
+    with raises(KeyError):
+        store.pop("id1")
+
+
+def test_memory_expiration():
+    store = IdStoreMemory(lifetime=60)
+    now = utc_now()
+    store.store("id1", "a", expires=now + 10)
+    store.store("id2", "b")
+    assert store.remove_expired(now + 30) == 1
+    assert store.keys() == ["id2"]
+
+    # Expired entries are dropped when new ones are stored
+    store.store("id3", "c", expires=now - 1)
+    assert "id3" not in store
+    with raises(KeyError):
+        _ = store["id3"]
+    assert len(store) == 1
+
+
+def test_memory_bounded():
+    store = IdStoreMemory(lifetime=60, max_entries=2)
+    now = utc_now()
+    store.store("id1", expires=now + 30)
+    store.store("id2", expires=now + 10)
+    store.store("id3", expires=now + 20)
+    # The one closest to expiration is dropped
+    assert sorted(store.keys()) == ["id1", "id3"]
+
+
+def test_add():
+    store = IdStoreMemory()
+    assert store.add("id1")
+    assert not store.add("id1")
+    # An expired ID may be used again
+    store.store("id2", expires=utc_now() - 1)
+    assert store.add("id2")
+
+
+def test_sqlite(tmpdir):
+    filename = str(tmpdir.join("ids.db"))
+    store = IdStoreSQLite(filename, "outstanding", 60)
+    seen = IdStoreSQLite(filename, "seen", 60)
+    store["id1"] = {"came_from": "/"}
+
+    # Another process
+    other = IdStoreSQLite(filename, "outstanding", 60)
+    assert other["id1"] == {"came_from": "/"}
+    assert "id1" not in seen
+    assert other.pop("id1") == {"came_from": "/"}
+    assert store.pop("id1", None) is None
+
+    assert seen.add("id2")
+    assert not IdStoreSQLite(filename, "seen", 60).add("id2")
+    assert seen.remove_expired(utc_now() + 120) == 1
+
+
+def test_factory(tmpdir):
+    assert isinstance(id_store_factory(None, "seen"), IdStoreMemory)
+    assert id_store_factory(("memory", 10), "seen").max_entries == 10
+    store = id_store_factory(("sqlite", str(tmpdir.join("ids.db"))), "seen",
+                             30)
+    assert isinstance(store, IdStoreSQLite)
+    assert store.lifetime == 30
+    with raises(SAMLError):
+        id_store_factory(("nosuch", None), "seen")
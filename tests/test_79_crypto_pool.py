@@ -0,0 +1,45 @@
+from saml2 import config
+from saml2.crypto_pool import CryptoPool
+from saml2.saml import NAMEID_FORMAT_TRANSIENT
+from saml2.saml import NameID
+from saml2.samlp import response_from_string
+from saml2.server import Server
+
+RESPONSE = 'urn:oasis:names:tc:SAML:2.0:protocol:Response'
+ASSERTION = 'urn:oasis:names:tc:SAML:2.0:assertion:Assertion'
+
+
+class TestCryptoPool():
+    def setup_class(self):
+        conf = config.IdPConfig()
+        conf.load_file("idp_conf")
+        conf.crypto_pool = (2, 4)
+        self.server = Server(config=conf)
+        self.name_id = NameID(format=NAMEID_FORMAT_TRANSIENT, text="id12")
+        self.ava = {"givenName": ["Derek"], "sn": ["Jeter"],
+                    "mail": ["derek@nyy.mlb.com"], "title": "The man"}
+
+    def teardown_class(self):
+        self.server.close()
+
+    def test_signed_response(self):
+        assert isinstance(self.server.sec, CryptoPool)
+        assert self.server.sec.max_pending == 4
+
+        signed_resp = self.server.create_authn_response(
+            self.ava, "id12", "http://lingon.catalogix.se:8087/",
+            "urn:mace:example.com:saml:roland:sp", name_id=self.name_id,
+            sign_response=True, sign_assertion=True)
+
+        sresponse = response_from_string(signed_resp)
+        # Verified locally
+        assert self.server.sec.verify_signature(
+            signed_resp, self.server.config.cert_file, node_name=RESPONSE,
+            node_id=sresponse.id, id_attr="")
+        assert self.server.sec.verify_signature(
+            signed_resp, self.server.config.cert_file, node_name=ASSERTION,
+            node_id=sresponse.assertion[0].id, id_attr="")
+
+        stats = self.server.sec.stats()
+        assert stats["completed"] == 2
+        assert stats["pending"] == 0
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+import base64
+import re
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from saml2 import class_name
+from saml2 import saml
+from saml2 import samlp
+from saml2 import sigver
+from saml2.crypto_native import AES256_GCM
+from saml2.crypto_native import CryptoBackendNative
+from saml2.crypto_native import RSA_OAEP_MGF1P
+from saml2.crypto_native import sign_data
+from saml2.crypto_native import verify_data
+from saml2.s_utils import do_attribute_statement
+from saml2.s_utils import factory
+from saml2.sigver import SignatureError
+from saml2.sigver import pre_encryption_part
+from saml2.sigver import pre_signature_part
+from saml2.xmldsig import SIG_ECDSA_SHA256
+from saml2.xmldsig import SIG_RSA_SHA256
+from saml2.xmldsig import TRANSFORM_ENVELOPED
+
+from py.test import raises
+
+from pathutils import full_path
+
+PUB_KEY = full_path("test.pem")
+PRIV_KEY = full_path("test.key")
+
+ENC_PUB_KEY = full_path("pki/test_3.crt")
+ENC_PRIV_KEY = full_path("pki/test_3.key")
+
+
+class FakeConfig():
+    xmlsec_binary = None
+    crypto_backend = 'native'
+    only_use_keys_in_metadata = False
+    metadata = None
+    cert_file = PUB_KEY
+    key_file = PRIV_KEY
+    encryption_keypairs = [{"key_file": ENC_PRIV_KEY,
+                            "cert_file": ENC_PUB_KEY}]
+    debug = False
+    cert_handler_extra_class = None
+    generate_cert_func = None
+    generate_cert_info = False
+    tmp_cert_file = None
+    tmp_key_file = None
+    validate_certificate = False
+
+    def getattr(self, attr, default):
+        return getattr(self, attr, default)
+
+
+def _response(sign=False):
+    assertion = factory(
+        saml.Assertion, version="2.0", id="id-assertion",
+        issue_instant="2009-10-30T13:20:28Z",
+        attribute_statement=do_attribute_statement({
+            ("", "", "surName"): ("Foo", ""),
+            ("", "", "givenName"): ("Bar", ""),
+        }))
+    response = samlp.Response(id="id-response", version="2.0",
+                              issue_instant="2009-10-30T13:20:28Z",
+                              assertion=assertion)
+    if sign:
+        cert = sigver.read_cert_from_file(PUB_KEY, "pem")
+        assertion.signature = pre_signature_part(
+            assertion.id, cert, 1, sign_alg=SIG_RSA_SHA256)
+        response.signature = pre_signature_part(response.id, cert, 2)
+    return response
+
+
+class TestCryptoBackendNative():
+    def setup_class(self):
+        self.sec = sigver.security_context(FakeConfig())
+
+    def test_backend(self):
+        assert isinstance(self.sec.crypto, CryptoBackendNative)
+        assert self.sec.crypto.version().startswith("native")
+
+    def _signed(self):
+        response = _response(sign=True)
+        signed = self.sec.sign_statement(
+            "%s" % response, class_name(response.assertion),
+            node_id=response.assertion.id)
+        return self.sec.sign_statement(signed, class_name(response),
+                                       node_id=response.id)
+
+    def test_sign_verify(self):
+        signed = self._signed()
+        resp = self.sec.correctly_signed_response(signed)
+        assert resp.signature.signature_value.text
+        assert self.sec.verify_signature(
+            signed, PUB_KEY, node_name=class_name(saml.Assertion()),
+            node_id="id-assertion", id_attr="")
+
+    def test_tampered(self):
+        signed = self._signed()
+        with raises(SignatureError):
+            self.sec.verify_signature(
+                signed.replace(">Bar<", ">Baz<"), PUB_KEY,
+                node_name=class_name(saml.Assertion()),
+                node_id="id-assertion", id_attr="")
+        with raises(SignatureError):
+            self.sec.correctly_signed_response(
+                signed.replace("Foo", "Fie"))
+
+    def test_signature_must_cover_node(self):
+        signed = self._signed()
+        # The signature of the assertion does not cover the response
+        response = samlp.response_from_string(signed)
+        response.signature = response.assertion[0].signature
+        with raises(SignatureError):
+            self.sec.verify_signature(
+                "%s" % response, PUB_KEY, node_name=class_name(response),
+                node_id="id-response", id_attr="")
+
+    def test_malformed_signature(self):
+        signed = self._signed()
+        node = dict(node_name=class_name(saml.Assertion()),
+                    node_id="id-assertion", id_attr="")
+        broken = [
+            # Unknown transform
+            signed.replace(TRANSFORM_ENVELOPED, "urn:example:transform"),
+            # No DigestMethod
+            re.sub(r"<\w+:DigestMethod [^>]*/>", "", signed),
+            # Signature method that doesn't match the key
+            signed.replace(SIG_RSA_SHA256, SIG_ECDSA_SHA256),
+            # Unknown signature method
+            signed.replace(SIG_RSA_SHA256, "urn:example:signature"),
+        ]
+        for text in broken:
+            assert text != signed
+            with raises(SignatureError):
+                self.sec.verify_signature(text, PUB_KEY, **node)
+
+    def test_encrypt_decrypt(self):
+        enc = self.sec.encrypt_assertion(_response(), ENC_PUB_KEY,
+                                         pre_encryption_part())
+        resp = samlp.response_from_string(enc)
+        assert resp.encrypted_assertion[0].encrypted_data
+        assert "Bar" not in enc
+
+        # Wrong key
+        assert self.sec.crypto.decrypt(enc, PRIV_KEY) is None
+
+        dec = self.sec.decrypt_keys(enc)
+        resp = samlp.response_from_string(dec)
+        assertion = resp.encrypted_assertion[0].extensions_as_elements(
+            "Assertion", saml)[0]
+        assert assertion.id == "id-assertion"
+
+    def test_key_strings(self):
+        # Keys given as strings are not written to files
+        fp, key_file = self.sec.crypto.key_file("pem")
+        assert fp is None
+        assert isinstance(key_file, sigver.PemData)
+
+        with open(PRIV_KEY, "rb") as fp:
+            key = base64.b64encode(fp.read())
+        response = _response(sign=True)
+        signed = self.sec.sign_statement(
+            "%s" % response, class_name(response.assertion), key=key,
+            node_id=response.assertion.id)
+        assert self.sec.verify_signature(
+            signed, PUB_KEY, node_name=class_name(saml.Assertion()),
+            node_id="id-assertion", id_attr="")
+
+        enc = self.sec.encrypt_assertion(_response(), ENC_PUB_KEY,
+                                         pre_encryption_part())
+        with open(ENC_PRIV_KEY) as fp:
+            dec = self.sec.decrypt_keys(enc, keys=[fp.read()])
+        assert "Bar" in dec
+
+    def test_encrypt_aes_gcm_oaep(self):
+        template = pre_encryption_part(msg_enc=AES256_GCM,
+                                       key_enc=RSA_OAEP_MGF1P)
+        enc = self.sec.encrypt_assertion(_response(), ENC_PUB_KEY, template)
+        dec = self.sec.decrypt(enc)
+        assert "EncryptedData" not in dec
+        assert 'ID="id-assertion"' in dec
+
+
+def test_decrypt_with_hinted_key():
+    conf = FakeConfig()
+    conf.encryption_keypairs = [
+        {"key_file": PRIV_KEY, "cert_file": PUB_KEY},
+        {"key_file": ENC_PRIV_KEY, "cert_file": ENC_PUB_KEY}]
+    sec = sigver.security_context(conf)
+    cert = sigver.read_cert_from_file(ENC_PUB_KEY, "pem")
+
+    tried = []
+    _decrypt = sec.crypto.decrypt
+
+    def decrypt(enctext, key_file):
+        tried.append(key_file)
+        return _decrypt(enctext, key_file)
+
+    sec.crypto.decrypt = decrypt
+
+    # The certificate in the EncryptedKey points to the second key
+    enc = sec.encrypt_assertion(_response(), ENC_PUB_KEY,
+                                pre_encryption_part(encrypt_cert=cert))
+    assert ("spki", sigver.spki_digest(
+        sigver.key_manager.public_key(ENC_PUB_KEY))) in \
+        sigver.key_info_hints(enc)
+    assert 'ID="id-assertion"' in sec.decrypt_keys(enc)
+    assert tried == [ENC_PRIV_KEY]
+
+    # Without hints all keys are tried in order
+    del tried[:]
+    enc = sec.encrypt_assertion(_response(), ENC_PUB_KEY,
+                                pre_encryption_part())
+    assert sigver.key_info_hints(enc) == {("name", "my-rsa-key")}
+    assert 'ID="id-assertion"' in sec.decrypt(enc)
+    assert tried == [PRIV_KEY, ENC_PRIV_KEY]
+
+
+def test_verify_data_ecdsa_length():
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    signature = sign_data(key, SIG_ECDSA_SHA256, b"data")
+    assert len(signature) == 64
+    assert verify_data(key.public_key(), SIG_ECDSA_SHA256, b"data", signature)
+    for bad in [b"", signature[:-1], signature + b"\x00", signature[:32]]:
+        assert not verify_data(key.public_key(), SIG_ECDSA_SHA256, b"data",
+                               bad)
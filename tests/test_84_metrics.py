@@ -0,0 +1,118 @@
+import base64
+import copy
+
+from py.test import raises
+
+from saml2 import BINDING_HTTP_POST
+from saml2 import config
+from saml2.authn_context import INTERNETPROTOCOLPASSWORD
+from saml2.client import Saml2Client
+from saml2.metrics import Collector
+from saml2.metrics import measure
+from saml2.metrics import timed
+from saml2.saml import NAMEID_FORMAT_TRANSIENT
+from saml2.saml import NameID
+from saml2.server import Server
+
+AUTHN = {
+    "class_ref": INTERNETPROTOCOLPASSWORD,
+    "authn_auth": "http://www.example.com/login"
+}
+
+
+class Timed(object):
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+
+    @timed("op")
+    def op(self, fail=False):
+        if fail:
+            raise ValueError("failed")
+        return "done"
+
+
+def test_collector():
+    sink = Collector()
+    obj = Timed(sink)
+    assert obj.op() == "done"
+    assert obj.op() == "done"
+    with raises(ValueError):
+        obj.op(fail=True)
+    with measure(sink, "block"):
+        pass
+    sink.count("thing", 2)
+
+    stats = sink.stats()
+    assert stats["op"]["count"] == 3
+    assert stats["op"]["min"] <= stats["op"]["mean"] <= stats["op"]["max"]
+    assert stats["op.error"] == {"count": 1}
+    assert stats["block"]["count"] == 1
+    assert stats["thing"] == {"count": 2}
+
+    sink.reset()
+    assert sink.stats() == {}
+
+
+def test_disabled():
+    assert Timed().op() == "done"
+    with measure(None, "block"):
+        pass
+
+
+def test_sink_in_config_module(tmpdir):
+    tmpdir.join("metrics_conf.py").write(
+        "from saml2.metrics import Collector\n"
+        "SINK = Collector()\n"
+        "CONFIG = {'entityid': 'urn:example:sp', 'metrics': SINK}\n")
+    conf = config.SPConfig()
+    conf.load_file(str(tmpdir.join("metrics_conf")))
+    import metrics_conf
+    assert conf.metrics is metrics_conf.SINK
+    assert copy.deepcopy(conf.metrics) is conf.metrics
+
+
+class TestEntityMetrics():
+    def setup_class(self):
+        conf = config.IdPConfig()
+        conf.load_file("idp_conf")
+        conf.metrics = Collector()
+        self.server = Server(config=conf)
+
+        conf = config.SPConfig()
+        conf.load_file("server_conf")
+        conf.metrics = Collector()
+        self.client = Saml2Client(conf)
+
+        self.name_id = NameID(format=NAMEID_FORMAT_TRANSIENT, text="id12")
+        self.ava = {"givenName": ["Derek"], "sn": ["Jeter"],
+                    "mail": ["derek@nyy.mlb.com"], "title": "The man"}
+
+    def teardown_class(self):
+        self.server.close()
+
+    def test_authn_response(self):
+        resp = self.server.create_authn_response(
+            self.ava, "id1", "http://lingon.catalogix.se:8087/",
+            "urn:mace:example.com:saml:roland:sp", name_id=self.name_id,
+            userid="foba0001@example.com", authn=AUTHN, sign_response=True,
+            sign_assertion=True)
+
+        stats = self.server.metrics.stats()
+        assert stats["authn_response_create"]["count"] == 1
+        assert stats["assertion_construct"]["count"] == 1
+        assert stats["policy_filter"]["count"] == 1
+        assert stats["sign"]["count"] == 2
+        # The security context reports to the same sink
+        assert self.server.sec.metrics is self.server.metrics
+
+        self.client.parse_authn_request_response(
+            base64.b64encode(("%s" % resp).encode("utf-8")),
+            BINDING_HTTP_POST, {"id1": "http://foo.example.com/service"})
+
+        stats = self.client.metrics.stats()
+        assert stats["authn_response_parse"]["count"] == 1
+        assert stats["parse"]["count"] == 1
+        assert stats["unravel"]["count"] == 1
+        assert stats["signature_verify"]["count"] >= 2
+        assert stats["parse"]["total"] <= stats["authn_response_parse"][
+            "total"]
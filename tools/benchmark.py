@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the hot paths in single sign-on, run against the keys,
+configurations and metadata in tests/. Nothing is fetched from the net.
+
+Usage::
+
+    benchmark.py [-n iterations] [-e entities] [-c crypto_backend] [-m]
+                 [-w threads[,processes]] [-j results.json] [benchmark ...]
+
+Without names all benchmarks are run. The results are printed as a table and,
+with -j, written as JSON so they can be compared between runs. With -m the
+time spent in each hot path, as reported through saml2.metrics, is added.
+With -w the metadata is loaded by that many worker threads and processes, as
+with the metadata_load_workers configuration option.
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+TESTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "tests")
+# The configurations in tests/ are imported as modules
+sys.path.insert(0, TESTS)
+
+from saml2 import BINDING_HTTP_POST
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2 import md
+from saml2 import saml
+from saml2 import __version__
+from saml2.attribute_converter import ac_factory
+from saml2.attribute_converter import from_local
+from saml2.attribute_converter import to_local
+from saml2.client import Saml2Client
+from saml2.config import IdPConfig
+from saml2.config import SPConfig
+from saml2.mdstore import MetadataStore
+from saml2.metrics import Collector
+from saml2.saml import NAME_FORMAT_URI
+from saml2.server import Server
+from saml2.xmldsig import SIG_RSA_SHA256
+
+from synthetic_metadata import synthetic_metadata
+
+timer = getattr(time, "perf_counter", time.time)
+
+IDP = "urn:mace:example.com:saml:roland:idp"
+SP = "urn:mace:example.com:saml:roland:sp"
+
+# The aggregate is also split into this many files, that can be loaded in
+# parallel
+METADATA_PARTS = 4
+ACS = "http://lingon.catalogix.se:8087/"
+
+AVA = {"givenName": ["Derek"], "sn": ["Jeter"],
+       "mail": ["derek@nyy.mlb.com"], "title": ["The man"]}
+
+AUTHN = {"class_ref": saml.AUTHN_PASSWORD,
+         "authn_auth": "http://www.example.com/login"}
+
+
+class Context(object):
+    """ The entities and data the benchmarks share """
+
+    def __init__(self, crypto_backend=None, entities=2000, metrics=False,
+                 load_workers=None):
+        conf = IdPConfig()
+        conf.load_file("idp_conf")
+        if crypto_backend:
+            conf.crypto_backend = crypto_backend
+        if metrics:
+            conf.metrics = Collector()
+        self.server = Server(config=conf)
+
+        conf = SPConfig()
+        conf.load_file("server_conf")
+        if crypto_backend:
+            conf.crypto_backend = crypto_backend
+        if metrics:
+            conf.metrics = Collector()
+        self.client = Saml2Client(conf)
+
+        self.name_id = self.server.ident.transient_nameid(SP, "id12")
+        self.entities = entities
+        self.load_workers = load_workers
+        self._desc = None
+        self._aggregate = None
+        self._parts = None
+
+    def _write(self, xmldoc):
+        fd, name = tempfile.mkstemp(suffix=".xml")
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(xmldoc)
+        return name
+
+    @property
+    def aggregate(self):
+        if self._aggregate is None:
+            self._desc, xmldoc = synthetic_metadata(self.entities)
+            self._aggregate = self._write(xmldoc)
+        return self._aggregate
+
+    @property
+    def aggregate_parts(self):
+        """ The entities of the aggregate spread over METADATA_PARTS files """
+        if self._parts is None:
+            _ = self.aggregate
+            eds = self._desc.entity_descriptor
+            self._parts = [self._write(("%s" % md.EntitiesDescriptor(
+                valid_until=self._desc.valid_until,
+                entity_descriptor=eds[i::METADATA_PARTS])).encode("utf-8"))
+                for i in range(METADATA_PARTS)]
+        return self._parts
+
+    def authn_response(self, **kwargs):
+        return self.server.create_authn_response(
+            AVA, "id1", ACS, SP, name_id=self.name_id,
+            userid="foba0001@example.com", authn=AUTHN, **kwargs)
+
+    def close(self):
+        self.server.close()
+        for name in [self._aggregate] + (self._parts or []):
+            if name:
+                os.unlink(name)
+
+
+# Every benchmark gets the context and returns a (prepare, run) tuple.
+# prepare is called, untimed, before each run and returns the arguments
+# to run, the time of run is what is measured.
+
+def bench_authn_response_signed(ctx):
+    def run():
+        return ctx.authn_response(sign_response=True, sign_assertion=True)
+    return None, run
+
+
+def bench_authn_response_encrypted(ctx):
+    def run():
+        return ctx.authn_response(sign_response=True, encrypt_assertion=True)
+    return None, run
+
+
+def bench_parse_authn_response(ctx):
+    # A new response every time, the same one would be taken for a replay
+    def prepare():
+        resp = "%s" % ctx.authn_response(sign_response=True)
+        return (base64.b64encode(resp.encode("utf-8")),)
+
+    def run(resp):
+        return ctx.client.parse_authn_request_response(
+            resp, BINDING_HTTP_POST, {"id1": "http://foo.example.com/service"})
+    return prepare, run
+
+
+def bench_authn_request_redirect(ctx):
+    def run():
+        return ctx.client.prepare_for_authenticate(
+            entityid=IDP, relay_state="https://sp.example.com/return",
+            binding=BINDING_HTTP_REDIRECT)
+    return None, run
+
+
+def bench_authn_request_redirect_signed(ctx):
+    def run():
+        return ctx.client.prepare_for_authenticate(
+            entityid=IDP, relay_state="https://sp.example.com/return",
+            binding=BINDING_HTTP_REDIRECT, sign=True,
+            sigalg=SIG_RSA_SHA256)
+    return None, run
+
+
+def bench_metadata_load(ctx):
+    acs = ac_factory(os.path.join(TESTS, "attributemaps"))
+    parts = ctx.aggregate_parts
+
+    def prepare():
+        return (MetadataStore(acs, ctx.server.config,
+                              load_workers=ctx.load_workers),)
+
+    # Goes through the same paths as the metadata of a service
+    def run(mds):
+        mds.imp({"local": parts})
+        return mds
+    return prepare, run
+
+
+def bench_metadata_lookup(ctx):
+    acs = ac_factory(os.path.join(TESTS, "attributemaps"))
+    mds = MetadataStore(acs, ctx.server.config)
+    mds.load("local", ctx.aggregate)
+    idps = sorted(mds.identity_providers())
+    sps = sorted(mds.service_providers())
+    state = {"n": 0}
+
+    # Endpoints and keys of IdPs and SPs spread over the aggregate
+    def run():
+        state["n"] += 1
+        idp = idps[state["n"] * 7919 % len(idps)]
+        sp = sps[state["n"] * 7919 % len(sps)]
+        mds.single_sign_on_service(idp, BINDING_HTTP_REDIRECT)
+        mds.assertion_consumer_service(sp, BINDING_HTTP_POST)
+        mds.certs(idp, "idpsso", "signing")
+        return mds.certs(sp, "spsso", "encryption")
+    return None, run
+
+
+def bench_attribute_to_local(ctx):
+    acs = ctx.client.config.attribute_converters
+    statement = saml.AttributeStatement(
+        attribute=from_local(acs, AVA, NAME_FORMAT_URI))
+
+    def run():
+        return to_local(acs, statement)
+    return None, run
+
+
+def bench_attribute_from_local(ctx):
+    acs = ctx.server.config.attribute_converters
+
+    def run():
+        return from_local(acs, AVA, NAME_FORMAT_URI)
+    return None, run
+
+
+def bench_policy_filter(ctx):
+    policy = ctx.server.config.getattr("policy", "idp")
+    ava = dict([(k, list(v)) for k, v in AVA.items()])
+
+    def run():
+        return policy.filter(dict(ava), SP, ctx.server.metadata)
+    return None, run
+
+
+BENCHMARKS = [
+    ("authn_response_signed", bench_authn_response_signed),
+    ("authn_response_encrypted", bench_authn_response_encrypted),
+    ("parse_authn_response", bench_parse_authn_response),
+    ("authn_request_redirect", bench_authn_request_redirect),
+    ("authn_request_redirect_signed", bench_authn_request_redirect_signed),
+    ("metadata_load", bench_metadata_load),
+    ("metadata_lookup", bench_metadata_lookup),
+    ("attribute_to_local", bench_attribute_to_local),
+    ("attribute_from_local", bench_attribute_from_local),
+    ("policy_filter", bench_policy_filter),
+]
+
+# Loading a large aggregate takes a while, do it fewer times
+ITERATION_FACTOR = {"metadata_load": 0.02}
+
+
+def measure(prepare, run, iterations):
+    """ Runs a benchmark
+
+    :return: A list of the time, in seconds, of each run
+    """
+    times = []
+    for _ in range(iterations):
+        args = prepare() if prepare else ()
+        start = timer()
+        run(*args)
+        times.append(timer() - start)
+    return times
+
+
+def summary(name, times):
+    times = sorted(times)
+    num = len(times)
+    mean = sum(times) / num
+    return {
+        "name": name,
+        "iterations": num,
+        "min": times[0],
+        "max": times[-1],
+        "mean": mean,
+        "median": times[num // 2],
+        "p95": times[min(num - 1, int(num * 0.95))],
+        "ops_per_sec": 1.0 / mean if mean else None,
+    }
+
+
+def run_benchmarks(ctx, names=None, iterations=100, warmup=3):
+    results = []
+    for name, bench in BENCHMARKS:
+        if names and name not in names:
+            continue
+        num = max(1, int(iterations * ITERATION_FACTOR.get(name, 1)))
+        try:
+            prepare, run = bench(ctx)
+            measure(prepare, run, warmup)
+            for entity in [ctx.server, ctx.client]:
+                if entity.metrics is not None:
+                    entity.metrics.reset()
+            res = summary(name, measure(prepare, run, num))
+            if ctx.server.metrics is not None:
+                res["metrics"] = {"idp": ctx.server.metrics.stats(),
+                                  "sp": ctx.client.metrics.stats()}
+            results.append(res)
+        except Exception as err:
+            # One broken benchmark shouldn't stop the others
+            results.append({"name": name, "error": "%s: %s" % (
+                err.__class__.__name__, err)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pysaml2 benchmarks")
+    parser.add_argument('-n', dest='iterations', type=int, default=100,
+                        help="Number of timed runs of each benchmark")
+    parser.add_argument('-e', dest='entities', type=int, default=2000,
+                        help="Number of entities in the metadata aggregate")
+    parser.add_argument('-c', dest='crypto_backend',
+                        help="Crypto backend, instead of the configured one")
+    parser.add_argument('-m', dest='metrics', action='store_true',
+                        help="Report the time spent in each hot path")
+    parser.add_argument('-w', dest='load_workers',
+                        help="Metadata load workers, threads[,processes]")
+    parser.add_argument('-j', dest='json',
+                        help="Write the results as JSON to this file")
+    parser.add_argument(dest="names", nargs="*",
+                        help="Benchmarks to run: %s" % ", ".join(
+                            [n for n, _ in BENCHMARKS]))
+    args = parser.parse_args(argv)
+
+    load_workers = None
+    if args.load_workers:
+        load_workers = tuple(int(n) for n in args.load_workers.split(","))
+        if len(load_workers) == 1:
+            load_workers = load_workers[0]
+
+    ctx = Context(args.crypto_backend, args.entities, args.metrics,
+                  load_workers)
+    try:
+        results = run_benchmarks(ctx, args.names, args.iterations)
+    finally:
+        ctx.close()
+
+    print("%-32s %8s %12s %12s %12s" % ("benchmark", "runs", "median ms",
+                                        "p95 ms", "ops/s"))
+    for res in results:
+        if "error" in res:
+            print("%-32s %s" % (res["name"], res["error"]))
+            continue
+        print("%-32s %8d %12.3f %12.3f %12.1f" % (
+            res["name"], res["iterations"], res["median"] * 1000,
+            res["p95"] * 1000, res["ops_per_sec"] or 0))
+        for role, stats in sorted(res.get("metrics", {}).items()):
+            for op, stat in sorted(stats.items()):
+                if "mean" not in stat:
+                    continue
+                print("    %-28s %8d %12.3f" % ("%s %s" % (role, op),
+                                                stat["count"],
+                                                stat["mean"] * 1000))
+
+    if args.json:
+        report = {
+            "time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "pysaml2": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "crypto_backend": ctx.server.config.crypto_backend,
+            "entities": args.entities,
+            "metadata_load_workers": load_workers,
+            "results": results,
+        }
+        with open(args.json, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+Creates large synthetic federation metadata, an EntitiesDescriptor with a
+mix of IdPs and SPs, to test how metadata handling scales.
+
+The entities are built with the same functions in saml2.metadata that
+make_metadata.py uses and look like what is found in real federations:
+mdui, entity categories, scopes, contact persons, requested attributes and
+one or more signing and encryption keys. The same seed gives the same
+metadata.
+
+Usage::
+
+    synthetic_metadata.py [-n entities] [-i idp_share] [-r seed]
+                          [-v valid_hours] [-s -k key -c cert] [-o file]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+
+import six
+
+from saml2 import BINDING_HTTP_ARTIFACT
+from saml2 import BINDING_HTTP_POST
+from saml2 import BINDING_HTTP_REDIRECT
+from saml2 import BINDING_SOAP
+from saml2 import md
+from saml2.attribute_converter import ac_factory
+from saml2.config import Config
+from saml2.extension import mdattr
+from saml2.extension.idpdisc import BINDING_DISCO
+from saml2.metadata import do_contact_person_info
+from saml2.metadata import do_idpsso_descriptor
+from saml2.metadata import do_organization_info
+from saml2.metadata import do_spsso_descriptor
+from saml2.metadata import entities_descriptor
+from saml2.metadata import metadata_tostring_fix
+from saml2.metadata import read_cert
+from saml2.saml import NAME_FORMAT_URI
+from saml2.saml import Attribute
+from saml2.saml import AttributeValue
+from saml2.sigver import security_context
+from saml2.validate import valid_instance
+
+TESTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "tests")
+
+# Certificates the keys of the entities are picked from
+CERT_FILES = [os.path.join(TESTS, f) for f in
+              ["test.pem", "test_1.crt", "test_2.crt", "pki/test_3.crt",
+               "keys/mycert.pem", "pki/cert.crt"]]
+
+ENTITY_CATEGORIES = [
+    "http://refeds.org/category/research-and-scholarship",
+    "http://www.geant.net/uri/dataprotection-code-of-conduct/v1",
+    "http://refeds.org/category/hide-from-discovery",
+]
+
+ASSURANCE_CERTIFICATION = \
+    "urn:oasis:names:tc:SAML:attribute:assurance-certification"
+SIRTFI = "https://refeds.org/sirtfi"
+
+ATTRIBUTES = ["eduPersonPrincipalName", "eduPersonScopedAffiliation",
+              "eduPersonTargetedID", "mail", "displayName", "givenName",
+              "sn", "schacHomeOrganization", "norEduPersonNIN"]
+
+NAMEID_FORMATS = [
+    "urn:oasis:names:tc:SAML:2.0:nameid-format:transient",
+    "urn:oasis:names:tc:SAML:2.0:nameid-format:persistent",
+    "urn:oasis:names:tc:SAML:1.1:nameid-format:emailAddress",
+]
+
+NSPAIR = {"xs": "http://www.w3.org/2001/XMLSchema"}
+
+
+class EntityConf(object):
+    """ The parts of an entity configuration the metadata functions read.
+    Much faster to create than a Config when there are many entities. """
+
+    metadata_key_usage = "both"
+    requested_attribute_name_format = NAME_FORMAT_URI
+
+    def __init__(self, acs, name=None, description=None, **kwargs):
+        self.attribute_converters = acs
+        self.name = name
+        self.description = description
+        self._conf = kwargs
+
+    def getattr(self, attr, context=None):
+        return self._conf.get(attr)
+
+
+def _sample(rnd, population, low, high):
+    return rnd.sample(population, rnd.randint(low, min(high,
+                                                       len(population))))
+
+
+def _entity_attributes(rnd, idp):
+    attributes = []
+    categories = _sample(rnd, ENTITY_CATEGORIES, 0, 2)
+    if categories:
+        name = "http://macedir.org/entity-category"
+        if idp:
+            name += "-support"
+        attributes.append(Attribute(
+            name=name, name_format=NAME_FORMAT_URI,
+            attribute_value=[AttributeValue(text=c) for c in categories]))
+    if rnd.random() < 0.3:
+        attributes.append(Attribute(
+            name=ASSURANCE_CERTIFICATION, name_format=NAME_FORMAT_URI,
+            attribute_value=[AttributeValue(text=SIRTFI)]))
+    return attributes
+
+
+def _ui_info(rnd, org, base):
+    ui_info = {
+        "display_name": [{"text": "%s service" % org, "lang": "en"},
+                         {"text": "%s tjanst" % org, "lang": "sv"}],
+        "description": [{"text": "Service number %d of %s" % (
+            rnd.randint(1, 1000), org), "lang": "en"}],
+        "information_url": [{"text": "%s/about" % base, "lang": "en"}],
+        "privacy_statement_url": [{"text": "%s/privacy" % base,
+                                   "lang": "en"}],
+    }
+    if rnd.random() < 0.7:
+        ui_info["logo"] = {"text": "%s/logo.png" % base, "height": "60",
+                           "width": "80"}
+    if rnd.random() < 0.5:
+        ui_info["keywords"] = [{"text": ["research", "library"],
+                                "lang": "en"}]
+    return ui_info
+
+
+def synthetic_entity(index, rnd, acs, certs, idp_share=0.2):
+    """ Creates one entity
+
+    :param index: Number of the entity, makes the entity ID unique
+    :param rnd: A random.Random instance
+    :param acs: Attribute converters
+    :param certs: Certificates to pick the keys from
+    :param idp_share: How large part of the entities that should be IdPs
+    :return: A md.EntityDescriptor instance
+    """
+    idp = rnd.random() < idp_share
+    org = "org%d" % (index // 4)
+    domain = "%s.example.org" % org
+    if idp:
+        base = "https://idp%d.%s" % (index, domain)
+    else:
+        base = "https://sp%d.%s" % (index, domain)
+
+    sign_certs = _sample(rnd, certs, 1, 3)
+    enc_certs = _sample(rnd, certs, 0, 2) or None
+
+    kwargs = {
+        "ui_info": _ui_info(rnd, org, base),
+        "name_id_format": _sample(rnd, NAMEID_FORMATS, 1, 2),
+    }
+    if idp:
+        kwargs["endpoints"] = {
+            "single_sign_on_service": [
+                ("%s/sso/redirect" % base, BINDING_HTTP_REDIRECT),
+                ("%s/sso/post" % base, BINDING_HTTP_POST)],
+            "single_logout_service": [
+                ("%s/slo" % base, BINDING_HTTP_REDIRECT)],
+            "artifact_resolution_service": [
+                ("%s/ars" % base, BINDING_SOAP)],
+        }
+        kwargs["scope"] = [domain]
+        conf = EntityConf(acs, **kwargs)
+        descriptor = do_idpsso_descriptor(conf, sign_certs, enc_certs)
+    else:
+        acs_endpoints = [("%s/acs/post" % base, BINDING_HTTP_POST)]
+        if rnd.random() < 0.3:
+            acs_endpoints.append(("%s/acs/artifact" % base,
+                                  BINDING_HTTP_ARTIFACT))
+        kwargs["endpoints"] = {
+            "assertion_consumer_service": acs_endpoints,
+            "single_logout_service": [
+                ("%s/slo" % base, BINDING_HTTP_REDIRECT)],
+            "discovery_response": [("%s/disco" % base, BINDING_DISCO)],
+        }
+        required = _sample(rnd, ATTRIBUTES, 1, 3)
+        kwargs["required_attributes"] = required
+        kwargs["optional_attributes"] = [
+            a for a in _sample(rnd, ATTRIBUTES, 0, 3) if a not in required]
+        conf = EntityConf(acs, name=("%s service" % org, "en"), **kwargs)
+        descriptor = do_spsso_descriptor(conf, sign_certs, enc_certs)
+
+    entd = md.EntityDescriptor(entity_id=base)
+    if idp:
+        entd.idpsso_descriptor = descriptor
+    else:
+        entd.spsso_descriptor = descriptor
+
+    entd.organization = do_organization_info({
+        "name": [(org, "en")],
+        "display_name": [("Organization %s" % org, "en")],
+        "url": "https://www.%s" % domain})
+    entd.contact_person = do_contact_person_info([
+        {"contact_type": "technical", "given_name": "Tech",
+         "email_address": "tech@%s" % domain},
+        {"contact_type": "support", "email_address": "help@%s" % domain}])
+
+    attributes = _entity_attributes(rnd, idp)
+    if attributes:
+        entd.extensions = md.Extensions()
+        entd.extensions.add_extension_element(
+            mdattr.EntityAttributes(attribute=attributes))
+    return entd
+
+
+def synthetic_metadata(entities, idp_share=0.2, seed=0, valid_for=24,
+                       name="", sign=False, secc=None, cert_files=None):
+    """ Creates an EntitiesDescriptor with synthetic entities
+
+    :param entities: Number of entities
+    :param idp_share: How large part of the entities that should be IdPs
+    :param seed: Seed for the random choices
+    :param valid_for: Hours the metadata should be valid for
+    :param name: Name of the EntitiesDescriptor
+    :param sign: Whether the EntitiesDescriptor should be signed
+    :param secc: The security context to sign with
+    :param cert_files: Certificates to pick the keys of the entities from
+    :return: A (md.EntitiesDescriptor instance, XML document) tuple
+    """
+    rnd = random.Random(seed)
+    acs = ac_factory()
+    certs = ["".join(read_cert(f)) for f in cert_files or CERT_FILES]
+
+    eds = [synthetic_entity(index, rnd, acs, certs, idp_share)
+           for index in range(entities)]
+    desc, xmldoc = entities_descriptor(eds, valid_for, name, None, sign, secc)
+    valid_instance(desc)
+    if xmldoc is not None and not isinstance(xmldoc, six.binary_type):
+        xmldoc = xmldoc.encode("utf-8")
+    return desc, metadata_tostring_fix(desc, NSPAIR, xmldoc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Creates synthetic federation metadata")
+    parser.add_argument('-n', dest='entities', type=int, default=10000,
+                        help="Number of entities")
+    parser.add_argument('-i', dest='idp_share', type=float, default=0.2,
+                        help="How large part of the entities are IdPs")
+    parser.add_argument('-r', dest='seed', type=int, default=0,
+                        help="Seed for the random choices")
+    parser.add_argument('-v', dest='valid', type=int, default=24,
+                        help="How long, in hours, the metadata is valid")
+    parser.add_argument('-N', dest='name', default="",
+                        help="Name of the EntitiesDescriptor")
+    parser.add_argument('-s', dest='sign', action='store_true',
+                        help="Sign the metadata")
+    parser.add_argument('-k', dest='keyfile',
+                        help="A file with a key to sign the metadata with")
+    parser.add_argument('-c', dest='cert', help='certificate')
+    parser.add_argument('-x', dest='xmlsec',
+                        help="xmlsec binaries to be used for the signing")
+    parser.add_argument('-b', dest='crypto_backend',
+                        help="Crypto backend to sign with")
+    parser.add_argument('-o', dest='output',
+                        help="File to write the metadata to")
+    args = parser.parse_args(argv)
+
+    secc = None
+    if args.sign:
+        conf = Config()
+        conf.key_file = args.keyfile
+        conf.cert_file = args.cert
+        conf.xmlsec_binary = args.xmlsec
+        if args.crypto_backend:
+            conf.crypto_backend = args.crypto_backend
+        secc = security_context(conf)
+
+    _, xmldoc = synthetic_metadata(args.entities, args.idp_share, args.seed,
+                                   args.valid, args.name, args.sign, secc)
+    if args.output:
+        with open(args.output, "wb") as fp:
+            fp.write(xmldoc)
+    else:
+        print(xmldoc.decode("utf-8"))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])